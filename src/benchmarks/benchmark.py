@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark choppy on synthetic rasters, shapefiles and NetCDF cubes.
+
+All inputs are generated offline at the chosen scale. Every case runs in
+its own process so its wall time and peak RSS are measured in isolation,
+and the results are written to a JSON file to compare across versions:
+
+    ./benchmark.py --scale small --output bench_small.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import zipfile
+import argparse
+import platform
+import resource
+import traceback
+import subprocess
+import multiprocessing as mp
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+import numpy as np
+
+# polygons, raster side in pixels, NetCDF times and NetCDF side in pixels
+SCALES = {
+    'tiny': dict(polygons=16, raster=256, times=10, grid=32),
+    'small': dict(polygons=100, raster=1000, times=10, grid=100),
+    'medium': dict(polygons=3000, raster=10000, times=1000, grid=200),
+    'large': dict(polygons=100000, raster=50000, times=10000, grid=500),
+}
+BOUNDS = (-104.0, 40.0, -95.0, 43.0)
+OUTPUT_FORMATS = ['csv', 'parquet', 'feather', 'netcdf']
+CLI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'choppy-lite.py')
+# the engine modules a mode only loads when its run uses them
+ENGINES = ['choppyzs.categorical', 'choppyzs.coverage', 'choppyzs.overviews',
+           'choppyzs.parallel', 'choppyzs.planner', 'choppyzs.streaming']
+# the modules each CLI mode loads and the ones it must not load
+STARTUP_MODES = {
+    'cli': ([], ['choppyzs.choppy', 'choppyzs.netcdf', 'rasterio']),
+    'raster': (['choppyzs.choppy'], ['choppyzs.netcdf', 'xarray'] + ENGINES),
+    'netcdf': (['choppyzs.netcdf'],
+               ['choppyzs.choppy', 'rasterstats'] + ENGINES),
+    'imagediff': (['choppyzs.imagediff'],
+                  ['rasterio', 'geopandas', 'shapely']),
+    'hashindex': (['choppyzs.hashindex'],
+                  ['choppyzs.parallel', 'rasterio', 'geopandas']),
+}
+IMAGE_MODULES = ['cv2', 'imagehash', 'PIL', 'imageio', 'scipy']
+STARTUP_SCRIPT = """
+import sys, json, time, runpy
+start = time.perf_counter()
+runpy.run_path(sys.argv[1])
+for module in sys.argv[3:]:
+    __import__(module)
+print(json.dumps({'import_seconds': time.perf_counter() - start,
+                  'loaded': [m for m in json.loads(sys.argv[2])
+                             if m in sys.modules]}))
+"""
+
+
+# synthetic inputs {{{1 ------------------------------------------------------
+def make_shapes(path, n_polygons, bounds=BOUNDS):
+    """Write a zipped shapefile of a grid of n_polygons squares."""
+    import geopandas as gpd
+    from shapely.geometry import box
+    west, south, east, north = bounds
+    columns = int(math.ceil(math.sqrt(n_polygons)))
+    rows = int(math.ceil(n_polygons / columns))
+    width = (east - west) / columns
+    height = (north - south) / rows
+    geoms = [box(west + (i % columns) * width, south + (i // columns) * height,
+                 west + (i % columns + 1) * width,
+                 south + (i // columns + 1) * height)
+             for i in range(n_polygons)]
+    shapes = gpd.GeoDataFrame({'ZONE': np.arange(n_polygons)},
+                              geometry=geoms, crs='EPSG:4326')
+    stem = os.path.splitext(path)[0]
+    shapes.to_file(stem + '.shp')
+    with zipfile.ZipFile(path, 'w') as archive:
+        for extension in ['shp', 'shx', 'dbf', 'prj', 'cpg']:
+            if os.path.isfile(f'{stem}.{extension}'):
+                archive.write(f'{stem}.{extension}',
+                              f'{os.path.basename(stem)}.{extension}')
+    return path
+
+
+def make_raster(path, size, bounds=BOUNDS, seed=0):
+    """Write a tiled int32 GeoTIFF of size x size pixels strip by strip."""
+    import rasterio as rio
+    from rasterio.transform import from_bounds
+    from rasterio.windows import Window
+    rng = np.random.default_rng(seed)
+    profile = dict(driver='GTiff', height=size, width=size, count=1,
+                   dtype='int32', crs='EPSG:4326', nodata=-1, tiled=True,
+                   blockxsize=256, blockysize=256, compress='deflate',
+                   transform=from_bounds(*bounds, size, size),
+                   BIGTIFF='IF_SAFER')
+    with rio.open(path, 'w', **profile) as dst:
+        for row_off in range(0, size, 256):
+            height = min(256, size - row_off)
+            data = rng.integers(0, 1000, (height, size), dtype=np.int32)
+            dst.write(data, 1, window=Window(0, row_off, size, height))
+    return path
+
+
+def make_netcdf(path, n_times, size, bounds=BOUNDS, seed=0):
+    """Write a (time, lat, lon) NetCDF cube one time step at a time."""
+    import netCDF4
+    rng = np.random.default_rng(seed)
+    west, south, east, north = bounds
+    with netCDF4.Dataset(path, 'w') as dataset:
+        dataset.createDimension('time', None)
+        dataset.createDimension('lat', size)
+        dataset.createDimension('lon', size)
+        times = dataset.createVariable('time', 'f8', ('time',))
+        times.units = 'days since 1980-01-01'
+        times.calendar = 'standard'
+        lat = dataset.createVariable('lat', 'f8', ('lat',))
+        lat.units = 'degrees_north'
+        lon = dataset.createVariable('lon', 'f8', ('lon',))
+        lon.units = 'degrees_east'
+        lat[:] = north - (np.arange(size) + 0.5) * (north - south) / size
+        lon[:] = west + (np.arange(size) + 0.5) * (east - west) / size
+        values = dataset.createVariable('scpdsi', 'f4',
+                                        ('time', 'lat', 'lon'),
+                                        fill_value=np.float32(np.nan))
+        for step in range(n_times):
+            times[step] = step
+            values[step] = rng.normal(size=(size, size)).astype('f4')
+    return path
+
+
+def make_inputs(work_dir, scale):
+    """Generate every synthetic input of a scale into work_dir."""
+    settings = SCALES[scale]
+    return {
+        'shapes': make_shapes(os.path.join(work_dir, 'zones.zip'),
+                              settings['polygons']),
+        'raster': make_raster(os.path.join(work_dir, 'raster.tif'),
+                              settings['raster']),
+        'netcdf': make_netcdf(os.path.join(work_dir, 'cube.nc'),
+                              settings['times'], settings['grid']),
+    }
+# 1}}} -----------------------------------------------------------------------
+
+
+# cases {{{1 -----------------------------------------------------------------
+def case_choppy(inputs, settings, output_dir, engine='rasterstats'):
+    """Time Choppy.chop on the synthetic raster."""
+    from choppyzs.choppy import Choppy
+    chopper = Choppy(inputs['shapes'], inputs['raster'],
+                     output_dir=output_dir, output_format='csv',
+                     engine=engine)
+    chopper.chop()
+    return {'pixels': settings['raster'] ** 2}
+
+
+def case_netcdf(inputs, settings, output_dir, output_format='csv',
+                cube=False):
+    """Time NetCDF2Stats.chop (or chop_cube) and export."""
+    from choppyzs.netcdf import NetCDF2Stats
+    chopper = NetCDF2Stats(inputs['shapes'], inputs['netcdf'],
+                           output_dir=output_dir, output_format=output_format)
+    if cube:
+        chopper.chop_cube()
+    else:
+        chopper.chop()
+    chopper.export()
+    return {'pixels': settings['grid'] ** 2 * settings['times'],
+            'zone_steps': settings['polygons'] * settings['times']}
+
+
+def benchmark_cases():
+    """List the (name, function, keyword arguments) of every case."""
+    cases = [(f'choppy.chop[{engine}]', case_choppy, {'engine': engine})
+             for engine in ['rasterstats', 'stream']]
+    cases += [(f'netcdf.chop+export[{output_format}]', case_netcdf,
+               {'output_format': output_format})
+              for output_format in OUTPUT_FORMATS]
+    cases.append(('netcdf.chop_cube+export[parquet]', case_netcdf,
+                  {'output_format': 'parquet', 'cube': True}))
+    return cases
+# 1}}} -----------------------------------------------------------------------
+
+
+# startup {{{1 ---------------------------------------------------------------
+def startup_time(mode, repeat=3):
+    """Time the fastest cold start of the CLI in a mode.
+
+    Each start is a fresh interpreter loading choppy-lite.py and the
+    engine of the mode; the heavy modules it loads but should not are
+    reported as ``unexpected``.
+    """
+    modules, forbidden = STARTUP_MODES[mode]
+    forbidden = forbidden + IMAGE_MODULES
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT, CLI,
+             json.dumps(forbidden)] + modules,
+            check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        result['wall_seconds'] = time.perf_counter() - start
+        if best is None or result['wall_seconds'] < best['wall_seconds']:
+            best = result
+    best['case'] = f'startup[{mode}]'
+    best['unexpected'] = best.pop('loaded')
+    return best
+
+
+def check_startup(max_seconds=None, repeat=3):
+    """Time the startup of every mode, failing on heavy imports.
+
+    Raises a RuntimeError when a mode loads a module it should not or
+    takes longer than max_seconds to start.
+    """
+    results = [startup_time(mode, repeat) for mode in STARTUP_MODES]
+    for result in results:
+        print(json.dumps(result))
+        if result['unexpected']:
+            raise RuntimeError(f'{result["case"]} imports '
+                               f'{result["unexpected"]}')
+        if max_seconds is not None and result['wall_seconds'] > max_seconds:
+            raise RuntimeError(f'{result["case"]} took '
+                               f'{result["wall_seconds"]:.2f}s to start')
+    return results
+# 1}}} -----------------------------------------------------------------------
+
+
+# runner {{{1 ----------------------------------------------------------------
+def _run_case(func, inputs, settings, kwargs, queue):
+    """Run a case in a child process and report its measurements."""
+    try:
+        with TemporaryDirectory() as output_dir:
+            start = time.perf_counter()
+            counts = func(inputs, settings, output_dir, **kwargs)
+            wall = time.perf_counter() - start
+        peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put({'wall_seconds': wall, 'peak_rss_mb': peak_kb / 1024,
+                   **counts})
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def run_case(name, func, inputs, settings, kwargs):
+    """Run a case in its own process, adding throughput to the result."""
+    queue = mp.get_context('spawn').Queue()
+    process = mp.get_context('spawn').Process(
+        target=_run_case, args=(func, inputs, settings, kwargs, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    result['case'] = name
+    if 'error' not in result:
+        wall = result['wall_seconds']
+        result['pixels_per_second'] = result.pop('pixels') / wall
+        if 'zone_steps' in result:
+            result['zone_steps_per_second'] = result.pop('zone_steps') / wall
+    return result
+
+
+def run(scale, output, work_dir=None, cases=None, repeat=1,
+        max_startup=None):
+    """Check the startup, run the cases of a scale and write JSON."""
+    settings = SCALES[scale]
+    startup = check_startup(max_startup)
+    with TemporaryDirectory(dir=work_dir) as input_dir:
+        start = time.perf_counter()
+        inputs = make_inputs(input_dir, scale)
+        generate = time.perf_counter() - start
+        results = []
+        for name, func, kwargs in benchmark_cases():
+            if cases and not any(case in name for case in cases):
+                continue
+            for attempt in range(repeat):
+                result = run_case(name, func, inputs, settings, kwargs)
+                result['repeat'] = attempt
+                print(json.dumps(result))
+                results.append(result)
+    from choppyzs.choppy import __version__
+    report = {
+        'version': __version__,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': scale,
+        'settings': settings,
+        'generate_seconds': generate,
+        'startup': startup,
+        'results': results,
+    }
+    with open(output, 'w') as handle:
+        json.dump(report, handle, indent=2)
+    return report
+
+
+def parse_args():
+    """Argument parser for the benchmarks."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark choppy on synthetic inputs')
+    parser.add_argument('-s', '--scale', choices=sorted(SCALES),
+                        dest='scale', help='the size of the inputs')
+    parser.add_argument('-o', '--output', dest='output', type=str,
+                        help='the JSON file to write the results to')
+    parser.add_argument('-w', '--work-dir', dest='work_dir', type=str,
+                        help='where to generate the inputs')
+    parser.add_argument('-c', '--case', dest='cases', action='append',
+                        help='only run cases whose name contains this')
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int,
+                        help='how many times to run every case')
+    parser.add_argument('-t', '--max-startup', dest='max_startup',
+                        type=float,
+                        help='fail when a CLI mode takes longer to start')
+    parser.add_argument('--startup-only', dest='startup_only',
+                        action='store_true',
+                        help='only check the startup of the CLI modes')
+    parser.set_defaults(scale='small', output='benchmark.json',
+                        work_dir=None, cases=None, repeat=1,
+                        max_startup=None, startup_only=False)
+    return parser.parse_args()
+# 1}}} -----------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.startup_only:
+        check_startup(args.max_startup)
+    else:
+        run(args.scale, args.output, args.work_dir, args.cases, args.repeat,
+            args.max_startup)
@@ -7,9 +7,12 @@ shapefile and a raster
 # imports {{{1 ---------------------------------------------------------------
 import os
 import sys
+import cProfile
 import argparse
-from choppyzs.choppy import Choppy
-from choppyzs.netcdf import NetCDF2Stats
+from choppyzs.logz import install_tracebacks
+from choppyzs.profiling import profile_path
+# the engines are imported by run() for the chosen mode only, to keep the
+# startup fast
 # 1}}} -----------------------------------------------------------------------
 # legal {{{1 -----------------------------------------------------------------
 __author__ = 'Joshua N. Grant'
@@ -103,12 +106,14 @@ def parse_args():
         help="The archived files to use to extract features and \
         compare against the raster", dest="shape_archive", action="store")
     parser.add_argument(
-        '-r', '--raster', type=str,
-        help="The rasterfile to use for retrieving zonals stats from",
+        '-r', '--raster', type=str, nargs='+',
+        help="The rasterfile to use for retrieving zonals stats from, \
+        several rasters, globs or a manifest file run as one batch",
         dest="raster", action="store")
     parser.add_argument(
-        '-n', '--netcdf', dest='nc_file', action='store',
-        help='The netcdf file to perform zonal stats on.')
+        '-n', '--netcdf', dest='nc_file', action='store', nargs='+',
+        help='The netcdf file to perform zonal stats on, several files or \
+        globs are opened as one dataset.')
     parser.add_argument(
         '-x', '--stats', dest='stats', type=str,
         help="Which  stats should be used to to compute the zonal statistics",
@@ -127,32 +132,187 @@ def parse_args():
         type=str, help='the destination output file')
     parser.add_argument(
         '-a', '--all-touched', dest='all_touched', action='store_true')
+    parser.add_argument(
+        '-e', '--engine', dest='engine', type=str, action='store',
+        help='the raster engine to use, rasterstats, stream, coverage \
+        (stats weighted by the fraction of each pixel inside each zone) or \
+        categorical (also count the pixels of every class in every zone)')
+    parser.add_argument(
+        '--remap', dest='remap', type=str, action='store',
+        help='a two column (value, class) CSV mapping the raster values to \
+        classes with the categorical engine')
+    parser.add_argument(
+        '--layout', dest='layout', type=str, action='store',
+        choices=['wide', 'long'],
+        help='categorical output with a column per class (wide) or a row \
+        per zone and class (long)')
+    parser.add_argument(
+        '--crs', dest='crs_mode', type=str, action='store',
+        choices=['shapes', 'raster', 'none'],
+        help='when the shapes and raster CRS differ, reproject the shapes \
+        (shapes), warp the raster to the shapes (raster) or use both as \
+        they are (none)')
+    parser.add_argument(
+        '-b', '--block-budget', dest='block_budget', type=int,
+        action='store',
+        help='the megabytes of raster to read at once with the stream engine')
+    parser.add_argument(
+        '-w', '--workers', dest='workers', type=int, action='store',
+        help='the number of processes to compute the stats with (1 by \
+        default), or of requests served at once (the CPU count by default)')
+    parser.add_argument(
+        '--prefetch', dest='prefetch', type=int, action='store',
+        help='the blocks or netcdf time chunks read ahead of the stats')
+    parser.add_argument(
+        '--reader-threads', dest='reader_threads', type=int,
+        action='store', help='the threads reading blocks or time chunks')
+    parser.add_argument(
+        '--compute-threads', dest='compute_threads', type=int,
+        action='store',
+        help='the threads computing the stats of what was read')
+    parser.add_argument(
+        '--max-bins', dest='max_bins', type=int, action='store',
+        help='the distinct values per zone kept for exact median/majority '
+        '(at most --sketch-size on float rasters)')
+    parser.add_argument(
+        '--sketch-size', dest='sketch_size', type=int, action='store',
+        help='the quantile sketch size past --max-bins, 0 to fail instead')
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir', type=str, action='store',
+        help='a directory to cache extracted shapes and zone rasters in')
+    parser.add_argument(
+        '--cache-size', dest='cache_size', type=int, action='store',
+        help='the megabytes the cache directory may grow to')
+    parser.add_argument(
+        '-q', '--quick-look', dest='quick_look', type=float, action='store',
+        help='compute approximate raster stats on the coarsest overview \
+        within this relative error, e.g. 0.05')
+    parser.add_argument(
+        '-c', '--cube', dest='cube', action='store_true',
+        help='compute the netcdf stats for all times at once')
+    parser.add_argument(
+        '--time-chunk', dest='time_chunk', type=int, action='store',
+        help='the number of netcdf times to read at once, by default as \
+        many as fit in the block budget')
+    parser.add_argument(
+        '--chunks', dest='chunks', type=int, action='store',
+        help='open the netcdf lazily with dask, this many times a chunk')
+    parser.add_argument(
+        '--incremental', dest='incremental', action='store_true',
+        help='only compute the netcdf times missing from an existing \
+        parquet, feather or netcdf output and append them')
+    parser.add_argument(
+        '--profile', dest='profile', action='store_true',
+        help='log the time and memory of each stage and write them as \
+        JSON next to the output')
+    parser.add_argument(
+        '--cprofile', dest='cprofile', action='store_true',
+        help='also write a cProfile dump next to the output')
+    parser.add_argument(
+        '--serve', dest='serve', action='store_true',
+        help='serve zonal stats over HTTP, keeping shapes, zone rasters \
+        and open rasters warm between requests, --workers at once')
+    parser.add_argument(
+        '--root', dest='roots', type=str, action='append',
+        help='a directory the served requests may read files under, \
+        repeatable, the current directory by default')
+    parser.add_argument(
+        '--host', dest='host', type=str, action='store',
+        help='the address to serve on, 127.0.0.1 by default')
+    parser.add_argument(
+        '--port', dest='port', type=int, action='store',
+        help='the port to serve on, 8765 by default')
+    parser.add_argument(
+        '--socket', dest='socket_path', type=str, action='store',
+        help='serve on this Unix socket instead of a port')
     parser.set_defaults(
         stats='min,max,mean,median,majority,sum,std,count,range',
         output_dir=os.getcwd(), output_format='csv',
         output_file='zonal_stats', all_touched=False, report_geometry=False,
-        nc_file=None, raster=None)
+        nc_file=None, raster=None, cube=False, time_chunk=None, chunks=None,
+        incremental=False, quick_look=None, remap=None, layout='wide',
+        crs_mode='shapes', prefetch=2, reader_threads=1, compute_threads=1,
+        engine='rasterstats', block_budget=64, workers=None,
+        max_bins=2 ** 16, sketch_size=1024, cache_dir=None,
+        cache_size=1024, profile=False, cprofile=False, serve=False,
+        host=None, port=None, socket_path=None, roots=None)
     return parser.parse_args()
 # 1}}} -----------------------------------------------------------------------
 
 
-if __name__ == "__main__":
-    banner()
-    if len(sys.argv) <= 0:
-        sys.exit()
-    args = parse_args()
-    print(type(args.shape_archive))
-    if args.raster is not None:
+# run choppy {{{1 ------------------------------------------------------------
+def run(args):
+    """ Run the chopper the arguments call for and return it """
+    c = None
+    if args.serve:
+        from choppyzs.service import (ZonalStatsService, serve, DEFAULT_HOST,
+                                      DEFAULT_PORT, DEFAULT_WORKERS)
+        service = ZonalStatsService(workers=args.workers or DEFAULT_WORKERS,
+                                    cache_dir=args.cache_dir,
+                                    cache_size=args.cache_size * 2 ** 20,
+                                    roots=args.roots)
+        if args.shape_archive is not None:
+            service.register('default', args.shape_archive)
+        serve(service, args.host or DEFAULT_HOST, args.port or DEFAULT_PORT,
+              args.socket_path)
+        return c
+    workers = args.workers or 1
+    rasters = None
+    if args.raster:
+        from choppyzs.batch import resolve_rasters
+        rasters = resolve_rasters(args.raster)
+    if rasters is not None and len(rasters) > 1:
+        from choppyzs.batch import ChoppyBatch
+        c = ChoppyBatch(shape_archive=args.shape_archive,
+                        rasters=args.raster,
+                        output_dir=args.output_dir,
+                        statistics=args.stats,
+                        output_file=args.output_file,
+                        all_touched=args.all_touched,
+                        output_format=args.output_format,
+                        geometry=args.report_geometry,
+                        engine=args.engine,
+                        block_budget=args.block_budget * 2 ** 20,
+                        workers=workers,
+                        quick_look=args.quick_look,
+                        max_bins=args.max_bins,
+                        sketch_size=args.sketch_size or None,
+                        cache_dir=args.cache_dir,
+                        cache_size=args.cache_size * 2 ** 20,
+                        crs_mode=args.crs_mode,
+                        prefetch=args.prefetch,
+                        reader_threads=args.reader_threads,
+                        compute_threads=args.compute_threads,
+                        profile=args.profile)
+        c.chop()
+    elif rasters is not None:
+        from choppyzs.choppy import Choppy
         c = Choppy(shape_archive=args.shape_archive,
-                   raster_file=args.raster,
+                   raster_file=rasters[0],
                    output_dir=args.output_dir,
                    statistics=args.stats,
                    output_file=args.output_file,
                    all_touched=args.all_touched,
                    output_format=args.output_format,
-                   geometry=args.report_geometry)
+                   geometry=args.report_geometry,
+                   engine=args.engine,
+                   block_budget=args.block_budget * 2 ** 20,
+                   workers=workers,
+                   max_bins=args.max_bins,
+                   sketch_size=args.sketch_size or None,
+                   cache_dir=args.cache_dir,
+                   cache_size=args.cache_size * 2 ** 20,
+                   quick_look=args.quick_look,
+                   remap=args.remap,
+                   layout=args.layout,
+                   crs_mode=args.crs_mode,
+                   prefetch=args.prefetch,
+                   reader_threads=args.reader_threads,
+                   compute_threads=args.compute_threads,
+                   profile=args.profile)
         c.chop()
     elif args.nc_file is not None:
+        from choppyzs.netcdf import NetCDF2Stats
         c = NetCDF2Stats(
             shape_archive=args.shape_archive,
             nc_file=args.nc_file,
@@ -161,6 +321,43 @@ if __name__ == "__main__":
             output_file=args.output_file,
             all_touched=args.all_touched,
             output_format=args.output_format,
-            geometry=args.report_geometry)
-        c.chop()
+            geometry=args.report_geometry,
+            engine='coverage' if args.engine == 'coverage' else 'zones',
+            workers=workers,
+            cache_dir=args.cache_dir,
+            cache_size=args.cache_size * 2 ** 20,
+            chunks=None if args.chunks is None else {'time': args.chunks},
+            block_budget=args.block_budget * 2 ** 20,
+            incremental=args.incremental,
+            crs_mode=args.crs_mode,
+            prefetch=args.prefetch,
+            reader_threads=args.reader_threads,
+            compute_threads=args.compute_threads)
+        if args.cube:
+            c.chop_cube(time_chunk=args.time_chunk)
+        else:
+            c.chop(time_chunk=args.time_chunk)
         c.export()
+    return c
+# 1}}} -----------------------------------------------------------------------
+
+
+if __name__ == "__main__":
+    install_tracebacks()
+    banner()
+    if len(sys.argv) <= 0:
+        sys.exit()
+    args = parse_args()
+    print(type(args.shape_archive))
+    profiler = cProfile.Profile() if args.cprofile else None
+    if profiler is not None:
+        profiler.enable()
+    c = run(args)
+    if c is None:
+        sys.exit()
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_path(c.output_path, 'prof'))
+    if args.profile:
+        c.profiler.log()
+        c.profiler.write(profile_path(c.output_path, 'json'))
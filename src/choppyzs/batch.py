@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compute zonal statistics of many rasters against one shape archive."""
+import os
+import glob
+import numpy as np
+import pandas as pd
+import rasterio as rio
+try:
+    from choppyzs.choppy import Choppy
+    from choppyzs.logz import create_logger
+    from choppyzs.planner import plan_windows
+    from choppyzs.reproject import WarpedZoneIndex
+    from choppyzs.stats import states_to_records
+    from choppyzs.streaming import stream_windows
+    from choppyzs.writers import STREAM_FORMATS, create_writer, zone_attributes
+except ImportError:
+    from .choppy import Choppy
+    from .logz import create_logger
+    from .planner import plan_windows
+    from .reproject import WarpedZoneIndex
+    from .stats import states_to_records
+    from .streaming import stream_windows
+    from .writers import STREAM_FORMATS, create_writer, zone_attributes
+
+logger = create_logger()
+
+MANIFEST_EXTENSIONS = ('.txt', '.lst', '.csv')
+
+
+def read_manifest(manifest):
+    """Read raster paths, one per line, relative to the manifest."""
+    base = os.path.dirname(os.path.abspath(manifest))
+    rasters = []
+    with open(manifest) as handle:
+        for line in handle:
+            line = line.split(',')[0].strip()
+            if not line or line.startswith('#'):
+                continue
+            rasters.append(line if os.path.isabs(line)
+                           else os.path.join(base, line))
+    return rasters
+
+
+def resolve_rasters(patterns):
+    """Expand raster paths, globs and manifest files into raster paths."""
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    rasters = []
+    for pattern in patterns:
+        if pattern.lower().endswith(MANIFEST_EXTENSIONS) and \
+                os.path.isfile(pattern):
+            rasters.extend(read_manifest(pattern))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise FileNotFoundError(f'No rasters match {pattern}!')
+            rasters.extend(matches)
+        else:
+            rasters.append(pattern)
+    for raster in rasters:
+        if not os.path.isfile(raster):
+            raise FileNotFoundError(f'{raster} not found!')
+    return rasters
+
+
+def raster_ids(rasters):
+    """Name rasters by their file stem, or their path if stems collide."""
+    stems = [os.path.splitext(os.path.basename(r))[0] for r in rasters]
+    if len(set(stems)) == len(stems):
+        return stems
+    return [os.path.splitext(r)[0] for r in rasters]
+
+
+def raster_grid(raster_file):
+    """Get the (crs, affine, shape) grid of a raster."""
+    with rio.open(raster_file) as src:
+        return (src.crs, src.transform, src.shape)
+
+
+class ChoppyBatch(Choppy):
+    """Compute zonal statistics of many rasters in a single invocation.
+
+    The shape archive is extracted and read once and the zones are
+    rasterized once per distinct grid (CRS, affine and shape) among the
+    rasters. The result is one long table with a raster_id column.
+
+    Parameters:
+        rasters     raster paths, globs or manifest files (one path a line)
+        The other parameters are those of Choppy, but for ``workers`` and
+        ``quick_look``: the rasters are pipelined over threads instead.
+    """
+
+    def __init__(self, shape_archive, rasters, **kwargs):
+        """Initialize a ChoppyBatch, resolving the rasters."""
+        if kwargs.get('engine') == 'categorical':
+            raise RuntimeError('The categorical engine takes one raster!')
+        if kwargs.get('quick_look') is not None:
+            raise RuntimeError('The quick look takes one raster!')
+        if (kwargs.get('workers') or 1) > 1:
+            raise RuntimeError('A batch of rasters runs in one process, use '
+                               'the reader and compute threads instead of '
+                               'workers!')
+        self.rasters = resolve_rasters(rasters)
+        if not self.rasters:
+            raise RuntimeError('No rasters were given!')
+        super().__init__(shape_archive, self.rasters[0], **kwargs)
+        self.raster_file = ','.join(self.rasters)
+
+    def read_zone_window(self, raster, zone_index):
+        """Read the zone window of a raster when it is read whole.
+
+        It is when it fits in the block budget, with coverage weights or
+        when the raster is warped to the shapes. Returns the (data, nodata)
+        read, or None when the raster is streamed block by block instead.
+        """
+        with rio.open(raster) as src:
+            window = zone_index.window
+            itemsize = np.dtype(src.dtypes[0]).itemsize
+            if self.engine != 'coverage' and \
+                    not isinstance(zone_index, WarpedZoneIndex) and \
+                    window.width * window.height * itemsize > \
+                    self.block_budget:
+                return None
+            with self.profiler.stage('read'):
+                data = src.read(1, window=window)
+                self.profiler.count_array(data)
+            return data, src.nodata
+
+    def raster_stats(self, raster, zone_index, shapes=None, loaded=None):
+        """Compute the stats of one raster with the zone index of its grid.
+
+        The zone window (``loaded`` when read_zone_window already read it)
+        is reduced with the zone index, otherwise the planned windows of
+        the shapes (by default those reprojected to the raster) are
+        streamed.
+        """
+        if loaded is None:
+            loaded = self.read_zone_window(raster, zone_index)
+        if loaded is not None:
+            statistics = self.statistics
+            if self.engine == 'coverage':
+                statistics = self.weighted_stats()
+            with self.profiler.stage('stats'):
+                return zone_index.stats(loaded[0], statistics,
+                                        nodata=loaded[1])
+        with rio.open(raster) as src:
+            if shapes is None:
+                shapes = self.zone_shapes(src.crs)
+            windows = plan_windows(src, list(shapes.geometry),
+                                   self.block_budget)
+        logger.info(f'Streaming {raster}, its zone window is over budget')
+        with self.profiler.stage('stats'):
+            states = stream_windows(raster, list(shapes.geometry),
+                                    windows, self.statistics,
+                                    self.all_touched, max_bins=self.max_bins,
+                                    sketch_size=self.sketch_size,
+                                    profiler=self.profiler,
+                                    pipeline=self.pipeline)
+            return states_to_records(states, self.statistics)
+
+    def chop(self):
+        """Compute the stats of every raster into one long table.
+
+        Through the pipeline the next rasters are read while the stats of
+        the current ones are computed and written.
+        """
+        writer = None
+        frames = []
+        if self.output_format in STREAM_FORMATS:
+            writer = create_writer(self.output_format, self.output_path,
+                                   zone_attributes(self.shapes,
+                                                   self.geometry),
+                                   step_name='raster_id')
+        df = pd.DataFrame(self.shapes)
+        if self.geometry is False:
+            df = df.drop(columns='geometry')
+
+        def grids():
+            # the zone indexes and shapes are shared, so they are built
+            # here in the calling thread
+            for raster_id, raster in zip(raster_ids(self.rasters),
+                                         self.rasters):
+                crs, transform, shape = raster_grid(raster)
+                yield (raster_id, raster,
+                       self.get_zone_index(crs, transform, shape),
+                       self.zone_shapes(crs))
+
+        def read(item):
+            logger.info(f'Parsing {item[1]}')
+            return item, self.read_zone_window(item[1], item[2])
+
+        def compute(loaded):
+            (raster_id, raster, zone_index, shapes), data = loaded
+            return raster_id, pd.DataFrame.from_dict(
+                self.raster_stats(raster, zone_index, shapes, data))
+
+        def write(result):
+            raster_id, sd = result
+            if writer is not None:
+                with self.profiler.stage('write'):
+                    writer.write(sd, raster_id)
+                return
+            with self.profiler.stage('concat'):
+                dat = pd.concat([df, sd], axis=1)
+                dat.insert(0, 'raster_id', raster_id)
+            frames.append(dat)
+
+        self.pipeline.run(grids(), read, compute, write)
+        if len(self.zone_indexes) > 1:
+            logger.info(f'{len(self.rasters)} rasters were on '
+                        f'{len(self.zone_indexes)} grids')
+        if writer is not None:
+            with self.profiler.stage('write'):
+                writer.close()
+            logger.info(f'Wrote {self.output_path}')
+            self.data = None
+            return None
+        with self.profiler.stage('concat'):
+            dat = pd.concat(frames, ignore_index=True)
+        with self.profiler.stage('write'):
+            if self.output_format == 'csv':
+                dat.to_csv(self.output_path, index=False)
+            elif self.output_format == 'tsv':
+                dat.to_csv(self.output_path, sep='\t', index=False)
+            elif self.output_format == 'xlsx':
+                dat.to_excel(self.output_path)
+            elif self.output_format == 'none':
+                print(dat)
+        self.data = dat
+        return dat
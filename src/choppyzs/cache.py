@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Persistent on-disk cache of extracted shapes and zone rasterizations.
+
+Entries are keyed by a content hash of the shape archive and, for the
+rasterized structures, by the grid (CRS, affine and shape) and the
+all_touched setting. The cache is bounded in bytes and evicts the least
+recently used entries first.
+"""
+import os
+import glob
+import pickle
+import hashlib
+from tempfile import NamedTemporaryFile
+
+# bump when the layout of cached objects changes
+CACHE_VERSION = 2
+DEFAULT_CACHE_SIZE = 2 ** 30
+
+
+def file_hash(file_name, chunk_size=2 ** 20):
+    """Compute the sha256 of a file's contents."""
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ZoneCache():
+    """Store picklable zone structures in a size-bounded LRU directory."""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_SIZE):
+        """Initialize the cache, creating the directory if needed."""
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        """Hash the parts of a key into a file name safe string."""
+        text = repr((CACHE_VERSION,) + parts)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def archive_key(self, shape_archive):
+        """Get the key of a shape archive from its contents."""
+        return self.key('archive', file_hash(shape_archive))
+
+    def grid_key(self, archive_key, crs, transform, shape, all_touched):
+        """Get the key of an archive rasterized on a grid."""
+        return self.key('grid', archive_key, str(crs), tuple(transform)[:6],
+                        tuple(shape), bool(all_touched))
+
+    def path(self, key, kind):
+        """Get the file of a cache entry."""
+        return os.path.join(self.cache_dir, f'{key}.{kind}.pkl')
+
+    def get(self, key, kind):
+        """Load an entry, marking it as recently used, or return None."""
+        path = self.path(key, kind)
+        try:
+            with open(path, 'rb') as handle:
+                value = pickle.load(handle)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError):
+            os.remove(path)
+            return None
+        os.utime(path)
+        return value
+
+    def put(self, key, kind, value):
+        """Store an entry atomically and evict entries over the budget."""
+        with NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp',
+                                delete=False) as handle:
+            pickle.dump(value, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(handle.name, self.path(key, kind))
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until under budget."""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
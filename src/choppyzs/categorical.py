@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Cross-tabulate the classes of a categorical raster by zone.
+
+The zone by class counts come from one bincount over the pixels of a
+ZoneIndex, the same index the other stats use, so the zones are only
+rasterized once. With many classes (and zones) the counts are kept in a
+scipy sparse matrix instead. Raster values can be remapped to classes
+first, e.g. land-cover codes to their names.
+"""
+import numpy as np
+import pandas as pd
+
+LAYOUTS = ['wide', 'long']
+CLASS_PREFIX = 'class_'
+# zone x class cells past which the counts are kept sparse
+SPARSE_CELLS = 2 ** 24
+
+
+def load_remap(remap):
+    """Load a remap table, a dict or a two column (value, class) CSV."""
+    if remap is None or isinstance(remap, dict):
+        return remap
+    table = pd.read_csv(remap)
+    return dict(zip(table.iloc[:, 0], table.iloc[:, 1]))
+
+
+def remap_values(values, remap):
+    """Map raster values to classes, values missing from the map are kept.
+
+    Each distinct value is looked up once.
+    """
+    if not remap:
+        return values
+    unique, inverse = np.unique(values, return_inverse=True)
+    mapped = [remap.get(value.item(), value.item()) for value in unique]
+    if all(isinstance(value, (int, float, np.number)) for value in mapped):
+        mapped = np.array(mapped)
+    else:
+        mapped = np.array([str(value) for value in mapped], dtype=object)
+    return mapped[inverse.ravel()]
+
+
+def class_counts(zone_index, arr, nodata=None, remap=None, sparse=None):
+    """Count the pixels of every class in every zone of a 2D array.
+
+    Returns the (zone, class) counts, a numpy array or, when ``sparse``
+    (by default when there are more than SPARSE_CELLS cells), a scipy CSR
+    matrix, and the sorted classes of the columns.
+    """
+    values = zone_index.subset(arr).ravel()[zone_index.pixels]
+    valid = np.ones(values.shape, dtype=bool)
+    if nodata is not None:
+        valid &= values != nodata
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    values = remap_values(values[valid], load_remap(remap))
+    zones = zone_index.zones[valid]
+    classes, column = np.unique(values, return_inverse=True)
+    column = column.ravel()
+    shape = (zone_index.n_zones, len(classes))
+    if sparse is None:
+        sparse = shape[0] * shape[1] > SPARSE_CELLS
+    if sparse:
+        from scipy.sparse import coo_matrix
+        counts = coo_matrix((np.ones(len(zones), dtype=np.int64),
+                             (zones, column)), shape=shape).tocsr()
+    else:
+        counts = np.bincount(zones * len(classes) + column,
+                             minlength=shape[0] * shape[1])
+        counts = counts.reshape(shape)
+    return counts, classes
+
+
+def wide_records(counts, classes, prefix=CLASS_PREFIX):
+    """Get one dict of class counts per zone, a column per class."""
+    if hasattr(counts, 'toarray'):
+        counts = counts.toarray()
+    columns = [f'{prefix}{value}' for value in classes]
+    return [dict(zip(columns, row)) for row in counts.tolist()]
+
+
+def long_frame(counts, classes, pixel_area=None):
+    """Get the non-zero counts as (zone_id, class, pixels, fraction) rows.
+
+    Zones without class pixels get one row with a null class and 0
+    pixels, as in the wide layout. The ``area`` of each class is added
+    when the pixel area is given.
+    """
+    if hasattr(counts, 'tocoo'):
+        coo = counts.tocoo()
+        zones, columns, values = coo.row, coo.col, coo.data
+        totals = np.asarray(counts.sum(axis=1)).ravel()
+    else:
+        zones, columns = np.nonzero(counts)
+        values = counts[zones, columns]
+        totals = counts.sum(axis=1)
+    order = np.lexsort((columns, zones))
+    zones, columns, values = zones[order], columns[order], values[order]
+    class_column = pd.Series(classes[columns])
+    if np.issubdtype(classes.dtype, np.integer):
+        class_column = class_column.astype('Int64')
+    empty = np.flatnonzero(totals == 0)
+    frame = pd.concat([
+        pd.DataFrame({'zone_id': zones.astype(np.int64),
+                      'class': class_column,
+                      'pixels': values.astype(np.int64),
+                      'fraction': values / totals[zones]}),
+        pd.DataFrame({'zone_id': empty.astype(np.int64),
+                      'class': pd.Series([None] * len(empty),
+                                         dtype=class_column.dtype),
+                      'pixels': np.zeros(len(empty), dtype=np.int64),
+                      'fraction': np.zeros(len(empty))})],
+        ignore_index=True)
+    frame = frame.sort_values('zone_id', kind='stable', ignore_index=True)
+    if pixel_area is not None:
+        frame['area'] = frame['pixels'] * pixel_area
+    return frame
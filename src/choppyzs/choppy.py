@@ -17,13 +17,41 @@ __version__ = "1.0.4"
 # imports {{{1 ----------------------------------------------------------------
 import os
 import sys
-import csv
-from pathlib import Path
+import numpy as np
 import pandas as pd
 import patoolib as pa
+import rasterio as rio
 import geopandas as gpd
 from tempfile import TemporaryDirectory
-from rasterstats import zonal_stats
+# the engines are imported by the code paths using them, so a run only
+# loads the engine it chose
+try:
+    from choppyzs.cache import ZoneCache, DEFAULT_CACHE_SIZE
+    from choppyzs.logz import create_logger
+    from choppyzs.pipeline import (Pipeline, DEFAULT_BLOCK_BUDGET,
+                                   DEFAULT_PREFETCH, DEFAULT_READER_THREADS,
+                                   DEFAULT_COMPUTE_THREADS)
+    from choppyzs.profiling import Profiler
+    from choppyzs.reproject import (build_zone_index, check_crs_mode,
+                                    check_overlap, index_kind, needs_warp,
+                                    shapes_to_crs, warn_unknown_crs)
+    from choppyzs.stats import DEFAULT_MAX_BINS, DEFAULT_SKETCH_SIZE
+    from choppyzs.writers import STREAM_FORMATS, output_extension
+    from choppyzs.zones import geometry_extents, split_stats
+except ImportError:
+    from .cache import ZoneCache, DEFAULT_CACHE_SIZE
+    from .logz import create_logger
+    from .pipeline import (Pipeline, DEFAULT_BLOCK_BUDGET, DEFAULT_PREFETCH,
+                           DEFAULT_READER_THREADS, DEFAULT_COMPUTE_THREADS)
+    from .profiling import Profiler
+    from .reproject import (build_zone_index, check_crs_mode, check_overlap,
+                            index_kind, needs_warp, shapes_to_crs,
+                            warn_unknown_crs)
+    from .stats import DEFAULT_MAX_BINS, DEFAULT_SKETCH_SIZE
+    from .writers import STREAM_FORMATS, output_extension
+    from .zones import geometry_extents, split_stats
+
+logger = create_logger()
 
 
 # 1}}} ------------------------------------------------------------------------
@@ -35,35 +63,127 @@ class Choppy:
   also passed.
 
   Parameters:
-      shape_archive    a shapefile archive
+      shape_archive    a shapefile archive, or a GeoDataFrame of shapes
+                       already read (its ``archive_key`` attribute keys
+                       the zone index cache)
       raster_file      a rasterfile
       output_dir       the output directory
       output_file      the desired output filename
       statistics       a comma separated list of statistics to perform
       all_touched      bool, should all shapes touched be included
-      output_format    the output format, must be one of xlsx, csv, tsv, or
-                       none if using the module inside other scripts or modules
+      output_format    the output format, must be one of xlsx, csv, tsv,
+                       parquet, feather, netcdf, or none if using the module
+                       inside other scripts or modules
+                       (parquet and feather are a directory of part files)
       geometry         also export the geometry information, may cause problems
                        with csv or tsv outputs
+      engine           rasterstats to read a window per feature, stream to
+                       walk the raster once in block order, or coverage to
+                       weight the stats by the exact fraction of each pixel
+                       inside each zone (min, max, mean, sum, std, count
+                       and range only), or categorical to also count the
+                       pixels of every class in every zone
+      block_budget     the bytes of raster to read at once with stream
+      workers          the number of processes to split the features (or
+                       with stream, the raster blocks) across
+      max_bins         the distinct values kept per zone for exact median
+                       and majority with stream
+      sketch_size      the quantile sketch size used past max_bins, the
+                       stats are then flagged approximate; None to raise
+      cache_dir        a directory to cache the extracted shapes in, repeat
+                       runs on the same archive then skip the extraction
+      cache_size       the bytes the cache directory may grow to
+      quick_look       a relative error tolerance (e.g. 0.05) to compute
+                       approximate stats on the coarsest overview level
+                       within it, see choppyzs.overviews; the rows are
+                       flagged approximate and the level used is kept in
+                       ``quick_look_level``, the engine runs as usual
+                       when the tolerance needs full resolution
+      remap            with categorical, a dict or two column CSV mapping
+                       raster values to classes
+      layout           with categorical, wide for a class_<class> count
+                       column per class, or long for a (class, pixels,
+                       fraction, area) row per zone and class
+      crs_mode         when the shapes and the raster CRS differ, shapes to
+                       reproject the shapes to the raster CRS, raster to
+                       warp the raster to the shapes CRS (with the zone
+                       index, see choppyzs.reproject) or none to use them
+                       as they are
+      prefetch         the blocks read ahead of the stats with stream
+      reader_threads   the threads reading blocks with stream
+      compute_threads  the threads rasterizing the zones of the blocks read
+                       with stream, see choppyzs.pipeline
+      profile          also count the pixels rasterstats reads, which
+                       costs another pass over the feature windows
+
+  The time, bytes read and pixels of each stage of a run are kept in
+  ``profiler`` (see choppyzs.profiling).
   """
 
     def __init__(self, shape_archive, raster_file, output_dir=os.getcwd(),
                  statistics='min,max,mean,median,majority,sum,std,count,range',
                  output_file='zonal_stats', all_touched=False,
-                 output_format='xlsx', geometry=False, melt=False):
+                 output_format='xlsx', geometry=False, melt=False,
+                 engine='rasterstats', block_budget=DEFAULT_BLOCK_BUDGET,
+                 workers=1, max_bins=DEFAULT_MAX_BINS,
+                 sketch_size=DEFAULT_SKETCH_SIZE, cache_dir=None,
+                 cache_size=DEFAULT_CACHE_SIZE, quick_look=None,
+                 remap=None, layout='wide', crs_mode='shapes',
+                 prefetch=DEFAULT_PREFETCH,
+                 reader_threads=DEFAULT_READER_THREADS,
+                 compute_threads=DEFAULT_COMPUTE_THREADS, profile=False):
         """ Initialize a Choppy class for preparation for zonal statistics """
         # create a temporary workspace
-        if output_format not in ['xlsx', 'csv', 'tsv', 'none']:
+        if output_format not in ['xlsx', 'csv', 'tsv', 'none'] + \
+                STREAM_FORMATS:
             raise RuntimeError(f'This format ({output_format}) is not '
                                f'acceptable!')
+        if engine not in ['rasterstats', 'stream', 'coverage',
+                          'categorical']:
+            raise RuntimeError(f'This engine ({engine}) is not acceptable!')
+        if engine == 'categorical':
+            try:
+                from choppyzs.categorical import LAYOUTS
+            except ImportError:
+                from .categorical import LAYOUTS
+            if layout not in LAYOUTS:
+                raise RuntimeError(f'This layout ({layout}) is not '
+                                   f'acceptable!')
+        if quick_look is not None and engine in ['coverage', 'categorical']:
+            raise RuntimeError(f'The quick look can not be combined with '
+                               f'the {engine} engine!')
+        if workers > 1 and engine in ['coverage', 'categorical']:
+            logger.warning(f'The {engine} engine runs in one process, '
+                           f'ignoring {workers} workers')
+        elif workers > 1 and quick_look is not None:
+            logger.warning(f'The quick look runs in one process, {workers} '
+                           f'workers are only used at full resolution')
+        check_crs_mode(crs_mode)
+        self.pipeline = Pipeline(prefetch, reader_threads, compute_threads)
+        self.profiler = Profiler()
+        self.profile = profile
+        self.engine = engine
+        self.block_budget = block_budget
+        self.workers = workers
+        self.max_bins = max_bins
+        self.sketch_size = sketch_size
+        self.quick_look = quick_look
+        self.quick_look_level = None
+        self.remap = remap
+        self.layout = layout
+        self.class_table = None
+        self.crs_mode = crs_mode
+        self.reprojected = {}
+        self.cache_dir = cache_dir
         self.working_directory = TemporaryDirectory()
         if ',' in statistics:
             self.statistics = statistics.split(',')
         if ',' not in statistics:
             self.statistics = statistics
         self.output_format = output_format
-        if not output_file.lower().endswith(output_format):
-            self.output_file = output_file + '.' + output_format
+        extension = output_extension(output_format)
+        if not output_file.lower().endswith(extension):
+            self.output_file = output_file + '.' + extension
         else:
             self.output_file = output_file
         self.all_touched = all_touched
@@ -71,64 +191,312 @@ class Choppy:
         self.shape_archive = shape_archive
         self.melt = melt
         self.geometry = geometry
-        pa.extract_archive(shape_archive, outdir=self.working_directory.name)
+        self.shape_file = None
+        self.shapes = None
+        self.zone_indexes = {}
+        self.cache = None
+        self.archive_key = None
+        if isinstance(shape_archive, gpd.GeoDataFrame):
+            self.shapes = shape_archive
+            self.archive_key = shape_archive.attrs.get('archive_key')
+        if cache_dir is not None and (self.shapes is None or
+                                      self.archive_key is not None):
+            self.cache = ZoneCache(cache_dir, cache_size)
+        if self.cache is not None and self.shapes is None:
+            with self.profiler.stage('cache'):
+                self.archive_key = self.cache.archive_key(shape_archive)
+                self.shapes = self.cache.get(self.archive_key, 'shapes')
+        if self.shapes is None:
+            self.extract_shapes()
+            if self.cache is not None:
+                with self.profiler.stage('cache'):
+                    self.cache.put(self.archive_key, 'shapes', self.shapes)
+        self.output_path = os.path.join(output_dir, self.output_file)
+        if output_format == 'json':
+            self.geojson = True
+        else:
+            self.geojson = False
+        self.all_touched = all_touched
+
+    def extract_shapes(self):
+        """ Extract the shape archive and read the shapefile """
+        with self.profiler.stage('extract'):
+            pa.extract_archive(self.shape_archive,
+                               outdir=self.working_directory.name)
         print(os.listdir(self.working_directory.name))
-        shape_dir_name = os.path.basename(
-            os.path.splitext(self.shape_archive)[0])
-        shape_dir_path = os.path.join(self.working_directory.name,
-                                      shape_dir_name)
         for f in os.listdir(self.working_directory.name):
             if f.endswith('.shp'):
                 self.shape_file = os.path.join(self.working_directory.name,
                                                f)
             else:
                 pass
-        if os.path.isfile(self.shape_file):
+        if self.shape_file is not None and os.path.isfile(self.shape_file):
             self.shape_file_present = True
         else:
             self.shape_file_present = False
             print('Shapefile was not found')
             sys.exit()
-        self.output_path = os.path.join(output_dir, self.output_file)
-        if output_format == 'json':
-            self.geojson = True
-        else:
-            self.geojson = False
-        self.all_touched = all_touched
-        self.shapes = gpd.read_file(self.shape_file)
+        with self.profiler.stage('read_shapes'):
+            self.shapes = gpd.read_file(self.shape_file)
+
+    def count_windows(self):
+        """ Count the raster pixels under the feature windows """
+        with rio.open(self.raster_file) as src:
+            shapes = self.zone_shapes(src.crs)
+            extents = geometry_extents(list(shapes.geometry),
+                                       src.transform, src.shape)
+            pixels = sum((r1 - r0) * (c1 - c0)
+                         for r0, r1, c0, c1 in filter(None, extents))
+            itemsize = np.dtype(src.dtypes[0]).itemsize
+        self.profiler.count(pixels * itemsize, pixels)
 
     def __str__(self):
         """ Display information about a Choppy object """
         return 'Choppy class object:\n\t' + \
-               'input shape archive:\t' + self.shape_archive + '\n\t' + \
-               'input shape file:\t' + self.shape_file + '\n\t' + \
+               'input shape archive:\t' + str(self.shape_archive) + \
+               '\n\t' + \
+               'input shape file:\t' + str(self.shape_file) + '\n\t' + \
                'input raster file:\t' + self.raster_file + '\n\t' + \
                'output directory:\t' + self.output_path + '\n\t' + \
                'statistics:\t\t' + ','.join(self.statistics) + '\n\t' + \
                'all touched:\t\t' + str(self.all_touched) + '\n\t'
 
-    def chop(self):
-        stats_data = zonal_stats(self.shape_file,
-                                 self.raster_file, geojson_out=self.geojson,
-                                 all_touched=self.all_touched,
-                                 stats=self.statistics)
+    def stats_frame(self, stats_data):
+        """ Join the stats records to the shape attributes """
         sd = pd.DataFrame.from_dict(stats_data)
         df = pd.DataFrame(self.shapes)
         if self.geometry is False:
             dat = pd.concat([df, sd], axis=1).drop(columns='geometry')
         elif self.geometry is not False:
             dat = pd.concat([df, sd], axis=1)
+        if self.class_table is not None:
+            dat = pd.concat([
+                dat.iloc[self.class_table['zone_id']].reset_index(
+                    drop=True),
+                self.class_table.drop(columns='zone_id')], axis=1)
         if self.melt is True:
-            df = pd.melt(df, value_vars=self.statistics, var_name='Attribute')
-        if self.output_format == 'csv':
-            dat.to_csv(self.output_path, index=False)
-        elif self.output_format == 'tsv':
-            dat.to_csv(self.output_path, sep='\t', index=False)
-        elif self.output_format == 'xlsx':
-            dat.to_excel(self.output_path)
-        elif self.output_format == 'none':
-            print(dat)
+            df = pd.melt(df, value_vars=self.statistics,
+                         var_name='Attribute')
+        return dat
+
+    def chop(self):
+        with self.profiler.stage('stats'):
+            stats_data = self.zonal_stats()
+        with self.profiler.stage('concat'):
+            dat = self.stats_frame(stats_data)
+        with self.profiler.stage('write'):
+            if self.output_format == 'csv':
+                dat.to_csv(self.output_path, index=False)
+            elif self.output_format == 'tsv':
+                dat.to_csv(self.output_path, sep='\t', index=False)
+            elif self.output_format == 'xlsx':
+                dat.to_excel(self.output_path)
+            elif self.output_format in STREAM_FORMATS:
+                try:
+                    from choppyzs.writers import write_frame
+                except ImportError:
+                    from .writers import write_frame
+                write_frame(dat, self.output_format, self.output_path)
+            elif self.output_format == 'none':
+                print(dat)
         self.data = dat
         return dat
+
+    def zone_shapes(self, crs):
+        """ Get the shapes reprojected to a raster CRS if the mode says so """
+        if str(crs) not in self.reprojected:
+            warn_unknown_crs(self.shapes, crs)
+            self.reprojected[str(crs)] = shapes_to_crs(self.shapes, crs,
+                                                       self.crs_mode)
+        return self.reprojected[str(crs)]
+
+    def get_zone_index(self, crs, transform, shape, base_kind=None):
+        """ Build (or load from the cache) the zone index of a grid
+
+        The index kind follows the engine unless ``base_kind`` is given.
+        """
+        if base_kind is None:
+            base_kind = 'coverage' if self.engine == 'coverage' else 'zones'
+        key = (str(crs), tuple(transform)[:6], tuple(shape), base_kind)
+        if key in self.zone_indexes:
+            return self.zone_indexes[key]
+        shapes = self.zone_shapes(crs)
+        kind = index_kind(shapes, crs, base_kind, self.crs_mode)
+        zone_index = None
+        if self.cache is not None:
+            cache_key = self.cache.grid_key(self.archive_key, crs, transform,
+                                            shape, self.all_touched)
+            with self.profiler.stage('cache'):
+                zone_index = self.cache.get(cache_key, kind)
+        if zone_index is None:
+            logger.info(f'Rasterizing {len(self.shapes)} zones')
+            with self.profiler.stage('rasterize'):
+                zone_index = build_zone_index(shapes, crs, transform, shape,
+                                              base_kind, self.all_touched,
+                                              self.crs_mode)
+            if self.cache is not None:
+                with self.profiler.stage('cache'):
+                    self.cache.put(cache_key, kind, zone_index)
+        self.zone_indexes[key] = zone_index
+        return zone_index
+
+    def weighted_stats(self, statistics=None):
+        """ Get the statistics available with coverage weights """
+        try:
+            from choppyzs.coverage import WEIGHTED_STATS
+        except ImportError:
+            from .coverage import WEIGHTED_STATS
+        if statistics is None:
+            statistics = self.statistics
+        statistics, skipped = split_stats(statistics, WEIGHTED_STATS)
+        if skipped:
+            logger.warning(f'Skipping {",".join(skipped)}, not available '
+                           f'with coverage weights')
+        return statistics
+
+    def index_stats(self, statistics, src=None, band=1):
+        """ Compute stats with the zone index on the zone window
+
+        The band is read from ``src`` when given (an open raster, or any
+        object with its crs, transform, shape, nodata and read), otherwise
+        from the raster file.
+        """
+        if src is None:
+            with rio.open(self.raster_file) as src:
+                return self.index_stats(statistics, src, band)
+        zone_index = self.get_zone_index(src.crs, src.transform, src.shape)
+        with self.profiler.stage('read'):
+            data = src.read(band, window=zone_index.window)
+            self.profiler.count_array(data)
+        return zone_index.stats(data, statistics, nodata=src.nodata)
+
+    def coverage_stats(self):
+        """ Compute the coverage weighted stats on the zone window """
+        return self.index_stats(self.weighted_stats())
+
+    def quick_look_stats(self, crs):
+        """ Compute approximate stats on a coarse level of the raster
+
+        Returns None when the tolerance needs the full resolution.
+        """
+        try:
+            from choppyzs.overviews import (AREA_STATS, read_overview,
+                                            scale_stats)
+        except ImportError:
+            from .overviews import AREA_STATS, read_overview, scale_stats
+        with self.profiler.stage('read'):
+            level = read_overview(self.raster_file, self.zone_shapes(crs),
+                                  self.quick_look, cache_dir=self.cache_dir)
+            if level is None:
+                logger.info(f'A {self.quick_look} tolerance needs the full '
+                            f'resolution, using the {self.engine} engine')
+                self.quick_look_level = {'factor': 1, 'source': 'full'}
+                return None
+            self.profiler.count_array(level['data'])
+        logger.info(f'Quick look at 1/{level["factor"]} ({level["source"]}),'
+                    f' resolution {level["resolution"]}')
+        self.quick_look_level = {key: value for key, value in level.items()
+                                 if key != 'data'}
+        grid = (level['crs'], level['transform'], level['data'].shape)
+        zone_index = self.get_zone_index(*grid)
+        stats = zone_index.stats(level['data'], self.statistics,
+                                 nodata=level['nodata'])
+        # coarse pixels cut by the zone edges are weighted by their cover
+        weighted = [stat for stat in self.statistics if stat in AREA_STATS]
+        if weighted and self.engine != 'coverage':
+            coverage_index = self.get_zone_index(*grid, base_kind='coverage')
+            for record, area_stats in zip(stats, coverage_index.stats(
+                    level['data'], weighted, nodata=level['nodata'])):
+                record.update(area_stats)
+        stats = scale_stats(stats, level['pixel_ratio'])
+        flagged = ','.join(self.statistics)
+        for record in stats:
+            record['approximate'] = flagged
+        return stats
+
+    def categorical_stats(self):
+        """ Compute the stats and the class counts of every zone """
+        try:
+            from choppyzs.categorical import (class_counts, long_frame,
+                                              wide_records)
+        except ImportError:
+            from .categorical import class_counts, long_frame, wide_records
+        with rio.open(self.raster_file) as src:
+            zone_index = self.get_zone_index(src.crs, src.transform,
+                                             src.shape)
+            with self.profiler.stage('read'):
+                data = src.read(1, window=zone_index.window)
+                self.profiler.count_array(data)
+            nodata = src.nodata
+            pixel_area = abs(src.transform.a * src.transform.e)
+        records = zone_index.stats(data, self.statistics, nodata=nodata)
+        counts, classes = class_counts(zone_index, data, nodata, self.remap)
+        if self.layout == 'long':
+            self.class_table = long_frame(counts, classes, pixel_area)
+            return records
+        return [{**record, **zone_classes} for record, zone_classes
+                in zip(records, wide_records(counts, classes))]
+
+    def zonal_stats(self):
+        """ Compute the zonal stats records with the selected engine
+
+        When the raster is warped to the shapes CRS the stats come from
+        the zone index whatever the engine.
+        """
+        with rio.open(self.raster_file) as src:
+            crs, bounds = src.crs, src.bounds
+        shapes = self.zone_shapes(crs)
+        check_overlap(shapes, crs, bounds, self.crs_mode)
+        if self.engine == 'categorical':
+            return self.categorical_stats()
+        if self.quick_look is not None:
+            stats = self.quick_look_stats(crs)
+            if stats is not None:
+                return stats
+        if self.engine == 'coverage':
+            return self.coverage_stats()
+        if needs_warp(shapes, crs, self.crs_mode):
+            if self.workers > 1:
+                logger.warning(f'The raster is warped in one process, '
+                               f'ignoring {self.workers} workers')
+            return self.index_stats(self.statistics)
+        if self.workers > 1:
+            try:
+                from choppyzs.parallel import parallel_zonal_stats
+            except ImportError:
+                from .parallel import parallel_zonal_stats
+            return parallel_zonal_stats(shapes, self.raster_file,
+                                        statistics=self.statistics,
+                                        all_touched=self.all_touched,
+                                        workers=self.workers,
+                                        engine=self.engine,
+                                        block_budget=self.block_budget,
+                                        max_bins=self.max_bins,
+                                        sketch_size=self.sketch_size,
+                                        pipeline=self.pipeline)
+        if self.engine == 'stream':
+            try:
+                from choppyzs.streaming import stream_zonal_stats
+            except ImportError:
+                from .streaming import stream_zonal_stats
+            return stream_zonal_stats(shapes, self.raster_file,
+                                      statistics=self.statistics,
+                                      all_touched=self.all_touched,
+                                      block_budget=self.block_budget,
+                                      max_bins=self.max_bins,
+                                      sketch_size=self.sketch_size,
+                                      profiler=self.profiler,
+                                      pipeline=self.pipeline)
+        from rasterstats import zonal_stats
+        if self.profile:
+            with self.profiler.stage('read'):
+                self.count_windows()
+        if shapes is self.shapes and self.shape_file is not None:
+            shapes = self.shape_file
+        return zonal_stats(shapes,
+                           self.raster_file,
+                           geojson_out=self.geojson,
+                           all_touched=self.all_touched,
+                           stats=self.statistics)
 # 1}}} ------------------------------------------------------------------------
 
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Weight zonal statistics by the exact area of each pixel in each zone.
+
+Pixels are candidates when any part of them touches a zone. Those away
+from the zone boundary are wholly inside it and weigh 1, only the pixels
+along the boundary are intersected with the zone, all at once with the
+vectorized Shapely 2 operations when available.
+"""
+import numpy as np
+try:
+    from shapely import area, box, intersection
+except ImportError:
+    box = None
+try:
+    from choppyzs.zones import (ZoneIndex, REPORT_ORDER, geometry_extents,
+                                iter_geometries, parse_stats,
+                                rasterize_extent)
+except ImportError:
+    from .zones import (ZoneIndex, REPORT_ORDER, geometry_extents,
+                        iter_geometries, parse_stats, rasterize_extent)
+
+WEIGHTED_STATS = ['min', 'max', 'mean', 'sum', 'std', 'count', 'range']
+
+
+def dilate(mask):
+    """Grow a boolean mask by one pixel in every direction."""
+    rows = mask.copy()
+    rows[1:] |= mask[:-1]
+    rows[:-1] |= mask[1:]
+    grown = rows.copy()
+    grown[:, 1:] |= rows[:, :-1]
+    grown[:, :-1] |= rows[:, 1:]
+    return grown
+
+
+def pixel_bounds(rows, cols, transform):
+    """Get the (xmin, ymin, xmax, ymax) arrays of grid pixels."""
+    if transform.b or transform.d:
+        raise RuntimeError('Coverage fractions need a grid without '
+                           'rotation!')
+    x0 = transform.c + cols * transform.a
+    y0 = transform.f + rows * transform.e
+    x1 = x0 + transform.a
+    y1 = y0 + transform.e
+    return (np.minimum(x0, x1), np.minimum(y0, y1),
+            np.maximum(x0, x1), np.maximum(y0, y1))
+
+
+def intersection_areas(geom, bounds):
+    """Get the areas of a geometry within pixel bounds."""
+    if box is not None:
+        return area(intersection(box(*bounds), geom))
+    from shapely.geometry import box as make_box
+    return np.array([make_box(*pixel).intersection(geom).area
+                     for pixel in zip(*bounds)])
+
+
+def coverage_fractions(geom, extent, transform):
+    """Get the pixels of an extent a geometry covers and their fractions.
+
+    Returns the (rows, cols) relative to the extent and the fraction of
+    each pixel's area inside the geometry.
+    """
+    r0 = extent[0]
+    c0 = extent[2]
+    touched = rasterize_extent(geom, extent, transform, all_touched=True)
+    edge = dilate(rasterize_extent(geom.boundary, extent, transform,
+                                   all_touched=True)) & touched
+    weights = touched.astype(np.float64)
+    rows, cols = np.nonzero(edge)
+    pixel_area = abs(transform.a * transform.e)
+    weights[rows, cols] = intersection_areas(
+        geom, pixel_bounds(rows + r0, cols + c0, transform)) / pixel_area
+    rows, cols = np.nonzero(weights > 0)
+    return rows, cols, np.minimum(weights[rows, cols], 1.0)
+
+
+class CoverageIndex(ZoneIndex):
+    """A zone index with the fraction of each pixel inside each zone.
+
+    Built once for a grid like a ZoneIndex (and cacheable the same way),
+    zones sharing a pixel each keep their own fraction of it. The stats
+    are weighted by the fractions: count is the covered pixel area in
+    pixels, sum, mean and std are weighted, min and max are over every
+    pixel the zone covers any part of.
+    """
+
+    def __init__(self, shapes, transform, shape):
+        """Initialize the CoverageIndex by intersecting every zone."""
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.all_touched = True
+        geoms = list(iter_geometries(shapes))
+        self.n_zones = len(geoms)
+        extents = geometry_extents(geoms, transform, self.shape)
+        self.window = self._covering_window(extents)
+        width = self.window.width
+        pixel_lists = []
+        weight_lists = []
+        for geom, ext in zip(geoms, extents):
+            if ext is None:
+                pixel_lists.append(np.empty(0, dtype=np.int64))
+                weight_lists.append(np.empty(0))
+                continue
+            rows, cols, weights = coverage_fractions(geom, ext, transform)
+            rows = rows + ext[0] - self.window.row_off
+            cols = cols + ext[2] - self.window.col_off
+            pixel_lists.append(rows.astype(np.int64) * width + cols)
+            weight_lists.append(weights)
+        self._set_pixels(pixel_lists)
+        self.weights = (np.concatenate(weight_lists) if weight_lists
+                        else np.empty(0))
+
+    def stats(self, arr, statistics=WEIGHTED_STATS, nodata=None):
+        """Compute weighted statistics for every zone of a 2D array.
+
+        Returns a list with one dict per zone like ZoneIndex.stats; the
+        count is a float, the covered area in pixels.
+        """
+        statistics = parse_stats(statistics)
+        cube = self.cube_stats(self.subset(arr)[np.newaxis], statistics,
+                               nodata)[:, 0, :]
+        order = ([s for s in REPORT_ORDER if s in statistics]
+                 + [s for s in statistics if s not in REPORT_ORDER])
+        records = []
+        for zone_stats in cube:
+            row = dict(zip(statistics, zone_stats))
+            records.append({
+                stat: float(row[stat])
+                if stat == 'count' or not np.isnan(row[stat]) else None
+                for stat in order})
+        return records
+
+    def cube_stats(self, cube, statistics=WEIGHTED_STATS, nodata=None):
+        """Compute weighted statistics for every zone and time of a cube.
+
+        Returns a float array shaped (zone, time, stat) like
+        ZoneIndex.cube_stats.
+        """
+        statistics = parse_stats(statistics)
+        for stat in statistics:
+            if stat not in WEIGHTED_STATS:
+                raise RuntimeError(f'Statistic {stat} can not be weighted, '
+                                   f'use one of {WEIGHTED_STATS}')
+        cube = self.subset(cube)
+        n_times = cube.shape[0]
+        values = cube.reshape(n_times, -1)[:, self.pixels]
+        values = values.astype(np.float64, copy=False)
+        valid = ~np.isnan(values)
+        if nodata is not None:
+            valid &= values != nodata
+        counts = np.diff(self.offsets)
+        present = counts > 0
+        starts = self.offsets[:-1][present]
+        out = np.full((self.n_zones, n_times, len(statistics)), np.nan)
+        out[..., [i for i, s in enumerate(statistics) if s == 'count']] = 0
+        if not starts.size:
+            return out
+        weights = np.where(valid, self.weights, 0)
+        values = np.where(valid, values, 0)
+        count = np.add.reduceat(weights, starts, axis=1)
+        total = np.add.reduceat(weights * values, starts, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+        results = {'count': count, 'sum': total, 'mean': mean}
+        if set(['min', 'max', 'range']).intersection(statistics):
+            results['min'] = np.minimum.reduceat(
+                np.where(valid, values, np.inf), starts, axis=1)
+            results['max'] = np.maximum.reduceat(
+                np.where(valid, values, -np.inf), starts, axis=1)
+            results['range'] = results['max'] - results['min']
+        if 'std' in statistics:
+            zone_of_pixel = np.repeat(np.arange(starts.size), counts[present])
+            deviation = values - mean[:, zone_of_pixel]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                results['std'] = np.sqrt(np.add.reduceat(
+                    weights * deviation * deviation, starts, axis=1) / count)
+        empty = count == 0
+        for i, stat in enumerate(statistics):
+            result = results[stat]
+            if stat != 'count':
+                result = np.where(empty, np.nan, result)
+            out[present, :, i] = result.T
+        return out
@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Check input files without importing any of the heavy engines."""
+import os
+
+
+def check_if_file_exists(file_name):
+    """Check if a file exists and if not, return FileNotFoundError."""
+    if os.path.isfile(file_name) is not True:
+        raise FileNotFoundError(f'{file_name} not found!')
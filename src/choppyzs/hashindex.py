@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Index perceptual hashes of images and rasters for near-duplicate lookup.
+
+Hashes are computed in a process pool and persisted as JSON keyed by
+path, modification time and size, so only new or changed files are hashed
+again. Lookups of every file within a Hamming distance go through a
+BK-tree rather than comparing every pair. Rasters are read decimated to
+the few pixels a hash needs, so hashing a large GeoTIFF stays cheap.
+"""
+import os
+import json
+import numpy as np
+try:
+    from choppyzs.files import check_if_file_exists
+except ImportError:
+    from .files import check_if_file_exists
+
+HASH_METHODS = ['average', 'phash']
+DEFAULT_HASH_SIZE = 8
+RASTER_EXTENSIONS = ['.tif', '.tiff', '.img', '.vrt', '.asc', '.nc']
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp']
+
+
+def hamming(hash_1, hash_2):
+    """Count the bits two integer hashes differ by."""
+    return bin(hash_1 ^ hash_2).count('1')
+
+
+def file_key(file_name):
+    """Get the (mtime, size) a file is indexed under."""
+    stat = os.stat(file_name)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def read_raster_image(raster_file, side, band=1):
+    """Read a raster decimated to side x side pixels as a grayscale image."""
+    import rasterio as rio
+    from PIL import Image
+    with rio.open(raster_file) as src:
+        data = src.read(band, out_shape=(side, side), masked=True)
+    data = data.astype(np.float64)
+    low, high = data.min(), data.max()
+    if np.ma.is_masked(low) or high <= low:
+        scaled = np.zeros((side, side))
+    else:
+        scaled = ((data - low) * 255 / (high - low)).filled(0)
+    return Image.fromarray(scaled.astype(np.uint8))
+
+
+def image_hash(file_name, method='average', hash_size=DEFAULT_HASH_SIZE):
+    """Compute the perceptual hash of an image or raster as an int."""
+    import imagehash
+    from PIL import Image
+    if method not in HASH_METHODS:
+        raise RuntimeError(f'Unknown hash method "{method}", use one of '
+                           f'{HASH_METHODS}')
+    check_if_file_exists(file_name)
+    if os.path.splitext(file_name)[1].lower() in RASTER_EXTENSIONS:
+        # phash takes a DCT of 4 times the hash size
+        image = read_raster_image(file_name, hash_size * 4)
+    else:
+        image = Image.open(file_name)
+    if method == 'phash':
+        hashed = imagehash.phash(image, hash_size=hash_size)
+    else:
+        hashed = imagehash.average_hash(image, hash_size=hash_size)
+    return int(str(hashed), 16)
+
+
+def _hash_files(file_names, method, hash_size):
+    """Hash a chunk of files in a worker process."""
+    return [image_hash(file_name, method, hash_size)
+            for file_name in file_names]
+
+
+class BKTree():
+    """A BK-tree of integer hashes under the Hamming distance.
+
+    Every node keeps the files sharing its hash; children are keyed by
+    their distance to the node, so a query within ``k`` only visits the
+    children whose key is within ``k`` of the query's distance.
+    """
+
+    def __init__(self):
+        """Initialize an empty tree."""
+        self.root = None
+
+    def add(self, hashed, item):
+        """Add an item under a hash."""
+        if self.root is None:
+            self.root = (hashed, [item], {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(hashed, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = (hashed, [item], {})
+                return
+            node = node[2][distance]
+
+    def query(self, hashed, max_distance=0):
+        """Get the (item, distance) of every item within max_distance."""
+        found = []
+        nodes = [] if self.root is None else [self.root]
+        while nodes:
+            node_hash, items, children = nodes.pop()
+            distance = hamming(hashed, node_hash)
+            if distance <= max_distance:
+                found.extend((item, distance) for item in items)
+            for child_distance, child in children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    nodes.append(child)
+        return sorted(found, key=lambda pair: pair[1])
+
+
+class HashIndex():
+    """A persistent perceptual-hash index of images and rasters.
+
+    Parameters:
+        index_file  the JSON file the hashes are kept in, or None to keep
+                    them in memory only
+        method      'average' or 'phash'
+        hash_size   the hash is hash_size ** 2 bits
+    """
+
+    def __init__(self, index_file=None, method='average',
+                 hash_size=DEFAULT_HASH_SIZE):
+        """Initialize the index, loading the index file if it exists."""
+        if method not in HASH_METHODS:
+            raise RuntimeError(f'Unknown hash method "{method}", use one of '
+                               f'{HASH_METHODS}')
+        self.index_file = index_file
+        self.method = method
+        self.hash_size = hash_size
+        self.entries = {}
+        self.tree = None
+        if index_file is not None and os.path.isfile(index_file):
+            with open(index_file) as handle:
+                saved = json.load(handle)
+            if saved['method'] == method and saved['hash_size'] == hash_size:
+                self.entries = saved['entries']
+
+    def __len__(self):
+        """Return the number of indexed files."""
+        return len(self.entries)
+
+    def update(self, files, workers=1):
+        """Hash the new or changed files of a list or directory.
+
+        Files that have disappeared since are dropped when a directory is
+        given. Returns the files that were hashed.
+        """
+        if isinstance(files, str) and os.path.isdir(files):
+            directory = os.path.abspath(files)
+            files = [os.path.join(root, name)
+                     for root, _, names in os.walk(directory)
+                     for name in sorted(names)
+                     if os.path.splitext(name)[1].lower()
+                     in RASTER_EXTENSIONS + IMAGE_EXTENSIONS]
+            for gone in [path for path in self.entries
+                         if path.startswith(directory + os.sep)
+                         and not os.path.isfile(path)]:
+                del self.entries[gone]
+        files = [os.path.abspath(file_name) for file_name in files]
+        stale = [file_name for file_name in files
+                 if self.entries.get(file_name, {}).get('key')
+                 != file_key(file_name)]
+        if stale:
+            try:
+                from choppyzs.parallel import map_chunks, CHUNKS_PER_WORKER
+            except ImportError:
+                from .parallel import map_chunks, CHUNKS_PER_WORKER
+            chunks = np.array_split(
+                np.array(stale, dtype=object),
+                max(min(workers * CHUNKS_PER_WORKER, len(stale)), 1))
+            hashes = map_chunks(
+                _hash_files,
+                [(list(chunk), self.method, self.hash_size)
+                 for chunk in chunks], workers)
+            for file_name, hashed in zip(stale, sum(hashes, [])):
+                self.entries[file_name] = {'key': file_key(file_name),
+                                           'hash': f'{hashed:x}'}
+        self.tree = None
+        return stale
+
+    def save(self, index_file=None):
+        """Write the index as JSON."""
+        index_file = self.index_file if index_file is None else index_file
+        with open(index_file, 'w') as handle:
+            json.dump({'method': self.method, 'hash_size': self.hash_size,
+                       'entries': self.entries}, handle)
+        return index_file
+
+    def get_hash(self, file_name):
+        """Get the hash of a file, from the index when it is unchanged."""
+        file_name = os.path.abspath(file_name)
+        entry = self.entries.get(file_name)
+        if entry is not None and entry['key'] == file_key(file_name):
+            return int(entry['hash'], 16)
+        return image_hash(file_name, self.method, self.hash_size)
+
+    def build_tree(self):
+        """Build the BK-tree of the indexed hashes."""
+        self.tree = BKTree()
+        for file_name, entry in self.entries.items():
+            self.tree.add(int(entry['hash'], 16), file_name)
+        return self.tree
+
+    def query(self, file_name, max_distance=0):
+        """Get the (file, distance) of every indexed file near a file."""
+        if self.tree is None:
+            self.build_tree()
+        file_name = os.path.abspath(file_name)
+        return [(other, distance) for other, distance
+                in self.tree.query(self.get_hash(file_name), max_distance)
+                if other != file_name]
+
+    def duplicates(self, max_distance=0):
+        """Group the indexed files within max_distance of each other."""
+        if self.tree is None:
+            self.build_tree()
+        groups = []
+        grouped = set()
+        for file_name, entry in sorted(self.entries.items()):
+            if file_name in grouped:
+                continue
+            group = [other for other, _ in self.tree.query(
+                int(entry['hash'], 16), max_distance)
+                if other not in grouped]
+            if len(group) > 1:
+                groups.append(sorted(group))
+            grouped.update(group)
+        return groups
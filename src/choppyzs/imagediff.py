@@ -1,30 +1,37 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-"""Compare the differences between two images and export as csv or image."""
+"""Compare the differences between two images and export as csv or image.
+
+The image libraries (PIL, imagehash, cv2, scipy and imageio) are imported
+by the functions using them, so importing this module stays cheap.
+"""
 import os
+import glob
 from collections import Counter
+from tempfile import TemporaryDirectory
 import numpy as np
 import pandas as pd
 try:
-    from scipy.misc import imread
-except ImportError:  # if using new scipy, use imageio
-    from imageio import imread
-from scipy.linalg import norm
-from scipy import sum, average
-from PIL import Image
-from PIL import ImageFile
-import cv2
-import imagehash
+    from choppyzs.files import check_if_file_exists
+except ImportError:
+    from .files import check_if_file_exists
+
+DEFAULT_CHUNK_SIZE = 2 ** 20
+DEFAULT_PARTITIONS = 16
 
 
-def check_if_file_exists(file_name):
-    """Check if a file exists and if not, return FileNotFoundError."""
-    if os.path.isfile(file_name) is not True:
-        raise FileNotFoundError(f'{file_name} not found!')
+def imread(image_file):
+    """Read an image into an array."""
+    try:
+        from scipy.misc import imread as read
+    except ImportError:  # if using new scipy, use imageio
+        from imageio import imread as read
+    return read(image_file)
 
 
 def compare_images_directly(image_1, image_2):
     """Compare to see if the images are different."""
+    from PIL import Image, ImageFile
     ImageFile.LOAD_TRUNCATED_IMAGES = True
     check_if_file_exists(image_1)
     check_if_file_exists(image_2)
@@ -40,6 +47,8 @@ def compare_images_directly(image_1, image_2):
 
 def get_hash_from_image(image_file):
     """Get hash dictionary from an image."""
+    from PIL import Image
+    import imagehash
     check_if_file_exists(image_file)
     with open(image_file, 'rb') as image:
         hash_image = imagehash.average_hash(Image.open(image))
@@ -48,6 +57,7 @@ def get_hash_from_image(image_file):
 
 def compare_image_with_hash(image_1, image_2, max_diff=0):
     """Compare the images for a maximum difference of hash."""
+    from PIL import ImageFile
     ImageFile.LOAD_TRUNCATED_IMAGES = True
     hash_1 = get_hash_from_image(image_1)
     hash_2 = get_hash_from_image(image_2)
@@ -61,6 +71,7 @@ def compare_image_with_hash(image_1, image_2, max_diff=0):
 
 def to_grayscale_array(arr):
     """Convert an image to grayscale for comparison."""
+    from scipy import average
     if len(arr.shape) == 3:
         return average(arr, -1)  # average over the last axis (color channel)
     return arr
@@ -76,6 +87,8 @@ def normalize(arr, factor=255):
 def compare_images(image_file_1, image_file_2, normalize_images=True,
                    normalize_factor=255):
     """Compare two images by converting them to 2D SciPy Arrays."""
+    from scipy import sum
+    from scipy.linalg import norm
     check_if_file_exists(image_file_1)
     check_if_file_exists(image_file_2)
     image_1 = to_grayscale_array(imread(image_file_1).astype(float))
@@ -89,8 +102,169 @@ def compare_images(image_file_1, image_file_2, normalize_images=True,
     return (m_norm, z_norm)
 
 
+class DiffState():
+    """Accumulate the differences of the pixels of a raster or a zone."""
+
+    def __init__(self):
+        """Initialize an empty state."""
+        self.valid = 0
+        self.nonzero = 0
+        self.changed = 0
+        self.nodata_changed = 0
+        self.manhattan = 0.0
+        self.max_abs = None
+
+    def add(self, abs_diff, nodata_changed=0, tolerance=0):
+        """Add the absolute differences of valid pixels."""
+        self.nodata_changed += int(nodata_changed)
+        if not abs_diff.size:
+            return
+        self.valid += abs_diff.size
+        self.nonzero += int(np.count_nonzero(abs_diff))
+        self.changed += int(np.count_nonzero(abs_diff > tolerance))
+        self.manhattan += float(abs_diff.sum())
+        block_max = float(abs_diff.max())
+        if self.max_abs is None or block_max > self.max_abs:
+            self.max_abs = block_max
+
+    def record(self):
+        """Get the state as a dict of change stats."""
+        return {
+            'valid_pixels': self.valid,
+            'changed_pixels': self.changed,
+            'nodata_changed': self.nodata_changed,
+            'manhattan_norm': self.manhattan,
+            'zero_norm': self.nonzero,
+            'max_abs_diff': self.max_abs,
+            'mean_abs_diff': (self.manhattan / self.valid if self.valid
+                              else None),
+        }
+
+
+def diff_dtype(dtype_1, dtype_2):
+    """Get a signed dtype holding the difference of two dtypes."""
+    if np.issubdtype(dtype_1, np.floating) or \
+            np.issubdtype(dtype_2, np.floating):
+        return np.result_type(dtype_1, dtype_2)
+    return np.result_type(dtype_1, dtype_2, np.int8)
+
+
+def valid_mask(arr, nodata):
+    """Get the pixels of an array that are neither nodata nor NaN."""
+    valid = np.ones(arr.shape, dtype=bool)
+    if nodata is not None:
+        valid &= arr != nodata
+    if np.issubdtype(arr.dtype, np.floating):
+        valid &= ~np.isnan(arr)
+    return valid
+
+
+def compare_rasters(raster_1, raster_2, band=1, nodata=None, tolerance=0,
+                    diff_raster=None, shapes=None, all_touched=False,
+                    block_budget=None, profiler=None):
+    """Compare two aligned rasters block by block.
+
+    Both rasters are read window by window in their native dtype, so the
+    memory follows ``block_budget`` rather than the raster size. Pixels
+    that are nodata (the rasters' own, or ``nodata``) or NaN in either
+    raster are left out; those nodata in only one of them are counted as
+    ``nodata_changed``. A pixel is changed when its absolute difference is
+    above ``tolerance``.
+
+    Returns a dict with the change stats of the whole raster and, when
+    ``shapes`` (a GeoDataFrame or geometries) are given, a ``zones`` list
+    with the change stats of each zone. The signed difference is written
+    to the ``diff_raster`` GeoTIFF when one is given. The
+    ``block_budget`` defaults to the streaming engine's.
+    """
+    import rasterio as rio
+    try:
+        from choppyzs.planner import window_zones
+        from choppyzs.streaming import block_windows, DEFAULT_BLOCK_BUDGET
+        from choppyzs.zones import (geometry_extents, iter_geometries,
+                                    rasterize_extent)
+    except ImportError:
+        from .planner import window_zones
+        from .streaming import block_windows, DEFAULT_BLOCK_BUDGET
+        from .zones import (geometry_extents, iter_geometries,
+                            rasterize_extent)
+    if block_budget is None:
+        block_budget = DEFAULT_BLOCK_BUDGET
+    check_if_file_exists(raster_1)
+    check_if_file_exists(raster_2)
+    geoms = [] if shapes is None else list(iter_geometries(shapes))
+    total = DiffState()
+    zone_states = [DiffState() for _ in geoms]
+    with rio.open(raster_1) as src_1, rio.open(raster_2) as src_2:
+        if src_1.shape != src_2.shape or \
+                not src_1.transform.almost_equals(src_2.transform):
+            raise RuntimeError(f'{raster_1} and {raster_2} are not aligned!')
+        nodata_1 = src_1.nodata if nodata is None else nodata
+        nodata_2 = src_2.nodata if nodata is None else nodata
+        out_dtype = diff_dtype(src_1.dtypes[band - 1],
+                               src_2.dtypes[band - 1])
+        work_dtype = (np.float64 if np.issubdtype(out_dtype, np.floating)
+                      else np.int64)
+        extents = geometry_extents(geoms, src_1.transform, src_1.shape)
+        dst = None
+        if diff_raster is not None:
+            out_nodata = (np.nan if np.issubdtype(out_dtype, np.floating)
+                          else np.iinfo(out_dtype).min)
+            profile = src_1.profile
+            profile.update(driver='GTiff', count=1, dtype=out_dtype,
+                           nodata=out_nodata)
+            dst = rio.open(diff_raster, 'w', **profile)
+        # both rasters are read at once, so each gets half the budget
+        windows = list(block_windows(src_1, block_budget // 2, band))
+        try:
+            for window, zones in zip(windows,
+                                     window_zones(windows, extents)):
+                data_1 = src_1.read(band, window=window)
+                data_2 = src_2.read(band, window=window)
+                if profiler is not None:
+                    profiler.count_array(data_1)
+                    profiler.count_array(data_2)
+                valid_1 = valid_mask(data_1, nodata_1)
+                valid_2 = valid_mask(data_2, nodata_2)
+                valid = valid_1 & valid_2
+                mismatch = valid_1 != valid_2
+                diff = data_1.astype(work_dtype) - data_2.astype(work_dtype)
+                abs_diff = np.abs(diff)
+                total.add(abs_diff[valid], np.count_nonzero(mismatch),
+                          tolerance)
+                if dst is not None:
+                    diff = diff.astype(out_dtype)
+                    diff[~valid] = out_nodata
+                    dst.write(diff, 1, window=window)
+                row_stop = window.row_off + window.height
+                col_stop = window.col_off + window.width
+                for zone in zones:
+                    ext = extents[zone]
+                    extent = (max(ext[0], window.row_off),
+                              min(ext[1], row_stop),
+                              max(ext[2], window.col_off),
+                              min(ext[3], col_stop))
+                    mask = rasterize_extent(geoms[zone], extent,
+                                            src_1.transform, all_touched)
+                    block = (slice(extent[0] - window.row_off,
+                                   extent[1] - window.row_off),
+                             slice(extent[2] - window.col_off,
+                                   extent[3] - window.col_off))
+                    zone_states[zone].add(
+                        abs_diff[block][mask & valid[block]],
+                        np.count_nonzero(mismatch[block] & mask), tolerance)
+        finally:
+            if dst is not None:
+                dst.close()
+        result = {'pixels': src_1.width * src_1.height, **total.record()}
+    if shapes is not None:
+        result['zones'] = [state.record() for state in zone_states]
+    return result
+
+
 def convert_image_to_list_of_pixel_values(image_file):
     """Convert an image to a list of lists of pixel values."""
+    from PIL import Image
     check_if_file_exists(image_file)
     # convert image to 8-bit grayscale
     image = Image.open(image_file).convert('L')
@@ -105,8 +279,10 @@ def image_to_dataframe(image_file, method="pil"):
     """Use cv2 to convert an image to a dataframe."""
     check_if_file_exists(image_file)
     if method.lower() == "cv2":
+        import cv2
         image_df = cv2.imread(image_file)
     elif method.lower() == "pil":
+        from PIL import Image
         imframe = Image.open(image_file)
         npframe = np.array(imframe.getdata())
         image_df = pd.DataFrame(npframe)
@@ -115,16 +291,178 @@ def image_to_dataframe(image_file, method="pil"):
     return image_df
 
 
-def compare_dataframes(df_1, df_2, method="merge", on=None):
-    """Compare two dataframes and retrieve the difference."""
-    if method.lower == 'concat':
+def row_hashes(df, columns=None, tolerance=None):
+    """Hash the rows of a DataFrame with pandas' vectorized hashing.
+
+    Float columns are rounded to a multiple of ``tolerance`` first, so
+    rows within the tolerance usually hash the same. Values on both sides
+    of a rounding boundary do not, see tolerance_unmatched.
+    """
+    df = df if columns is None else df[list(columns)]
+    if tolerance:
+        floats = df.select_dtypes('floating').columns
+        if len(floats):
+            df = df.copy()
+            df[floats] = np.round(df[floats] / tolerance) * tolerance
+    return pd.util.hash_pandas_object(df, index=False).values
+
+
+def occurrence_hashes(hashes):
+    """Tell repeated hashes apart by hashing them with their occurrence."""
+    occurrence = pd.Series(hashes).groupby(hashes).cumcount().values
+    return pd.util.hash_pandas_object(
+        pd.DataFrame({'hash': hashes, 'occurrence': occurrence}),
+        index=False).values
+
+
+def values_equal(values_1, values_2, tolerance=None):
+    """Compare aligned columns, floats within a tolerance, NaN equal NaN."""
+    equal = np.ones(len(values_1), dtype=bool)
+    for column in values_1.columns:
+        col_1 = values_1[column].values
+        col_2 = values_2[column].values
+        if tolerance and np.issubdtype(col_1.dtype, np.floating) and \
+                np.issubdtype(col_2.dtype, np.floating):
+            equal &= np.isclose(col_1, col_2, rtol=0, atol=tolerance,
+                                equal_nan=True)
+        else:
+            equal &= (col_1 == col_2) | (pd.isna(col_1) & pd.isna(col_2))
+    return equal
+
+
+def tolerance_unmatched(df_1, df_2, tolerance=None):
+    """Pair the rows of two frames whose values are within a tolerance.
+
+    Rows are paired one to one when their other columns are equal and
+    their floats within ``tolerance``. Nearest partners on the first float
+    column are paired at once, the rows left are searched in a sorted
+    window of that column. The pairing is greedy, so rows crowded within
+    the tolerance of each other may be left over. Returns the masks of
+    the rows of each frame left without a partner.
+    """
+    unmatched_1 = np.ones(len(df_1), dtype=bool)
+    unmatched_2 = np.ones(len(df_2), dtype=bool)
+    floats = [column for column in df_1.select_dtypes('floating').columns
+              if column in df_2
+              and np.issubdtype(df_2[column].dtype, np.floating)]
+    if not tolerance or not floats or not len(df_1) or not len(df_2):
+        return unmatched_1, unmatched_2
+    df_2 = df_2[df_1.columns]
+    exact = [column for column in df_1.columns if column not in floats]
+    keys_1, keys_2 = [
+        row_hashes(df, exact) if exact else np.zeros(len(df), np.uint64)
+        for df in [df_1, df_2]]
+    # NaN sorts last as inf, the value check tells them apart
+    x_1, x_2 = [np.nan_to_num(df[floats[0]].values.astype(np.float64),
+                              nan=np.inf) for df in [df_1, df_2]]
+    left = pd.DataFrame({'key': keys_1, 'x': x_1,
+                         'row_1': np.arange(len(x_1))})
+    right = pd.DataFrame({'key': keys_2, 'x': x_2,
+                          'row_2': np.arange(len(x_2))})
+    while unmatched_1.any() and unmatched_2.any():
+        pairs = pd.merge_asof(
+            left[unmatched_1].sort_values('x'),
+            right[unmatched_2].sort_values('x'), on='x', by='key',
+            tolerance=tolerance, direction='nearest').dropna()
+        rows_1 = pairs['row_1'].values
+        rows_2 = pairs['row_2'].values.astype(np.int64)
+        equal = values_equal(df_1.iloc[rows_1], df_2.iloc[rows_2],
+                             tolerance)
+        # a right row claimed by several left rows pairs with one of them
+        rows_2, first = np.unique(rows_2[equal], return_index=True)
+        if not rows_2.size:
+            break
+        unmatched_1[rows_1[equal][first]] = False
+        unmatched_2[rows_2] = False
+    order = np.lexsort((x_2, keys_2))
+    sorted_keys, sorted_x = keys_2[order], x_2[order]
+    for row in np.flatnonzero(unmatched_1):
+        start = np.searchsorted(sorted_keys, keys_1[row], 'left')
+        stop = np.searchsorted(sorted_keys, keys_1[row], 'right')
+        low = start + np.searchsorted(sorted_x[start:stop],
+                                      x_1[row] - tolerance, 'left')
+        high = start + np.searchsorted(sorted_x[start:stop],
+                                       x_1[row] + tolerance, 'right')
+        window = order[low:high]
+        window = window[unmatched_2[window]]
+        if not window.size:
+            continue
+        window = window[values_equal(
+            df_1.iloc[np.repeat(row, window.size)], df_2.iloc[window],
+            tolerance)]
+        if window.size:
+            unmatched_1[row] = False
+            unmatched_2[window[np.argmin(
+                np.abs(x_2[window] - x_1[row]))]] = False
+    return unmatched_1, unmatched_2
+
+
+def hash_diff(df_1, df_2, on=None, tolerance=None):
+    """Diff two DataFrames by hashing their rows.
+
+    Without key columns rows are matched as a multiset of whole rows,
+    the rows whose hashes differ are then paired within ``tolerance``.
+    With key columns (``on``) rows are matched by key; rows with the same
+    key whose values differ by more than ``tolerance`` (floats) are
+    reported on both sides. The differing rows are returned with a
+    ``_merge`` column of ``left_only`` or ``right_only``.
+    """
+    if on is None:
+        tags_1 = occurrence_hashes(row_hashes(df_1, tolerance=tolerance))
+        tags_2 = occurrence_hashes(row_hashes(df_2, tolerance=tolerance))
+        only_1 = ~np.isin(tags_1, tags_2)
+        only_2 = ~np.isin(tags_2, tags_1)
+        if tolerance:
+            unmatched_1, unmatched_2 = tolerance_unmatched(
+                df_1[only_1], df_2[only_2], tolerance)
+            only_1[np.flatnonzero(only_1)[~unmatched_1]] = False
+            only_2[np.flatnonzero(only_2)[~unmatched_2]] = False
+    else:
+        on = [on] if isinstance(on, str) else list(on)
+        values = [c for c in df_1.columns if c not in on]
+        left = pd.DataFrame({
+            'key': occurrence_hashes(row_hashes(df_1, on)),
+            'value': row_hashes(df_1, values), 'row': np.arange(len(df_1))})
+        right = pd.DataFrame({
+            'key': occurrence_hashes(row_hashes(df_2, on)),
+            'value': row_hashes(df_2, values), 'row': np.arange(len(df_2))})
+        matched = left.merge(right, on='key', how='outer', indicator=True,
+                             suffixes=('_1', '_2'))
+        only_1 = np.zeros(len(df_1), dtype=bool)
+        only_2 = np.zeros(len(df_2), dtype=bool)
+        only_1[matched.loc[matched['_merge'] == 'left_only', 'row_1']
+               .astype(np.int64)] = True
+        only_2[matched.loc[matched['_merge'] == 'right_only', 'row_2']
+               .astype(np.int64)] = True
+        both = matched[(matched['_merge'] == 'both')
+                       & (matched['value_1'] != matched['value_2'])]
+        if len(both):
+            rows_1 = both['row_1'].values.astype(np.int64)
+            rows_2 = both['row_2'].values.astype(np.int64)
+            changed = ~values_equal(
+                df_1[values].iloc[rows_1].reset_index(drop=True),
+                df_2[values].iloc[rows_2].reset_index(drop=True), tolerance)
+            only_1[rows_1[changed]] = True
+            only_2[rows_2[changed]] = True
+    return pd.concat([df_1[only_1].assign(_merge='left_only'),
+                      df_2[only_2].assign(_merge='right_only')])
+
+
+def compare_dataframes(df_1, df_2, method="merge", on=None, tolerance=None):
+    """Compare two dataframes and retrieve the difference.
+
+    The ``hash`` method scales to large frames, see hash_diff.
+    """
+    if method.lower() == 'concat':
         diff = pd.concat([df_1, df_2]).drop_duplicates(keep=False)
-    elif method.lower == 'isin':
+    elif method.lower() == 'isin':
         diff = df_1[~df_1.apply(tuple, 1).isin(df_2.apply(tuple, 1))]
-    elif method.lower == 'merge':
+    elif method.lower() == 'merge':
         diff = df_1.merge(
             df_2, indicator=True, how='left'
         ).loc[lambda x: x['_merge'] != 'both']
+    elif method.lower() == 'hash':
+        diff = hash_diff(df_1, df_2, on=on, tolerance=tolerance)
     elif method.lower() == 'counter':
         on = on if on is not None else df_1.columns
         df1_on = df_1[on]
@@ -141,3 +479,92 @@ def compare_dataframes(df_1, df_2, method="merge", on=None):
     else:
         raise RuntimeError(f'Unknown method "{method}" chosen.')
     return diff
+
+
+def iter_frames(file_name, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Read a CSV, Parquet or Feather file in DataFrames of chunk_size."""
+    check_if_file_exists(file_name)
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == '.csv':
+        yield from pd.read_csv(file_name, chunksize=chunk_size)
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(file_name).iter_batches(chunk_size):
+            yield batch.to_pandas()
+    elif extension in ['.feather', '.arrow']:
+        import pyarrow.ipc as ipc
+        with ipc.open_file(file_name) as reader:
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).to_pandas()
+    else:
+        raise RuntimeError(f'Can not stream {file_name}, use a csv, '
+                           f'parquet or feather file.')
+
+
+def partition_file(file_name, directory, side, on=None, tolerance=None,
+                   partitions=DEFAULT_PARTITIONS,
+                   chunk_size=DEFAULT_CHUNK_SIZE):
+    """Split a file into buckets by the hash of its keys (or rows)."""
+    for chunk, df in enumerate(iter_frames(file_name, chunk_size)):
+        if on is None:
+            hashes = row_hashes(df, tolerance=tolerance)
+        else:
+            hashes = row_hashes(df, [on] if isinstance(on, str) else on)
+        buckets = hashes % np.uint64(partitions)
+        for bucket in np.unique(buckets):
+            df[buckets == bucket].to_pickle(os.path.join(
+                directory, f'{side}_{bucket}_{chunk}.pkl'))
+
+
+def read_bucket(directory, side, bucket):
+    """Read the pieces of a bucket of one side back into a DataFrame."""
+    pieces = sorted(glob.glob(os.path.join(directory,
+                                           f'{side}_{bucket}_*.pkl')))
+    if not pieces:
+        return None
+    return pd.concat([pd.read_pickle(piece) for piece in pieces],
+                     ignore_index=True)
+
+
+def compare_files(file_1, file_2, on=None, tolerance=None,
+                  partitions=DEFAULT_PARTITIONS,
+                  chunk_size=DEFAULT_CHUNK_SIZE):
+    """Diff two CSV, Parquet or Feather files too large to load at once.
+
+    Both files are streamed in chunks and split into ``partitions``
+    buckets by the hash of their key columns (or whole rows), so matching
+    rows land in the same bucket; the buckets are then diffed one at a
+    time with ``hash_diff``. Without key columns the rows left over in
+    every bucket are paired within ``tolerance`` once more, as rounding
+    may put close rows in different buckets. Returns the differing rows
+    like hash_diff.
+    """
+    diffs = []
+    with TemporaryDirectory() as directory:
+        for side, file_name in enumerate([file_1, file_2]):
+            partition_file(file_name, directory, side, on, tolerance,
+                           partitions, chunk_size)
+        for bucket in range(partitions):
+            df_1 = read_bucket(directory, 0, bucket)
+            df_2 = read_bucket(directory, 1, bucket)
+            if df_1 is None and df_2 is None:
+                continue
+            if df_1 is None:
+                df_1 = df_2.iloc[:0]
+            if df_2 is None:
+                df_2 = df_1.iloc[:0]
+            diff = hash_diff(df_1, df_2, on, tolerance)
+            if len(diff):
+                diffs.append(diff)
+    if not diffs:
+        return pd.DataFrame(columns=['_merge'])
+    diff = pd.concat(diffs, ignore_index=True)
+    if on is None and tolerance:
+        left = diff[diff['_merge'] == 'left_only']
+        right = diff[diff['_merge'] == 'right_only']
+        unmatched_1, unmatched_2 = tolerance_unmatched(
+            left.drop(columns='_merge'), right.drop(columns='_merge'),
+            tolerance)
+        diff = pd.concat([left[unmatched_1], right[unmatched_2]],
+                         ignore_index=True)
+    return diff
@@ -2,15 +2,27 @@
 # -*- coding: utf-8 -*-
 # standard python imports
 import logging
-from rich.logging import RichHandler
-from rich.traceback import install
-install()
 
 
 def create_logger():
-    """Create a logger for use in all cases."""
-    rich_handler = RichHandler(rich_tracebacks=True, markup=True)
-    logging.basicConfig(level='INFO', format='%(message)s',
-                        datefmt="[%Y/%m/%d %H:%M;%S]",
-                        handlers=[rich_handler])
-    return logging.getLogger('rich')
+    """Create a logger for use in all cases.
+
+    Rich is loaded on the first call rather than when the module is
+    imported. Importing a module never installs the rich traceback hook,
+    the command line does with install_tracebacks().
+    """
+    logger = logging.getLogger('rich')
+    if not any(type(handler).__name__ == 'RichHandler'
+               for handler in logging.getLogger().handlers):
+        from rich.logging import RichHandler
+        rich_handler = RichHandler(rich_tracebacks=True, markup=True)
+        logging.basicConfig(level='INFO', format='%(message)s',
+                            datefmt="[%Y/%m/%d %H:%M;%S]",
+                            handlers=[rich_handler])
+    return logger
+
+
+def install_tracebacks():
+    """Show the uncaught exceptions with rich tracebacks."""
+    from rich.traceback import install
+    install()
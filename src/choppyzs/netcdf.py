@@ -2,24 +2,203 @@
 # -*- coding: utf-8 -*-
 """Compute zonal statistics of a netcdf."""
 import os
-import logging
+import glob
+from importlib import import_module
 from tempfile import TemporaryDirectory
+import numpy as np
 import pandas as pd
 import xarray as xr
-import rioxarray
 import patoolib as pa
-import rasterio as rio
 import geopandas as gpd
-from rasterstats import zonal_stats
+from rasterio.transform import Affine
 try:
-    from choppyzs.imagediff import check_if_file_exists
+    from choppyzs.cache import ZoneCache, DEFAULT_CACHE_SIZE, file_hash
+    from choppyzs.files import check_if_file_exists
     from choppyzs.logz import create_logger
+    from choppyzs.pipeline import (Pipeline, DEFAULT_BLOCK_BUDGET,
+                                   DEFAULT_PREFETCH, DEFAULT_READER_THREADS,
+                                   DEFAULT_COMPUTE_THREADS)
+    from choppyzs.profiling import Profiler
+    from choppyzs.reproject import (build_zone_index, check_crs_mode,
+                                    index_kind, needs_warp, shapes_to_crs,
+                                    warn_unknown_crs)
+    from choppyzs.writers import (STREAM_FORMATS, create_writer,
+                                  output_extension, read_steps, step_key,
+                                  zone_attributes)
+    from choppyzs.zones import (ARRAY_NODATA, CUBE_STATS, parse_stats,
+                                split_stats)
 except ImportError:
-    from .imagediff import check_if_file_exists
+    from .cache import ZoneCache, DEFAULT_CACHE_SIZE, file_hash
+    from .files import check_if_file_exists
     from .logz import create_logger
+    from .pipeline import (Pipeline, DEFAULT_BLOCK_BUDGET, DEFAULT_PREFETCH,
+                           DEFAULT_READER_THREADS, DEFAULT_COMPUTE_THREADS)
+    from .profiling import Profiler
+    from .reproject import (build_zone_index, check_crs_mode, index_kind,
+                            needs_warp, shapes_to_crs, warn_unknown_crs)
+    from .writers import (STREAM_FORMATS, create_writer, output_extension,
+                          read_steps, step_key, zone_attributes)
+    from .zones import ARRAY_NODATA, CUBE_STATS, parse_stats, split_stats
 
 logger = create_logger()
 
+# the (y, x) dimensions of a grid in geographic coordinates
+GEOGRAPHIC_DIMS = [('lat', 'lon'), ('latitude', 'longitude')]
+
+
+def resolve_netcdfs(nc_file):
+    """Expand a NetCDF path, glob or list of them into NetCDF paths."""
+    patterns = [nc_file] if isinstance(nc_file, str) else list(nc_file)
+    nc_files = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise FileNotFoundError(f'No NetCDFs match {pattern}!')
+            nc_files.extend(matches)
+        else:
+            check_if_file_exists(pattern)
+            nc_files.append(pattern)
+    return nc_files
+
+
+def open_netcdf(nc_files, chunks=None):
+    """Open one NetCDF, or several as one dataset along their coordinates.
+
+    With ``chunks`` (any xarray chunk spec, e.g. ``{'time': 12}``) the
+    variables are Dask arrays read chunk by chunk, several files are
+    always opened that way.
+    """
+    if len(nc_files) == 1:
+        return xr.open_dataset(nc_files[0], chunks=chunks)
+    return xr.open_mfdataset(nc_files, chunks=chunks or {},
+                             combine='by_coords')
+
+
+def coords_affine(nc_var):
+    """Derive the affine of a (..., y, x) variable from its coordinates."""
+    y, x = (np.asarray(nc_var[dim].values, dtype=float)
+            for dim in nc_var.dims[-2:])
+    if len(x) < 2 or len(y) < 2:
+        raise RuntimeError(f'The grid of {nc_var.name} is a single row or '
+                           f'column, its affine is unknown!')
+    res_x = (x[-1] - x[0]) / (len(x) - 1)
+    res_y = (y[-1] - y[0]) / (len(y) - 1)
+    if not (np.allclose(np.diff(x), res_x) and
+            np.allclose(np.diff(y), res_y)):
+        raise RuntimeError(f'The grid of {nc_var.name} is not regular!')
+    return Affine(res_x, 0, x[0] - res_x / 2, 0, res_y, y[0] - res_y / 2)
+
+
+def dataset_grid(nc_ds):
+    """Get the (affine, crs) of the first gridded variable of a dataset.
+
+    A grid without a CRS on lat/lon dimensions is taken as EPSG:4326.
+    """
+    # rioxarray is only imported for the .rio accessor it registers
+    import_module('rioxarray')
+    for nc_var in nc_ds.data_vars.values():
+        if nc_var.ndim >= 2:
+            crs = nc_var.rio.crs
+            if crs is None and \
+                    tuple(nc_var.dims[-2:]) in GEOGRAPHIC_DIMS:
+                crs = 'EPSG:4326'
+            return coords_affine(nc_var), crs
+    raise RuntimeError('The NetCDF has no gridded variables!')
+
+
+def times_per_read(nc_var, slices=None, block_budget=DEFAULT_BLOCK_BUDGET):
+    """Get how many time steps of a variable fit in a byte budget."""
+    shape = nc_var.shape[-2:]
+    if slices is not None:
+        shape = [len(range(*s.indices(n))) for s, n in zip(slices, shape)]
+    step_bytes = int(np.prod(shape)) * nc_var.dtype.itemsize
+    return max(block_budget // max(step_bytes, 1), 1)
+
+
+def prefetch(loads, depth=1):
+    """Call the loads in a thread, yielding results up to depth ahead.
+
+    The next block is read while the caller computes on the current one,
+    and at most ``depth + 1`` blocks are held at once.
+    """
+    return Pipeline(prefetch=depth).map(loads, lambda load: load())
+
+
+def read_times(nc_var, nc_times, slices=None, profiler=None,
+               time_var='time'):
+    """Read the values of some times, within the (row, col) slices."""
+    profiler = Profiler() if profiler is None else profiler
+    with profiler.stage('read'):
+        block = nc_var.sel({time_var: nc_times})
+        if slices is not None:
+            block = block[(Ellipsis,) + slices]
+        values = block.values
+        profiler.count_array(values)
+    return values
+
+
+def chop_times(nc_var, nc_times, shapes, affine, statistics,
+               all_touched=False, nodata=None, zone_index=None,
+               profiler=None, time_chunk=None,
+               block_budget=DEFAULT_BLOCK_BUDGET, pipeline=None,
+               time_var='time'):
+    """Compute the zonal stats of a NetCDF variable for a list of times.
+
+    The stats come from the zone index when one is given, otherwise from
+    ``zonal_stats`` on the shapes (a shape file or a GeoDataFrame). The
+    times are read ``time_chunk`` at a time (by default as many as fit in
+    ``block_budget``), the next chunks through the ``pipeline`` while the
+    stats of the current ones are computed. The times are selected along
+    the ``time_var`` dimension. The reads and stats are timed on the
+    ``profiler``.
+    """
+    profiler = Profiler() if profiler is None else profiler
+    pipeline = Pipeline() if pipeline is None else pipeline
+    slices = None if zone_index is None else zone_index.slices
+    if zone_index is None:
+        from rasterstats import zonal_stats
+    if time_chunk is None:
+        time_chunk = times_per_read(nc_var, slices, block_budget)
+    groups = [nc_times[start:start + time_chunk]
+              for start in range(0, len(nc_times), time_chunk)]
+
+    def read(group):
+        return group, read_times(nc_var, group, slices, profiler,
+                                 time_var)
+
+    def compute(loaded):
+        stats_list = []
+        for nc_time, nc_arr_values in zip(*loaded):
+            logger.info(f'Parsing time {nc_time}')
+            with profiler.stage('stats'):
+                if zone_index is not None:
+                    stats_data = zone_index.stats(
+                        nc_arr_values, statistics,
+                        nodata=ARRAY_NODATA if nodata is None else nodata)
+                else:
+                    stats_data = zonal_stats(shapes, nc_arr_values,
+                                             affine=affine, stats=statistics,
+                                             nodata=nodata,
+                                             all_touched=all_touched)
+            stats_list.append(stats_data)
+        return stats_list
+
+    for stats_list in pipeline.map(groups, read, compute):
+        yield from stats_list
+
+
+def _chop_times_worker(nc_files, value_var, nc_times, shapes, affine,
+                       statistics, all_touched, nodata, zone_index, chunks,
+                       time_chunk, block_budget, pipeline, time_var):
+    """Open the NetCDF in a worker process and chop a chunk of times."""
+    with open_netcdf(nc_files, chunks) as nc_ds:
+        return list(chop_times(nc_ds[value_var], nc_times, shapes,
+                               affine, statistics, all_touched, nodata,
+                               zone_index, time_chunk=time_chunk,
+                               block_budget=block_budget,
+                               pipeline=pipeline, time_var=time_var))
+
 
 class NetCDF2Stats():
     """Convert a netcdf timeseries to zonal_stats."""
@@ -27,10 +206,75 @@ class NetCDF2Stats():
     def __init__(self, shape_archive, nc_file, output_dir=os.getcwd(),
                  statistics='min,max,mean,median,majority,sum,std,count,range',
                  output_file='zonal_stats', all_touched=False,
-                 output_format='csv', geometry=False):
-        """Initialize the NetCDF2Stats class."""
-        if output_format not in ['xlsx', 'csv', 'tsv', 'none', None]:
+                 output_format='csv', geometry=False, engine='zones',
+                 nodata=None, workers=1, cache_dir=None,
+                 cache_size=DEFAULT_CACHE_SIZE, chunks=None,
+                 block_budget=DEFAULT_BLOCK_BUDGET, incremental=False,
+                 crs_mode='shapes', prefetch=DEFAULT_PREFETCH,
+                 reader_threads=DEFAULT_READER_THREADS,
+                 compute_threads=DEFAULT_COMPUTE_THREADS):
+        """Initialize the NetCDF2Stats class.
+
+        The ``zones`` engine rasterizes the shapes once and reuses the zone
+        index for every time step, the ``rasterstats`` engine calls
+        ``zonal_stats`` for each time step and the ``coverage`` engine
+        weights the min, max, mean, sum, std, count and range stats by the
+        exact fraction of each pixel inside each zone (see
+        choppyzs.coverage). With ``workers`` above one the time steps are
+        split across a process pool.
+
+        The parquet, feather and netcdf formats are written incrementally
+        while chopping, with the zone attributes stored once by zone_id.
+
+        With a ``cache_dir`` the extracted shapes and the zone index are
+        cached on disk, keyed by the archive contents and the grid. The
+        ``shape_archive`` may also be a GeoDataFrame of shapes already
+        read, its ``archive_key`` attribute then keys the zone index.
+
+        The ``nc_file`` may be a path, a glob or a list of them, several
+        files are opened as one dataset. With ``chunks`` the variables are
+        opened lazily as Dask arrays. Times are read as many at once as fit
+        in ``block_budget`` bytes, the next ones while the stats of the
+        current ones are computed. The affine is derived from the lat/lon
+        (or y/x) coordinates.
+
+        With ``incremental`` the times already in an existing parquet,
+        feather or netcdf output computed with the same shapes, stats,
+        all_touched and nodata are skipped and only the new times are
+        appended to it.
+
+        When the shapes and the dataset CRS differ the shapes are
+        reprojected to the dataset (``crs_mode`` 'shapes'), the dataset is
+        warped to the shapes by a cached plan ('raster', always through a
+        zone index) or both are used as they are ('none').
+
+        The times are read ``prefetch`` chunks ahead by ``reader_threads``
+        while ``compute_threads`` compute the stats of the chunks read and
+        the stats are written in a writer thread (see choppyzs.pipeline).
+        The NetCDF reads themselves are serialized by xarray's file lock.
+
+        The time, bytes read and pixels of each stage are kept in
+        ``profiler``.
+        """
+        if output_format not in ['xlsx', 'csv', 'tsv', 'none', None] + \
+                STREAM_FORMATS:
             raise RuntimeError(f'Format {output_format} is not acceptable!')
+        if incremental and output_format not in STREAM_FORMATS:
+            raise RuntimeError(f'Format {output_format} can not be '
+                               f'appended to, use one of '
+                               f'{", ".join(STREAM_FORMATS)}!')
+        if engine not in ['zones', 'rasterstats', 'coverage']:
+            raise RuntimeError(f'Engine {engine} is not acceptable!')
+        check_crs_mode(crs_mode)
+        self.pipeline = Pipeline(prefetch, reader_threads, compute_threads)
+        self.profiler = Profiler()
+        self.engine = engine
+        self.nodata = nodata
+        self.workers = workers
+        self.chunks = chunks
+        self.block_budget = block_budget
+        self.incremental = incremental
+        self.config = None
         self.output_format = output_format
         self.working_directory = TemporaryDirectory()
         if ',' in statistics:
@@ -38,60 +282,304 @@ class NetCDF2Stats():
         else:
             self.statistics = statistics
         self.all_touched = all_touched
+        self.crs_mode = crs_mode
         self.shape_archive = shape_archive
         self.nc_file = nc_file
-        self.output_file = output_file + '.' + output_format
+        self.output_file = output_file + '.' + \
+            output_extension(output_format)
         self.geometry = geometry
-        pa.extract_archive(shape_archive, outdir=self.working_directory.name)
-        for file_name in os.listdir(self.working_directory.name):
-            if file_name.endswith('.shp'):
-                self.shape_file = os.path.join(self.working_directory.name,
-                                               file_name)
-        check_if_file_exists(self.shape_file)
-        check_if_file_exists(self.nc_file)
+        self.shape_file = None
+        self.shape_df = None
+        self.cache = None
+        self.archive_key = None
+        if isinstance(shape_archive, gpd.GeoDataFrame):
+            self.shape_df = shape_archive
+            self.archive_key = shape_archive.attrs.get('archive_key')
+        if cache_dir is not None and (self.shape_df is None or
+                                      self.archive_key is not None):
+            self.cache = ZoneCache(cache_dir, cache_size)
+        if self.cache is not None and self.shape_df is None:
+            with self.profiler.stage('cache'):
+                self.archive_key = self.cache.archive_key(shape_archive)
+                self.shape_df = self.cache.get(self.archive_key, 'shapes')
+        if self.shape_df is None:
+            self.extract_shapes()
+            if self.cache is not None:
+                with self.profiler.stage('cache'):
+                    self.cache.put(self.archive_key, 'shapes',
+                                   self.shape_df)
+        self.nc_files = resolve_netcdfs(self.nc_file)
         self.output_path = os.path.join(output_dir, self.output_file)
         if output_format == 'json':
             self.geojson = True
         else:
             self.geojson = False
-        self.shape_df = gpd.read_file(self.shape_file)
-        self.nc_ds = xr.open_dataset(self.nc_file)
-        self.affine = rio.open(self.nc_file).transform
+        with self.profiler.stage('open'):
+            self.nc_ds = open_netcdf(self.nc_files, chunks)
+            self.affine, self.crs = dataset_grid(self.nc_ds)
+        warn_unknown_crs(self.shape_df, self.crs)
+        self.crs_shapes = shapes_to_crs(self.shape_df, self.crs, crs_mode)
         self.df_list = []
+        self.zone_index = None
+        self.writer = None
+
+    def extract_shapes(self):
+        """Extract the shape archive and read the shapefile."""
+        with self.profiler.stage('extract'):
+            pa.extract_archive(self.shape_archive,
+                               outdir=self.working_directory.name)
+        for file_name in os.listdir(self.working_directory.name):
+            if file_name.endswith('.shp'):
+                self.shape_file = os.path.join(self.working_directory.name,
+                                               file_name)
+        if self.shape_file is None:
+            raise FileNotFoundError(f'No shapefile in {self.shape_archive}!')
+        check_if_file_exists(self.shape_file)
+        with self.profiler.stage('read_shapes'):
+            self.shape_df = gpd.read_file(self.shape_file)
+
+    def get_zone_index(self, shape):
+        """Build (or load from the cache) the zone index for the grid.
+
+        The coverage engine builds a CoverageIndex instead, and the
+        ``raster`` CRS mode a WarpedZoneIndex.
+        """
+        if self.zone_index is not None and \
+                self.zone_index.shape == tuple(shape):
+            return self.zone_index
+        kind = index_kind(self.shape_df, self.crs,
+                          'coverage' if self.engine == 'coverage'
+                          else 'zones', self.crs_mode)
+        if self.cache is not None:
+            key = self.cache.grid_key(self.archive_key, self.crs,
+                                      self.affine, shape, self.all_touched)
+            with self.profiler.stage('cache'):
+                self.zone_index = self.cache.get(key, kind)
+            if self.zone_index is not None:
+                logger.info('Loaded the zone index from the cache')
+                return self.zone_index
+        logger.info(f'Rasterizing {len(self.shape_df)} zones')
+        with self.profiler.stage('rasterize'):
+            self.zone_index = build_zone_index(
+                self.shape_df, self.crs, self.affine, shape,
+                'coverage' if self.engine == 'coverage' else 'zones',
+                self.all_touched, self.crs_mode)
+        if self.cache is not None:
+            with self.profiler.stage('cache'):
+                self.cache.put(key, kind, self.zone_index)
+        return self.zone_index
+
+    @property
+    def shapes(self):
+        """Get the shape file, or the cached shapes when not extracted.
+
+        The shapes are reprojected to the dataset CRS when they differ.
+        """
+        if self.crs_shapes is not self.shape_df:
+            return self.crs_shapes
+        return self.shape_file or self.shape_df
+
+    def run_config(self, value_var, statistics):
+        """Get the configuration the stats of a run depend on.
+
+        The CRS mode is only kept when it is not the default one, so the
+        outputs of earlier runs can still be appended to.
+        """
+        config = {'shapes': file_hash(self.shape_archive),
+                  'value_var': value_var,
+                  'statistics': list(statistics),
+                  'all_touched': bool(self.all_touched),
+                  'coverage': self.engine == 'coverage',
+                  'nodata': None if self.nodata is None
+                  else float(self.nodata)}
+        if self.crs_mode != 'shapes':
+            config['crs_mode'] = self.crs_mode
+        return config
+
+    def missing_times(self, nc_times, config):
+        """Keep the times not already in the output of the same config.
 
-    def chop(self, time_var='time', value_var='scpdsi'):
+        Every time is missing unless the run is incremental.
+        """
+        self.config = config
+        if not self.incremental:
+            return nc_times
+        metadata, steps = read_steps(self.output_format, self.output_path)
+        if steps and metadata != config:
+            raise RuntimeError(f'{self.output_path} was computed with '
+                               f'another configuration ({metadata}), can '
+                               f'not append to it!')
+        done = set(steps)
+        missing = np.array([step_key(nc_time) not in done
+                            for nc_time in nc_times], dtype=bool)
+        logger.info(f'{len(nc_times) - missing.sum()} times are already in '
+                    f'{self.output_path}, {missing.sum()} to compute')
+        return nc_times[missing]
+
+    def append(self, nc_time, sd):
+        """Keep or write out the stats DataFrame of one time step."""
+        if self.output_format in STREAM_FORMATS:
+            with self.profiler.stage('write'):
+                if self.writer is None:
+                    self.writer = create_writer(
+                        self.output_format, self.output_path,
+                        zone_attributes(self.shape_df, self.geometry),
+                        metadata=self.config, append=self.incremental)
+                self.writer.write(sd, nc_time)
+            return
+        with self.profiler.stage('concat'):
+            self.df_list.append(self.time_frame(nc_time, sd))
+
+    def time_frame(self, nc_time, sd):
+        """Join the stats DataFrame of a time step to the shapes."""
+        dat = pd.concat([pd.DataFrame(self.shape_df), sd], axis=1)
+        dat['time'] = nc_time
+        if self.geometry is False:
+            dat.drop(columns='geometry', inplace=True, errors='ignore')
+        return dat
+
+    def select_stats(self, statistics):
+        """Parse the stats, keeping the coverage weighted ones with it."""
+        statistics = parse_stats(statistics)
+        if self.engine == 'coverage':
+            try:
+                from choppyzs.coverage import WEIGHTED_STATS
+            except ImportError:
+                from .coverage import WEIGHTED_STATS
+            statistics, skipped = split_stats(statistics, WEIGHTED_STATS)
+            if skipped:
+                logger.warning(f'Skipping {",".join(skipped)}, not '
+                               f'available with coverage weights')
+        return statistics
+
+    def times_zone_index(self, nc_var):
+        """Get the zone index of a variable, None with rasterstats."""
+        if self.engine in ['zones', 'coverage'] or \
+                needs_warp(self.shape_df, self.crs, self.crs_mode):
+            return self.get_zone_index(nc_var.shape[-2:])
+        return None
+
+    def time_stats(self, nc_times, statistics, time_var='time',
+                   value_var='scpdsi', time_chunk=None):
+        """Compute the stats of some times in this process, per time."""
+        nc_var = self.nc_ds[value_var]
+        return chop_times(nc_var, nc_times, self.shapes, self.affine,
+                          statistics, self.all_touched, self.nodata,
+                          self.times_zone_index(nc_var), self.profiler,
+                          time_chunk, self.block_budget, self.pipeline,
+                          time_var)
+
+    def chop(self, time_var='time', value_var='scpdsi', time_chunk=None):
         """Chop the raster stats over the years."""
         nc_var = self.nc_ds[value_var]
         logger.info(f'{len(nc_var)}')
-        nc_times = self.nc_ds[time_var].values
+        statistics = self.select_stats(self.statistics)
+        nc_times = self.missing_times(self.nc_ds[time_var].values,
+                                      self.run_config(value_var, statistics))
         logger.info(f'Parsing {len(nc_times)} times')
-        for nc_time in nc_times:
-            logger.info(f'Parsing time {nc_time}')
-            nc_arr = nc_var.sel(time=nc_time)
-            nc_arr_values = nc_arr.values
-            stats_data = zonal_stats(self.shape_file,
-                                     nc_arr_values, affine=self.affine,
-                                     stats=self.statistics,
-                                     geojson_out=self.geojson,
-                                     all_touched=self.all_touched)
-            sd = pd.DataFrame.from_dict(stats_data)
-            df = pd.DataFrame(self.shape_df)
-            dat = pd.concat([df, sd], axis=1)
-            logging.info(f'{nc_time}')
-            dat['time'] = nc_time
-            if self.geometry is False:
-                dat.drop(columns='geometry', inplace=True, errors='ignore')
-            self.df_list.append(dat)
+        if not len(nc_times):
+            return
+        if self.workers > 1:
+            try:
+                from choppyzs.parallel import map_chunks, CHUNKS_PER_WORKER
+            except ImportError:
+                from .parallel import map_chunks, CHUNKS_PER_WORKER
+            zone_index = self.times_zone_index(nc_var)
+            chunks = [chunk for chunk in np.array_split(
+                nc_times, self.workers * CHUNKS_PER_WORKER) if chunk.size]
+            with self.profiler.stage('stats'):
+                results = map_chunks(
+                    _chop_times_worker,
+                    [(self.nc_files, value_var, chunk, self.shapes,
+                      self.affine, statistics, self.all_touched,
+                      self.nodata, zone_index, self.chunks, time_chunk,
+                      self.block_budget, self.pipeline, time_var)
+                     for chunk in chunks],
+                    self.workers)
+            stats_list = (stats for result in results for stats in result)
+        else:
+            stats_list = self.time_stats(nc_times, statistics, time_var,
+                                         value_var, time_chunk)
+
+        def write(step):
+            self.append(step[0], pd.DataFrame.from_dict(step[1]))
+        self.pipeline.drain(zip(nc_times, stats_list), write)
+
+    def chop_cube(self, time_var='time', value_var='scpdsi',
+                  time_chunk=None):
+        """Chop the stats for all times at once, reading chunks of times.
+
+        Only the stats that reduce over whole cubes (min, max, mean, sum,
+        std, count and range) are computed. The (zone, time, stat) array is
+        kept as ``self.cube`` with the stat names in ``self.cube_stats``.
+        By default as many times are read at once as fit in the block
+        budget.
+        """
+        self.cube_stats, skipped = split_stats(self.statistics, CUBE_STATS)
+        if skipped:
+            logger.warning(f'Skipping {",".join(skipped)}, not available '
+                           f'for whole cubes')
+        nc_var = self.nc_ds[value_var]
+        nc_times = self.missing_times(
+            self.nc_ds[time_var].values,
+            self.run_config(value_var, self.cube_stats))
+        zone_index = self.get_zone_index(nc_var.shape[-2:])
+        nodata = ARRAY_NODATA if self.nodata is None else self.nodata
+        self.cube = np.empty((len(zone_index), len(nc_times),
+                              len(self.cube_stats)))
+        if time_chunk is None:
+            time_chunk = times_per_read(nc_var, zone_index.slices,
+                                        self.block_budget)
+        starts = range(0, len(nc_times), time_chunk)
+
+        def read(start):
+            return start, read_times(nc_var,
+                                     nc_times[start:start + time_chunk],
+                                     zone_index.slices, self.profiler,
+                                     time_var)
+
+        def compute(loaded):
+            start, block = loaded
+            logger.info(f'Parsing times {nc_times[start]} to '
+                        f'{nc_times[start + len(block) - 1]}')
+            with self.profiler.stage('stats'):
+                return start, zone_index.cube_stats(block, self.cube_stats,
+                                                    nodata=nodata)
+
+        def write(computed):
+            start, chunk = computed
+            stop = start + chunk.shape[1]
+            self.cube[:, start:stop, :] = chunk
+            for step in range(stop - start):
+                sd = pd.DataFrame(chunk[:, step, :], columns=self.cube_stats)
+                if 'count' in sd and self.engine != 'coverage':
+                    sd['count'] = sd['count'].astype(int)
+                self.append(nc_times[start + step], sd)
+        self.pipeline.run(starts, read, compute, write)
+        return self.cube
 
     def export(self):
-        """Export the dataframe as the appropriate output."""
-        self.df = pd.concat(self.df_list, ignore_index=True)
-        if self.output_format == 'csv':
-            self.df.to_csv(self.output_path, index=False)
-        elif self.output_format == 'tsv':
-            self.df.to_csv(self.output_path, sep='\t', index=False)
-        elif self.output_format == 'xlsx':
-            self.df.to_excel(self.output_path)
-        elif self.output_format == 'none':
-            logger.info(self.df)
+        """Export the dataframe as the appropriate output.
+
+        The streamed formats are already written while chopping, so export
+        only closes the file and returns None.
+        """
+        if self.output_format in STREAM_FORMATS:
+            if self.writer is not None:
+                with self.profiler.stage('write'):
+                    self.writer.close()
+                self.writer = None
+            logger.info(f'Wrote {self.output_path}')
+            return None
+        with self.profiler.stage('concat'):
+            self.df = pd.concat(self.df_list, ignore_index=True)
+        with self.profiler.stage('write'):
+            if self.output_format == 'csv':
+                self.df.to_csv(self.output_path, index=False)
+            elif self.output_format == 'tsv':
+                self.df.to_csv(self.output_path, sep='\t', index=False)
+            elif self.output_format == 'xlsx':
+                self.df.to_excel(self.output_path)
+            elif self.output_format == 'none':
+                logger.info(self.df)
         return self.df
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Read a raster at a coarser level for quick-look zonal statistics.
+
+The level is the coarsest one at which most zones still cover enough
+pixels for a requested relative error: a zone of n pixels has a mean
+error of about 1 / sqrt(n), so a tolerance of 0.05 keeps 400 pixels per
+zone. The coarse pixels on the zone edges are weighted by the share of
+them the zone covers for the mean, count and sum, so the tolerance also
+bounds the relative error of count and sum; the other statistics (min,
+max, std and the order statistics) come from the coarse pixel values and
+have no such bound. Only the window of the zones is read, with average
+resampling from the internal overviews of the raster when it has them;
+otherwise a decimated copy is built once, strip by strip, and cached.
+When the tolerance needs the full resolution nothing is read and the
+caller falls back to its normal engine.
+"""
+import os
+import math
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.windows import Window, transform as window_transform
+try:
+    from choppyzs.logz import create_logger
+    from choppyzs.pipeline import DEFAULT_BLOCK_BUDGET
+    from choppyzs.zones import geometry_extents, iter_geometries
+except ImportError:
+    from .logz import create_logger
+    from .pipeline import DEFAULT_BLOCK_BUDGET
+    from .zones import geometry_extents, iter_geometries
+
+logger = create_logger()
+
+DEFAULT_TOLERANCE = 0.05
+# the share of the zones allowed to have fewer pixels than the tolerance
+# asks for, so a few slivers do not force the full resolution
+SMALL_ZONE_QUANTILE = 10
+# stats that add up pixels and are scaled back to full resolution pixels
+SCALED_STATS = ['count', 'sum']
+# stats taken from the covered area of the coarse pixels
+AREA_STATS = ['mean', 'count', 'sum']
+
+
+def zone_pixels(shapes, transform):
+    """Get the area of every zone in full resolution pixels."""
+    pixel_area = abs(transform.a * transform.e - transform.b * transform.d)
+    return np.array([0.0 if geom is None or geom.is_empty
+                     else geom.area / pixel_area
+                     for geom in iter_geometries(shapes)])
+
+
+def choose_factor(pixels, tolerance=DEFAULT_TOLERANCE, factors=None):
+    """Choose the decimation factor of a level for a relative error.
+
+    The factor is the largest of ``factors`` (the overview factors of the
+    raster, or powers of 2 when None) keeping the small zones above the
+    pixels the tolerance needs.
+    """
+    pixels = pixels[pixels > 0]
+    if not pixels.size or tolerance <= 0:
+        return 1
+    needed = 1 / tolerance ** 2
+    reference = np.percentile(pixels, SMALL_ZONE_QUANTILE)
+    largest = max(int(math.sqrt(reference / needed)), 1)
+    if factors is None:
+        factors = [2 ** level for level in range(1, 31)]
+    return max([1] + [f for f in factors if f <= largest])
+
+
+def level_shape(shape, factor):
+    """Get the (height, width) of a grid decimated by a factor.
+
+    A last partial row or column of pixels is kept.
+    """
+    return (max(-(-shape[0] // factor), 1), max(-(-shape[1] // factor), 1))
+
+
+def zones_window(shapes, transform, shape, factor=1):
+    """Get the window of a grid the zones cover, aligned to a factor.
+
+    Returns None when no zone overlaps the grid.
+    """
+    extents = [ext for ext in geometry_extents(list(iter_geometries(shapes)),
+                                               transform, shape)
+               if ext is not None]
+    if not extents:
+        return None
+    extents = np.array(extents)
+    row_start = extents[:, 0].min() // factor * factor
+    col_start = extents[:, 2].min() // factor * factor
+    row_stop = min(-(-extents[:, 1].max() // factor) * factor, shape[0])
+    col_stop = min(-(-extents[:, 3].max() // factor) * factor, shape[1])
+    return Window(int(col_start), int(row_start), int(col_stop - col_start),
+                  int(row_stop - row_start))
+
+
+def pyramid_path(cache_dir, raster_file, factor, band=1):
+    """Get the cached decimated copy of a raster, keyed by its stat."""
+    stat = os.stat(raster_file)
+    stem = os.path.splitext(os.path.basename(raster_file))[0]
+    return os.path.join(cache_dir, 'pyramids',
+                        f'{stem}_{stat.st_mtime_ns}_{stat.st_size}'
+                        f'_b{band}_ov{factor}.tif')
+
+
+def read_level(src, factor, band=1, window=None):
+    """Read a window of a band decimated by a factor (average resampling).
+
+    Returns the (masked float array, transform) of the level over the
+    window, the whole raster by default; GDAL reads it from the closest
+    internal overview when there is one.
+    """
+    if window is None:
+        window = Window(0, 0, src.width, src.height)
+    height, width = level_shape((window.height, window.width), factor)
+    data = src.read(band, window=window, out_shape=(height, width),
+                    masked=True, resampling=Resampling.average,
+                    out_dtype='float64')
+    transform = window_transform(window, src.transform)
+    transform = transform * transform.scale(window.width / width,
+                                            window.height / height)
+    return data, transform
+
+
+def build_pyramid(raster_file, factor, path, band=1,
+                  block_budget=DEFAULT_BLOCK_BUDGET):
+    """Write a raster decimated by a factor as a GeoTIFF.
+
+    The level is read and written in strips of rows within the budget.
+    """
+    with rio.open(raster_file) as src:
+        height, width = level_shape(src.shape, factor)
+        nodata = src.nodata if src.nodata is not None else np.nan
+        profile = dict(driver='GTiff', height=height, width=width,
+                       count=1, dtype='float64', crs=src.crs,
+                       transform=src.transform * src.transform.scale(
+                           src.width / width, src.height / height),
+                       nodata=nodata, tiled=True, compress='deflate')
+        rows = max(block_budget // (width * 8), 1)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with rio.open(f'{path}.tmp', 'w', **profile) as dst:
+            for row in range(0, height, rows):
+                window = Window(0, row * factor, src.width,
+                                min(rows * factor, src.height - row * factor))
+                data, _ = read_level(src, factor, band, window)
+                dst.write(data.filled(nodata), 1,
+                          window=Window(0, row, width, data.shape[0]))
+    os.replace(f'{path}.tmp', path)
+    return path
+
+
+def read_overview(raster_file, shapes, tolerance=DEFAULT_TOLERANCE,
+                  cache_dir=None, band=1):
+    """Read the zones' window at the coarsest level within a tolerance.
+
+    Returns a dict with the level's ``data`` (a float array, nodata
+    filled), ``transform``, ``crs``, ``nodata``, its decimation ``factor``
+    from the full resolution, ``resolution`` (pixel width and height),
+    ``pixel_ratio`` (full resolution pixels per pixel) and its ``source``
+    (overview, pyramid or resampled). Returns None without reading when
+    the tolerance needs the full resolution or no zone overlaps the
+    raster.
+    """
+    with rio.open(raster_file) as src:
+        pixels = zone_pixels(shapes, src.transform)
+        overviews = src.overviews(band)
+        factor = choose_factor(pixels, tolerance, overviews or None)
+        window = zones_window(shapes, src.transform, src.shape, factor)
+        if factor == 1 or window is None:
+            return None
+        nodata = src.nodata if src.nodata is not None else np.nan
+        crs = src.crs
+        full_area = abs(src.transform.a * src.transform.e)
+        source = 'overview' if overviews else 'resampled'
+        if not overviews and cache_dir is not None:
+            source = 'pyramid'
+        else:
+            data, transform = read_level(src, factor, band, window)
+    if source == 'pyramid':
+        path = pyramid_path(cache_dir, raster_file, factor, band)
+        if not os.path.isfile(path):
+            logger.info(f'Building a 1/{factor} pyramid of {raster_file}')
+            build_pyramid(raster_file, factor, path, band)
+        with rio.open(path) as src:
+            level_window = Window(
+                window.col_off // factor, window.row_off // factor,
+                min(-(-window.width // factor),
+                    src.width - window.col_off // factor),
+                min(-(-window.height // factor),
+                    src.height - window.row_off // factor))
+            data = src.read(1, window=level_window, masked=True)
+            transform = window_transform(level_window, src.transform)
+    fewer = int(np.count_nonzero(
+        (pixels > 0) & (pixels / factor ** 2 < 1 / tolerance ** 2)))
+    if fewer:
+        logger.warning(f'{fewer} zones have fewer pixels than a '
+                       f'{tolerance} tolerance needs at 1/{factor}')
+    return {'data': data.filled(nodata), 'transform': transform, 'crs': crs,
+            'nodata': nodata, 'factor': factor,
+            'resolution': (abs(transform.a), abs(transform.e)),
+            'pixel_ratio': abs(transform.a * transform.e) / full_area,
+            'source': source}
+
+
+def scale_stats(records, pixel_ratio, statistics=SCALED_STATS):
+    """Scale the pixel sums of level stats back to full resolution."""
+    for record in records:
+        for stat in statistics:
+            if record.get(stat) is not None:
+                record[stat] = record[stat] * pixel_ratio
+    return records
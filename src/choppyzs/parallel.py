@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Partition zonal statistics work and run it in a process pool."""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import rasterio as rio
+try:
+    from choppyzs.stats import (ZoneState, DEFAULT_MAX_BINS,
+                                DEFAULT_SKETCH_SIZE, needs_histogram,
+                                states_to_records)
+    from choppyzs.planner import plan_windows
+    from choppyzs.streaming import stream_windows, DEFAULT_BLOCK_BUDGET
+    from choppyzs.zones import iter_geometries, parse_stats
+except ImportError:
+    from .stats import (ZoneState, DEFAULT_MAX_BINS, DEFAULT_SKETCH_SIZE,
+                        needs_histogram, states_to_records)
+    from .planner import plan_windows
+    from .streaming import stream_windows, DEFAULT_BLOCK_BUDGET
+    from .zones import iter_geometries, parse_stats
+
+# chunks handed out per worker, so uneven chunks still balance
+CHUNKS_PER_WORKER = 4
+
+
+def morton_key(x, y, bits=16):
+    """Interleave the bits of quantized x and y into a Z-order key."""
+    key = np.zeros(x.shape, dtype=np.uint64)
+    x = x.astype(np.uint64)
+    y = y.astype(np.uint64)
+    for bit in range(bits):
+        key |= ((x >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit)
+        key |= ((y >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + 1)
+    return key
+
+
+def partition_features(shapes, n_chunks):
+    """Split features into spatially coherent chunks of feature indices.
+
+    Features are ordered along a Z-order curve of their bounding box centers
+    and the curve is cut into ``n_chunks`` runs of about the same length.
+    """
+    geoms = list(iter_geometries(shapes))
+    if not geoms:
+        return []
+    centers = np.array([
+        [(g.bounds[0] + g.bounds[2]) / 2, (g.bounds[1] + g.bounds[3]) / 2]
+        if g is not None and not g.is_empty else [0.0, 0.0] for g in geoms])
+    low = centers.min(axis=0)
+    span = np.maximum(centers.max(axis=0) - low, 1e-12)
+    cells = np.floor((centers - low) / span * 65535).astype(np.int64)
+    order = np.argsort(morton_key(cells[:, 0], cells[:, 1]), kind='stable')
+    n_chunks = max(min(n_chunks, len(geoms)), 1)
+    return [chunk for chunk in np.array_split(order, n_chunks) if chunk.size]
+
+
+def map_chunks(func, chunks, workers):
+    """Run ``func(*args)`` for every chunk of args in a process pool.
+
+    Results are returned in the order of ``chunks``.
+    """
+    if workers <= 1 or len(chunks) <= 1:
+        return [func(*args) for args in chunks]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(func, *args) for args in chunks]
+        return [future.result() for future in futures]
+
+
+def _chop_features(geoms, raster_file, statistics, all_touched):
+    """Compute the stats of a chunk of features in a worker process."""
+    from rasterstats import zonal_stats
+    return zonal_stats(geoms, raster_file, all_touched=all_touched,
+                       stats=statistics)
+
+
+def parallel_zonal_stats(shapes, raster_file, statistics, all_touched=False,
+                         workers=1, engine='rasterstats',
+                         block_budget=DEFAULT_BLOCK_BUDGET,
+                         max_bins=DEFAULT_MAX_BINS,
+                         sketch_size=DEFAULT_SKETCH_SIZE, pipeline=None):
+    """Compute zonal statistics with the work split across processes.
+
+    The rasterstats engine splits the features and every worker opens its
+    own raster handle; the results are stitched back into the original
+    feature order. The stream engine splits the raster blocks instead and
+    merges the per-worker zone states, each worker reading through its
+    own copy of the ``pipeline``.
+    """
+    geoms = list(iter_geometries(shapes))
+    if engine == 'stream':
+        return parallel_stream_zonal_stats(geoms, raster_file, statistics,
+                                           all_touched, workers,
+                                           block_budget, max_bins,
+                                           sketch_size, pipeline)
+    chunks = partition_features(geoms, workers * CHUNKS_PER_WORKER)
+    results = map_chunks(
+        _chop_features,
+        [([geoms[i] for i in chunk], raster_file, statistics, all_touched)
+         for chunk in chunks],
+        workers)
+    stats_data = [None] * len(geoms)
+    for chunk, chunk_stats in zip(chunks, results):
+        for i, feature_stats in zip(chunk, chunk_stats):
+            stats_data[i] = feature_stats
+    return stats_data
+
+
+def parallel_stream_zonal_stats(shapes, raster_file, statistics,
+                                all_touched=False, workers=1,
+                                block_budget=DEFAULT_BLOCK_BUDGET,
+                                max_bins=DEFAULT_MAX_BINS,
+                                sketch_size=DEFAULT_SKETCH_SIZE,
+                                pipeline=None):
+    """Stream runs of planned windows in worker processes and merge states.
+
+    The workers keep the moments of every window and the runs are merged
+    in window order into fresh states, so the stats are the same floats as
+    a serial stream. Zones that all miss the raster plan no windows and
+    get empty stats.
+    """
+    statistics = parse_stats(statistics)
+    geoms = list(iter_geometries(shapes))
+    with rio.open(raster_file) as src:
+        windows = plan_windows(src, geoms, block_budget)
+    histogram = needs_histogram(statistics)
+    states = [ZoneState(histogram=histogram, max_bins=max_bins,
+                        sketch_size=sketch_size) for _ in geoms]
+    if not windows:
+        return states_to_records(states, statistics)
+    chunks = [chunk for chunk in np.array_split(
+        np.arange(len(windows)), workers * CHUNKS_PER_WORKER) if chunk.size]
+    results = map_chunks(
+        stream_windows,
+        [(raster_file, geoms, [windows[i] for i in chunk], statistics,
+          all_touched, 1, None, max_bins, sketch_size, None, pipeline,
+          True)
+         for chunk in chunks],
+        workers)
+    for chunk_states in results:
+        for state, other in zip(states, chunk_states):
+            state.merge(other)
+    return states_to_records(states, statistics)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Overlap the reads, computations and writes of a sequence of items.
+
+Reader threads fetch the next items (raster windows, NetCDF times) while
+compute threads reduce the ones already read, and a writer thread streams
+the results out, so a slow disk and the CPU are kept busy at once. The
+items read ahead are bounded by ``prefetch``, so memory stays within a
+few blocks, and results always come out in the order of the items.
+"""
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# the bytes of raster or NetCDF read at once
+DEFAULT_BLOCK_BUDGET = 64 * 2 ** 20
+DEFAULT_PREFETCH = 2
+DEFAULT_READER_THREADS = 1
+DEFAULT_COMPUTE_THREADS = 1
+# put on the writer queue after the last result
+_DONE = object()
+
+
+class Pipeline():
+    """A read, compute and write pipeline over threads.
+
+    Parameters:
+        prefetch         the items read ahead of the computations
+        reader_threads   the threads reading items
+        compute_threads  the threads computing on the items read
+    """
+
+    def __init__(self, prefetch=DEFAULT_PREFETCH,
+                 reader_threads=DEFAULT_READER_THREADS,
+                 compute_threads=DEFAULT_COMPUTE_THREADS):
+        """Initialize the pipeline, checking its sizes."""
+        for name, value, low in [('prefetch', prefetch, 0),
+                                 ('reader_threads', reader_threads, 1),
+                                 ('compute_threads', compute_threads, 1)]:
+            if value is None or value < low:
+                raise RuntimeError(f'The {name} ({value}) must be at least '
+                                   f'{low}!')
+        self.prefetch = prefetch
+        self.reader_threads = reader_threads
+        self.compute_threads = compute_threads
+
+    @property
+    def depth(self):
+        """Return the most items in flight at once."""
+        return self.prefetch + self.compute_threads
+
+    def submit(self, readers, computers, read, compute, item):
+        """Read then compute an item, returning the future of its result."""
+        done = Future()
+
+        def computed(future):
+            try:
+                done.set_result(future.result())
+            except BaseException as error:
+                done.set_exception(error)
+
+        def loaded(future):
+            error = future.exception()
+            if error is not None:
+                done.set_exception(error)
+            elif compute is None:
+                done.set_result(future.result())
+            else:
+                computers.submit(compute, future.result()) \
+                    .add_done_callback(computed)
+        readers.submit(read, item).add_done_callback(loaded)
+        return done
+
+    def map(self, items, read, compute=None):
+        """Yield ``compute(read(item))`` for every item, in order.
+
+        The items are iterated in the calling thread, so a generator of
+        items may touch state the threads do not.
+        """
+        with ThreadPoolExecutor(self.compute_threads) as computers, \
+                ThreadPoolExecutor(self.reader_threads) as readers:
+            pending = deque()
+            for item in items:
+                pending.append(self.submit(readers, computers, read,
+                                           compute, item))
+                if len(pending) >= self.depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def drain(self, results, write):
+        """Call ``write`` on every result in a writer thread, in order.
+
+        The results are pulled in the calling thread, which drives the
+        reads and computations of a map meanwhile. Returns the number of
+        results written; the first error of the writer is raised.
+        """
+        pending = queue.Queue(maxsize=max(self.prefetch, 1))
+        errors = []
+
+        def writer():
+            while True:
+                result = pending.get()
+                if result is _DONE:
+                    return
+                if not errors:
+                    try:
+                        write(result)
+                    except BaseException as error:
+                        errors.append(error)
+        thread = threading.Thread(target=writer, name='choppy-writer',
+                                  daemon=True)
+        thread.start()
+        written = 0
+        try:
+            for result in results:
+                if errors:
+                    break
+                pending.put(result)
+                written += 1
+        finally:
+            pending.put(_DONE)
+            thread.join()
+        if errors:
+            raise errors[0]
+        return written
+
+    def run(self, items, read, compute=None, write=None):
+        """Read, compute and write every item, returning the results count.
+
+        Without ``write`` the results are only computed.
+        """
+        results = self.map(items, read, compute)
+        try:
+            if write is None:
+                return sum(1 for _ in results)
+            return self.drain(results, write)
+        finally:
+            # waits for the items still in flight after an error
+            results.close()
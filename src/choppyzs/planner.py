@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Plan the raster windows a set of zones has to read.
+
+The extents of the zones are snapped to the raster blocks and clustered
+with an STRtree, so zones sharing blocks share their reads and blocks no
+zone touches are never read. Each cluster is cut into windows within the
+block budget and trimmed to the blocks its zones cover, and the windows
+are read in the block order of the file. The windows never overlap, so
+a zone pixel is only read once.
+"""
+import numpy as np
+import geopandas as gpd
+from rasterio.windows import Window
+from shapely.geometry import box
+try:
+    from choppyzs.logz import create_logger
+    from choppyzs.zones import geometry_extents
+except ImportError:
+    from .logz import create_logger
+    from .zones import geometry_extents
+
+logger = create_logger()
+
+# shrinks the block boxes so clusters that only touch are kept apart
+TOUCH_MARGIN = 0.25
+
+
+def tile_windows(window, block_shape, itemsize, block_budget):
+    """Yield the block aligned windows of a window within a budget.
+
+    Whole rows of blocks are grouped while they fit in ``block_budget``
+    bytes, otherwise each row of blocks is split into runs of blocks.
+    """
+    block_height, block_width = block_shape
+    row_stop = window.row_off + window.height
+    col_stop = window.col_off + window.width
+    row_bytes = window.width * block_height * itemsize
+    if row_bytes <= block_budget:
+        height = max(block_budget // row_bytes, 1) * block_height
+        for row_off in range(window.row_off, row_stop, height):
+            yield Window(window.col_off, row_off, window.width,
+                         min(height, row_stop - row_off))
+        return
+    block_bytes = block_height * block_width * itemsize
+    width = max(block_budget // block_bytes, 1) * block_width
+    for row_off in range(window.row_off, row_stop, block_height):
+        for col_off in range(window.col_off, col_stop, width):
+            yield Window(col_off, row_off, min(width, col_stop - col_off),
+                         min(block_height, row_stop - row_off))
+
+
+def block_extents(extents, block_shape):
+    """Snap (r0, r1, c0, c1) pixel extents outwards to block units."""
+    block_height, block_width = block_shape
+    extents = np.asarray(extents, dtype=np.int64).reshape(-1, 4)
+    return np.stack([extents[:, 0] // block_height,
+                     -(-extents[:, 1] // block_height),
+                     extents[:, 2] // block_width,
+                     -(-extents[:, 3] // block_width)], axis=1)
+
+
+def cluster_boxes(boxes):
+    """Group (r0, r1, c0, c1) boxes into clusters with disjoint hulls.
+
+    Boxes overlapping each other are joined through an STRtree query, and
+    the clusters are joined again until none of their hulls overlap.
+    Returns the (hull, member indices) of every cluster.
+    """
+    clusters = [(tuple(b), [i]) for i, b in enumerate(boxes.tolist())]
+    while len(clusters) > 1:
+        hulls = gpd.GeoSeries([
+            box(c0 + TOUCH_MARGIN, r0 + TOUCH_MARGIN, c1 - TOUCH_MARGIN,
+                r1 - TOUCH_MARGIN)
+            for (r0, r1, c0, c1), _ in clusters])
+        parents = np.arange(len(clusters))
+
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+        merged = False
+        for i, hull in enumerate(hulls):
+            for j in hulls.sindex.query(hull, predicate='intersects'):
+                root_i, root_j = find(i), find(j)
+                if root_i != root_j:
+                    parents[max(root_i, root_j)] = min(root_i, root_j)
+                    merged = True
+        if not merged:
+            break
+        joined = {}
+        for i, (hull, members) in enumerate(clusters):
+            root = find(i)
+            if root not in joined:
+                joined[root] = (hull, [])
+            r0, r1, c0, c1 = joined[root][0]
+            joined[root] = ((min(r0, hull[0]), max(r1, hull[1]),
+                             min(c0, hull[2]), max(c1, hull[3])),
+                            joined[root][1] + members)
+        clusters = list(joined.values())
+    return clusters
+
+
+def window_zones(windows, extents):
+    """Return the zones each window touches, found through an STRtree.
+
+    ``extents`` are the (r0, r1, c0, c1) pixel extents of the zones, None
+    for those off the raster. Returns a list of zone indices per window.
+    """
+    hits = [[] for _ in windows]
+    zones = [zone for zone, ext in enumerate(extents) if ext is not None]
+    if not windows or not zones:
+        return hits
+    tree = gpd.GeoSeries([
+        box(w.col_off + TOUCH_MARGIN, w.row_off + TOUCH_MARGIN,
+            w.col_off + w.width - TOUCH_MARGIN,
+            w.row_off + w.height - TOUCH_MARGIN) for w in windows])
+    boxes = [box(c0, r0, c1, r1)
+             for r0, r1, c0, c1 in (extents[zone] for zone in zones)]
+    found, window_ids = tree.sindex.query(boxes, predicate='intersects')
+    for zone, window in sorted(zip(found.tolist(), window_ids.tolist())):
+        hits[window].append(zones[zone])
+    return hits
+
+
+def plan_windows(src, geoms, block_budget, band=1):
+    """Plan the windows to read for the zones of some geometries.
+
+    Returns block aligned, non-overlapping windows within
+    ``block_budget`` bytes (unless a single block is larger), covering
+    every zone pixel in the block order of the raster.
+    """
+    block_shape = tuple(src.block_shapes[band - 1])
+    block_height, block_width = block_shape
+    itemsize = np.dtype(src.dtypes[band - 1]).itemsize
+    extents = [ext for ext in geometry_extents(geoms, src.transform,
+                                               src.shape) if ext is not None]
+    if not extents:
+        return []
+    # zones in the same blocks read the same, cluster their blocks once
+    blocks = np.unique(block_extents(extents, block_shape), axis=0)
+    windows = []
+    for (r0, r1, c0, c1), members in cluster_boxes(blocks):
+        hull = Window(c0 * block_width, r0 * block_height,
+                      min(c1 * block_width, src.width) - c0 * block_width,
+                      min(r1 * block_height, src.height) - r0 * block_height)
+        member_blocks = blocks[members]
+        for tile in tile_windows(hull, block_shape, itemsize, block_budget):
+            tile_rows = (tile.row_off // block_height,
+                         -(-(tile.row_off + tile.height) // block_height))
+            tile_cols = (tile.col_off // block_width,
+                         -(-(tile.col_off + tile.width) // block_width))
+            hits = member_blocks[(member_blocks[:, 0] < tile_rows[1])
+                                 & (member_blocks[:, 1] > tile_rows[0])
+                                 & (member_blocks[:, 2] < tile_cols[1])
+                                 & (member_blocks[:, 3] > tile_cols[0])]
+            if not hits.size:
+                continue
+            row_start = max(hits[:, 0].min() * block_height, tile.row_off)
+            row_stop = min(hits[:, 1].max() * block_height,
+                           tile.row_off + tile.height)
+            col_start = max(hits[:, 2].min() * block_width, tile.col_off)
+            col_stop = min(hits[:, 3].max() * block_width,
+                           tile.col_off + tile.width)
+            windows.append(Window(col_start, row_start,
+                                  col_stop - col_start,
+                                  row_stop - row_start))
+    windows.sort(key=lambda w: (w.row_off // block_height,
+                                w.col_off // block_width))
+    read = sum(w.width * w.height for w in windows)
+    logger.info(f'Planned {len(windows)} windows for {len(extents)} zones, '
+                f'reading {read / (src.width * src.height):.1%} of the '
+                f'raster')
+    return windows
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Time the stages of a run and count the raster data they read.
+
+Stages are named blocks (``extract``, ``read_shapes``, ``rasterize``,
+``read``, ``stats``, ``concat``, ``write``); a stage entered several
+times accumulates. The report is logged or written as JSON.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    from choppyzs.logz import create_logger
+except ImportError:
+    from .logz import create_logger
+
+logger = create_logger()
+
+
+def peak_rss(who='self'):
+    """Get the peak resident memory in bytes, or None where unknown."""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self'
+                               else resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def profile_path(output_path, extension):
+    """Get the path of a profile report next to an output file."""
+    return f'{os.path.splitext(output_path)[0]}_profile.{extension}'
+
+
+class Profiler():
+    """Accumulate the time, bytes read and pixels of named stages."""
+
+    def __init__(self):
+        """Initialize an empty profile, starting the total clock."""
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @property
+    def current(self):
+        """Get the stack of stages entered by the calling thread."""
+        if not hasattr(self.local, 'current'):
+            self.local.current = []
+        return self.local.current
+
+    def get(self, name):
+        """Get the counters of a stage, creating it when new."""
+        if name not in self.stages:
+            self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0,
+                                 'bytes_read': 0, 'pixels': 0,
+                                 'peak_rss': None})
+        return self.stages[name]
+
+    @contextmanager
+    def stage(self, name):
+        """Time a block as a stage; nested stages are timed inclusively."""
+        stage = self.get(name)
+        self.current.append(name)
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            with self.lock:
+                stage['seconds'] += time.perf_counter() - start
+                stage['calls'] += 1
+                stage['peak_rss'] = peak_rss()
+            self.current.pop()
+
+    def count(self, bytes_read=0, pixels=0, name=None):
+        """Add bytes read and pixels processed to a (the current) stage."""
+        if name is None:
+            name = self.current[-1] if self.current else 'other'
+        stage = self.get(name)
+        with self.lock:
+            stage['bytes_read'] += int(bytes_read)
+            stage['pixels'] += int(pixels)
+
+    def count_array(self, arr, name=None):
+        """Count an array read from a raster or NetCDF."""
+        self.count(arr.nbytes, arr.size, name)
+
+    def report(self):
+        """Get the profile as a JSON serializable dict."""
+        return {
+            'total_seconds': time.perf_counter() - self.started,
+            'bytes_read': sum(s['bytes_read'] for s in self.stages.values()),
+            'pixels': sum(s['pixels'] for s in self.stages.values()),
+            'peak_rss': peak_rss(),
+            'peak_rss_children': peak_rss('children'),
+            'stages': self.stages,
+        }
+
+    def log(self):
+        """Log one line per stage and the totals."""
+        report = self.report()
+        for name, stage in report['stages'].items():
+            line = f'{name}: {stage["seconds"]:.3f}s in {stage["calls"]} ' \
+                f'call(s)'
+            if stage['pixels']:
+                line += f', {stage["pixels"]} pixels, ' \
+                    f'{stage["bytes_read"] / 2 ** 20:.1f} MB read'
+            logger.info(line)
+        memory = report['peak_rss']
+        logger.info(f'total: {report["total_seconds"]:.3f}s, peak memory '
+                    + ('unknown' if memory is None
+                       else f'{memory / 2 ** 20:.1f} MB'))
+
+    def write(self, path):
+        """Write the profile as JSON."""
+        with open(path, 'w') as handle:
+            json.dump(self.report(), handle, indent=2)
+        return path
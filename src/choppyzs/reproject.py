@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Reconcile the CRS of the shapes with the CRS of a raster grid.
+
+By default the shapes are reprojected to the raster CRS, which is cheap.
+Otherwise the raster is warped to the CRS of the shapes through a warp
+plan: the zones are rasterized on a grid in their own CRS and each of
+their pixels is mapped once to the nearest raster pixel. Warping an array
+is then a single fancy index, so the plan is reused for every time step
+of a NetCDF and every raster of a batch sharing the grid.
+"""
+import math
+import numpy as np
+from rasterio.transform import Affine, array_bounds
+from rasterio.warp import calculate_default_transform, transform as warp_xy
+from rasterio.windows import Window
+try:
+    from choppyzs.logz import create_logger
+    from choppyzs.zones import ZoneIndex, DEFAULT_STATS
+except ImportError:
+    from .logz import create_logger
+    from .zones import ZoneIndex, DEFAULT_STATS
+
+logger = create_logger()
+
+# shapes: reproject the shapes to the raster, raster: warp the raster to
+# the shapes, none: use both as they are
+CRS_MODES = ['shapes', 'raster', 'none']
+
+
+def same_crs(crs_1, crs_2):
+    """Check if two CRS match, an unknown CRS is assumed to match."""
+    if crs_1 is None or crs_2 is None or not str(crs_1) or not str(crs_2):
+        return True
+    if str(crs_1) == str(crs_2):
+        return True
+    from pyproj import CRS
+    return CRS.from_user_input(crs_1) == CRS.from_user_input(crs_2)
+
+
+def check_crs_mode(crs_mode):
+    """Raise a RuntimeError for an unknown CRS mode."""
+    if crs_mode not in CRS_MODES:
+        raise RuntimeError(f'This CRS mode ({crs_mode}) is not acceptable, '
+                           f'use one of {CRS_MODES}!')
+
+
+def warn_unknown_crs(shapes, crs):
+    """Warn when the CRS of the shapes or the raster is not known."""
+    if getattr(shapes, 'crs', None) is None or crs is None or not str(crs):
+        logger.warning('The CRS of the shapes or the raster is unknown, '
+                       'assuming they match')
+
+
+def needs_warp(shapes, crs, crs_mode='shapes'):
+    """Check if the raster has to be warped to the CRS of the shapes."""
+    return crs_mode == 'raster' and \
+        not same_crs(getattr(shapes, 'crs', None), crs)
+
+
+def check_overlap(shapes, crs, bounds, crs_mode='shapes'):
+    """Raise when shapes left in another CRS miss the raster bounds.
+
+    With the ``none`` mode the shapes are used as they are, so shapes in
+    another CRS would silently fall off the raster (or span an enormous
+    window of it) rather than meet their zones.
+    """
+    if crs_mode != 'none' or same_crs(getattr(shapes, 'crs', None), crs) \
+            or not len(shapes):
+        return
+    left, bottom, right, top = shapes.total_bounds
+    west, east = sorted([bounds[0], bounds[2]])
+    south, north = sorted([bounds[1], bounds[3]])
+    if left > east or right < west or bottom > north or top < south:
+        raise RuntimeError(f'The shapes in {shapes.crs} do not overlap the '
+                           f'raster in {crs}, use the shapes or raster CRS '
+                           f'mode to reproject them!')
+
+
+def shapes_to_crs(shapes, crs, crs_mode='shapes'):
+    """Reproject the shapes to a raster CRS when the mode asks for it."""
+    if crs_mode != 'shapes' or same_crs(getattr(shapes, 'crs', None), crs):
+        return shapes
+    logger.info(f'Reprojecting the shapes from {shapes.crs} to {crs}')
+    return shapes.to_crs(crs)
+
+
+def zone_grid(shapes, crs, transform, shape):
+    """Get a (transform, shape) grid over the shapes in their CRS.
+
+    Its square pixels are about the size of the raster's once warped.
+    """
+    height, width = shape
+    warped, _, _ = calculate_default_transform(
+        crs, shapes.crs, width, height,
+        *array_bounds(height, width, transform))
+    resolution = abs(warped.a)
+    west, south, east, north = shapes.total_bounds
+    return (Affine(resolution, 0, west, 0, -resolution, north),
+            (max(int(math.ceil((north - south) / resolution)), 1),
+             max(int(math.ceil((east - west) / resolution)), 1)))
+
+
+class WarpedZoneIndex():
+    """A zone index in the CRS of the shapes for a raster in another CRS.
+
+    It stands in for a ZoneIndex of the raster grid: ``window`` and
+    ``slices`` are those of the raster pixels the zones need, and arrays
+    of the raster grid (or that window, with any leading time axes) are
+    warped by nearest neighbour before the stats of the zone grid index.
+    Pixels of the zones outside of the raster are nodata, and counts are
+    of zone grid pixels.
+    """
+
+    def __init__(self, shapes, crs, transform, shape, all_touched=False,
+                 coverage=False):
+        """Initialize the index and the warp plan of the raster grid."""
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.all_touched = all_touched
+        zone_transform, zone_shape = zone_grid(shapes, crs, transform,
+                                               shape)
+        if coverage:
+            self.index = coverage_index(shapes, zone_transform, zone_shape)
+        else:
+            self.index = ZoneIndex(shapes, zone_transform, zone_shape,
+                                   all_touched=all_touched)
+        zone_window = self.index.window
+        targets = np.unique(self.index.pixels)
+        rows = targets // max(zone_window.width, 1) + zone_window.row_off
+        cols = targets % max(zone_window.width, 1) + zone_window.col_off
+        xs, ys = zone_transform * (cols + 0.5, rows + 0.5)
+        xs, ys = warp_xy(shapes.crs, crs, xs, ys)
+        src_cols, src_rows = ~transform * (np.asarray(xs), np.asarray(ys))
+        src_rows = np.floor(src_rows).astype(np.int64)
+        src_cols = np.floor(src_cols).astype(np.int64)
+        inside = ((src_rows >= 0) & (src_rows < self.shape[0])
+                  & (src_cols >= 0) & (src_cols < self.shape[1]))
+        self.targets = targets[inside]
+        src_rows, src_cols = src_rows[inside], src_cols[inside]
+        if self.targets.size:
+            row_off, col_off = src_rows.min(), src_cols.min()
+            self.window = Window(col_off, row_off,
+                                 src_cols.max() - col_off + 1,
+                                 src_rows.max() - row_off + 1)
+        else:
+            row_off = col_off = 0
+            self.window = Window(0, 0, 0, 0)
+        self.sources = (src_rows - row_off) * self.window.width \
+            + (src_cols - col_off)
+
+    def __len__(self):
+        """Return the number of zones."""
+        return self.index.n_zones
+
+    @property
+    def n_zones(self):
+        """Return the number of zones."""
+        return self.index.n_zones
+
+    @property
+    def pixels(self):
+        """Return the zone pixels of the zone grid window."""
+        return self.index.pixels
+
+    @property
+    def zones(self):
+        """Return the zone of each of the zone pixels."""
+        return self.index.zones
+
+    @property
+    def offsets(self):
+        """Return the offsets of the zones in the pixels."""
+        return self.index.offsets
+
+    @property
+    def slices(self):
+        """Return the (row, col) slices of the raster window."""
+        win = self.window
+        return (slice(win.row_off, win.row_off + win.height),
+                slice(win.col_off, win.col_off + win.width))
+
+    def warp(self, arr, nodata=None):
+        """Warp a raster array to the window of the zone grid.
+
+        Pixels without a raster pixel get nodata, or NaN when there is no
+        nodata (integer arrays are then cast to floats).
+        """
+        win = self.window
+        if arr.shape[-2:] == self.shape:
+            arr = arr[(Ellipsis,) + self.slices]
+        elif arr.shape[-2:] != (win.height, win.width):
+            raise RuntimeError(f'Array shape {arr.shape} does not match the '
+                               f'grid {self.shape} or window {win}')
+        dtype = arr.dtype
+        if nodata is None and not np.issubdtype(dtype, np.floating):
+            dtype = np.float64
+        zone_window = self.index.window
+        out = np.full(arr.shape[:-2] + (zone_window.height,
+                                        zone_window.width),
+                      np.nan if nodata is None else nodata, dtype=dtype)
+        flat = out.reshape(arr.shape[:-2] + (-1,))
+        flat[..., self.targets] = np.asarray(arr).reshape(
+            arr.shape[:-2] + (-1,))[..., self.sources]
+        return out
+
+    def subset(self, arr, nodata=None):
+        """Warp an array to the window of the zone grid."""
+        return self.warp(arr, nodata)
+
+    def stats(self, arr, statistics=DEFAULT_STATS, nodata=None):
+        """Compute the statistics of every zone of a warped 2D array."""
+        return self.index.stats(self.warp(arr, nodata), statistics,
+                                nodata=nodata)
+
+    def cube_stats(self, cube, statistics, nodata=None):
+        """Compute the statistics of every zone and time of a cube."""
+        return self.index.cube_stats(self.warp(cube, nodata), statistics,
+                                     nodata=nodata)
+
+
+def coverage_index(shapes, transform, shape):
+    """Build a CoverageIndex, importing the coverage engine when needed."""
+    try:
+        from choppyzs.coverage import CoverageIndex
+    except ImportError:
+        from .coverage import CoverageIndex
+    return CoverageIndex(shapes, transform, shape)
+
+
+def build_zone_index(shapes, crs, transform, shape, kind='zones',
+                     all_touched=False, crs_mode='shapes'):
+    """Build the zone index of shapes on a raster grid.
+
+    The shapes are reprojected to the raster CRS, or with the ``raster``
+    mode a WarpedZoneIndex warps the raster to the shapes.
+    """
+    check_overlap(shapes, crs, array_bounds(*shape, transform), crs_mode)
+    if needs_warp(shapes, crs, crs_mode):
+        logger.info(f'Planning the warp of the raster from {crs} to '
+                    f'{shapes.crs}')
+        return WarpedZoneIndex(shapes, crs, transform, shape, all_touched,
+                               coverage=kind == 'coverage')
+    shapes = shapes_to_crs(shapes, crs, crs_mode)
+    if kind == 'coverage':
+        return coverage_index(shapes, transform, shape)
+    return ZoneIndex(shapes, transform, shape, all_touched=all_touched)
+
+
+def index_kind(shapes, crs, kind='zones', crs_mode='shapes'):
+    """Get the cache kind of a zone index, warped ones apart."""
+    return f'warp-{kind}' if needs_warp(shapes, crs, crs_mode) else kind
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Serve zonal statistics over HTTP with warm shape and raster caches.
+
+The service keeps shape sets, a Choppy per shape set and raster (holding
+its zone indexes), open rasters and a NetCDF2Stats per shape set and
+NetCDF in LRU caches, so a query only reads the zone window and reduces
+it the way the command line does. Requests are JSON posted to
+``/stats``; results come back as JSON records or an Arrow IPC stream::
+
+    POST /register  {"name": "counties", "shape_archive": "counties.zip"}
+    POST /stats     {"shapes": "counties", "raster": "pop.tif",
+                     "stats": "mean,sum", "format": "arrow"}
+    POST /stats     {"shapes": "counties", "netcdf": "pdsi.nc",
+                     "variable": "scpdsi", "time_var": "time",
+                     "times": ["2000-01-01"]}
+    GET  /health    cache sizes and hit counts
+
+Only files under the service's root directories can be read.
+"""
+import os
+import json
+import socketserver
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+import pandas as pd
+import patoolib as pa
+import geopandas as gpd
+import rasterio as rio
+try:
+    from choppyzs.cache import ZoneCache, DEFAULT_CACHE_SIZE
+    from choppyzs.choppy import Choppy
+    from choppyzs.files import check_if_file_exists
+    from choppyzs.logz import create_logger
+    from choppyzs.netcdf import NetCDF2Stats
+    from choppyzs.reproject import check_crs_mode
+    from choppyzs.zones import DEFAULT_STATS, parse_stats
+except ImportError:
+    from .cache import ZoneCache, DEFAULT_CACHE_SIZE
+    from .choppy import Choppy
+    from .files import check_if_file_exists
+    from .logz import create_logger
+    from .netcdf import NetCDF2Stats
+    from .reproject import check_crs_mode
+    from .zones import DEFAULT_STATS, parse_stats
+
+logger = create_logger()
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_ENTRIES = 32
+DEFAULT_WORKERS = os.cpu_count() or 4
+ARROW_TYPE = 'application/vnd.apache.arrow.stream'
+# the engines computing stats from a zone index
+ENGINES = ['zones', 'coverage']
+
+
+class LRUCache():
+    """A thread-safe mapping keeping the most recently used entries.
+
+    ``on_evict`` is called with the entries pushed out, e.g. to close
+    file handles. Entries taken with ``hold`` are acquired under the lock,
+    so an eviction meanwhile can wait for their release.
+    """
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, on_evict=None):
+        """Initialize an empty cache."""
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        """Return the number of entries."""
+        return len(self.entries)
+
+    def get(self, key, factory, acquire=False):
+        """Get an entry, building it with factory() when missing.
+
+        With ``acquire`` the entry's acquire() is called under the lock.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                value = self.entries[key]
+                if acquire:
+                    value.acquire()
+                return value
+        value = factory()
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                evicted.append(value)
+                value = self.entries[key]
+            else:
+                self.entries[key] = value
+                self.misses += 1
+            if acquire:
+                value.acquire()
+            while len(self.entries) > self.max_entries:
+                evicted.append(self.entries.popitem(last=False)[1])
+        if self.on_evict is not None:
+            for old in evicted:
+                self.on_evict(old)
+        return value
+
+    @contextmanager
+    def hold(self, key, factory):
+        """Get an entry acquired until the block exits, then release it."""
+        value = self.get(key, factory, acquire=True)
+        try:
+            yield value
+        finally:
+            value.release()
+
+    def info(self):
+        """Get the size and hit counts of the cache."""
+        return {'entries': len(self), 'hits': self.hits,
+                'misses': self.misses}
+
+
+class SharedHandle():
+    """An open file held by requests, closed once evicted and released."""
+
+    def __init__(self):
+        """Initialize the lock and the count of requests holding it."""
+        self.lock = threading.Lock()
+        self.count_lock = threading.Lock()
+        self.holders = 0
+        self.evicted = False
+
+    def acquire(self):
+        """Hold the handle for a request."""
+        with self.count_lock:
+            self.holders += 1
+
+    def release(self):
+        """Release the handle, closing it if it was evicted meanwhile."""
+        with self.count_lock:
+            self.holders -= 1
+            close = self.evicted and not self.holders
+        if close:
+            self.close()
+
+    def evict(self):
+        """Close the handle now, or once the last request releases it."""
+        with self.count_lock:
+            self.evicted = True
+            close = not self.holders
+        if close:
+            self.close()
+
+
+class RasterHandle(SharedHandle):
+    """An open raster whose reads are serialized by a lock."""
+
+    def __init__(self, path):
+        """Open the raster and keep its grid."""
+        super().__init__()
+        self.path = path
+        self.src = rio.open(path)
+        self.crs = self.src.crs
+        self.transform = self.src.transform
+        self.shape = self.src.shape
+        self.nodata = self.src.nodata
+
+    def read(self, band=1, window=None):
+        """Read a window of a band."""
+        with self.lock:
+            return self.src.read(band, window=window)
+
+    def close(self):
+        """Close the raster once no read is in flight."""
+        with self.lock:
+            self.src.close()
+
+
+class NetCDFHandle(SharedHandle):
+    """A NetCDF2Stats of a shape set whose reads are serialized by a lock."""
+
+    def __init__(self, shape_df, path, **kwargs):
+        """Open the dataset with the NetCDF2Stats options."""
+        super().__init__()
+        self.path = path
+        self.chopper = NetCDF2Stats(shape_df, path, output_format='none',
+                                    **kwargs)
+
+    def close(self):
+        """Close the dataset once no read is in flight."""
+        with self.lock:
+            self.chopper.nc_ds.close()
+
+
+def file_key(path):
+    """Key a file by its path, modification time and size."""
+    check_if_file_exists(path)
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def read_shape_archive(shape_archive):
+    """Extract a shape archive and read its shapefile."""
+    with TemporaryDirectory() as working_directory:
+        pa.extract_archive(shape_archive, outdir=working_directory,
+                           verbosity=-1)
+        for file_name in os.listdir(working_directory):
+            if file_name.endswith('.shp'):
+                return gpd.read_file(os.path.join(working_directory,
+                                                  file_name))
+    raise FileNotFoundError(f'No shapefile in {shape_archive}!')
+
+
+class ZonalStatsService():
+    """Compute zonal statistics against warm, cached inputs.
+
+    Parameters:
+        workers        the number of requests computed at once
+        max_entries    the entries kept in each of the shape, zone index,
+                       raster and NetCDF caches
+        cache_dir      a directory to also cache shapes and zone indexes
+                       on disk, shared with Choppy and NetCDF2Stats
+        cache_size     the bytes the cache directory may grow to
+        roots          the directories requests may read files under, the
+                       current directory by default
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS,
+                 max_entries=DEFAULT_CACHE_ENTRIES, cache_dir=None,
+                 cache_size=DEFAULT_CACHE_SIZE, roots=None):
+        """Initialize the caches and the worker pool."""
+        self.roots = [os.path.realpath(root)
+                      for root in (roots or [os.getcwd()])]
+        self.registered = {}
+        self.shape_sets = LRUCache(max_entries)
+        self.choppers = LRUCache(max_entries)
+        self.rasters = LRUCache(max_entries, on_evict=SharedHandle.evict)
+        self.netcdfs = LRUCache(max_entries, on_evict=SharedHandle.evict)
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.disk_cache = None
+        if cache_dir is not None:
+            self.disk_cache = ZoneCache(cache_dir, cache_size)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def check_path(self, path):
+        """Raise a PermissionError for a path outside the roots."""
+        real = os.path.realpath(path)
+        if not any(os.path.commonpath([root, real]) == root
+                   for root in self.roots):
+            raise PermissionError(f'{path} is not under the served '
+                                  f'directories!')
+        return path
+
+    def register(self, name, shape_archive):
+        """Name a shape archive and load it into the cache."""
+        _, shape_df = self.get_shapes(shape_archive)
+        self.registered[name] = shape_archive
+        return {'name': name, 'zones': len(shape_df),
+                'columns': [c for c in shape_df.columns if c != 'geometry']}
+
+    def get_shapes(self, shapes):
+        """Get the (key, GeoDataFrame) of a registered name or archive."""
+        shape_archive = self.registered.get(shapes)
+        if shape_archive is None:
+            shape_archive = self.check_path(shapes)
+        key = file_key(shape_archive)
+        return key, self.shape_sets.get(
+            key, partial(self.load_shapes, shape_archive))
+
+    def load_shapes(self, shape_archive):
+        """Load a shape archive from the disk cache or by extracting it."""
+        logger.info(f'Loading {shape_archive}')
+        if self.disk_cache is None:
+            return read_shape_archive(shape_archive)
+        archive_key = self.disk_cache.archive_key(shape_archive)
+        shape_df = self.disk_cache.get(archive_key, 'shapes')
+        if shape_df is None:
+            shape_df = read_shape_archive(shape_archive)
+            self.disk_cache.put(archive_key, 'shapes', shape_df)
+        shape_df.attrs['archive_key'] = archive_key
+        return shape_df
+
+    def options(self, request):
+        """Get the zone index options of a request, checking them."""
+        engine = request.get('engine', 'zones')
+        if engine not in ENGINES:
+            raise RuntimeError(f'Engine {engine} is not acceptable, use one '
+                               f'of {", ".join(ENGINES)}!')
+        crs_mode = request.get('crs_mode', 'shapes')
+        check_crs_mode(crs_mode)
+        return {'engine': engine,
+                'all_touched': bool(request.get('all_touched', False)),
+                'crs_mode': crs_mode, 'cache_dir': self.cache_dir,
+                'cache_size': self.cache_size}
+
+    def raster_stats(self, shape_key, shape_df, request, statistics):
+        """Compute the stats of a raster with a Choppy, one row per zone."""
+        raster = self.check_path(request['raster'])
+        options = self.options(request)
+        raster_key = file_key(raster)
+        # Choppy has no zones engine, its stream engine uses a zone index
+        if options['engine'] == 'zones':
+            options['engine'] = 'stream'
+        choppy = self.choppers.get(
+            (shape_key, raster_key, options['engine'],
+             options['all_touched'], options['crs_mode']),
+            partial(Choppy, shape_df, raster, output_format='none',
+                    **options))
+        if choppy.engine == 'coverage':
+            statistics = choppy.weighted_stats(statistics)
+        with self.rasters.hold(raster_key,
+                               partial(RasterHandle, raster)) as handle:
+            stats = choppy.index_stats(statistics, handle,
+                                       request.get('band', 1))
+        return choppy.stats_frame(stats)
+
+    def netcdf_stats(self, shape_key, shape_df, request, statistics):
+        """Compute the stats of NetCDF times, one row per zone and time."""
+        nc_file = self.check_path(request['netcdf'])
+        options = self.options(request)
+        options['nodata'] = request.get('nodata')
+        time_var = request.get('time_var', 'time')
+        key = (shape_key, file_key(nc_file), options['engine'],
+               options['all_touched'], options['crs_mode'],
+               options['nodata'])
+        with self.netcdfs.hold(key, partial(NetCDFHandle, shape_df, nc_file,
+                                            **options)) as handle:
+            chopper = handle.chopper
+            nc_times = chopper.nc_ds[time_var].values
+            if request.get('times') is not None:
+                nc_times = chopper.nc_ds[time_var].sel(
+                    {time_var: request['times']}).values
+            statistics = chopper.select_stats(statistics)
+            with handle.lock:
+                stats_list = list(chopper.time_stats(
+                    nc_times, statistics, time_var,
+                    request.get('variable', 'scpdsi')))
+        return pd.concat([chopper.time_frame(nc_time, pd.DataFrame(stats))
+                          for nc_time, stats in zip(nc_times, stats_list)],
+                         ignore_index=True)
+
+    def stats(self, request):
+        """Compute the stats a request asks for as a DataFrame."""
+        shape_key, shape_df = self.get_shapes(request['shapes'])
+        statistics = parse_stats(request.get('stats', DEFAULT_STATS))
+        if 'raster' in request:
+            return self.raster_stats(shape_key, shape_df, request,
+                                     statistics)
+        if 'netcdf' in request:
+            return self.netcdf_stats(shape_key, shape_df, request,
+                                     statistics)
+        raise RuntimeError('A request needs a raster or a netcdf!')
+
+    def submit(self, request):
+        """Compute a request on the worker pool, returning a future."""
+        return self.pool.submit(self.stats, request)
+
+    def info(self):
+        """Get the state of the caches."""
+        return {'registered': self.registered,
+                'shapes': self.shape_sets.info(),
+                'choppers': self.choppers.info(),
+                'rasters': self.rasters.info(),
+                'netcdfs': self.netcdfs.info()}
+
+
+def encode_frame(df, output_format='json'):
+    """Encode a DataFrame of stats as JSON records or an Arrow stream."""
+    if output_format == 'arrow':
+        import pyarrow as pa_arrow
+        table = pa_arrow.Table.from_pandas(df, preserve_index=False)
+        sink = pa_arrow.BufferOutputStream()
+        with pa_arrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), ARROW_TYPE
+    if output_format != 'json':
+        raise RuntimeError(f'Format {output_format} is not acceptable!')
+    return (df.to_json(orient='records', date_format='iso').encode(),
+            'application/json')
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """Answer the HTTP requests of a ZonalStatsService."""
+
+    def do_GET(self):
+        """Report the health and caches of the service."""
+        if self.path.rstrip('/') in ['', '/health']:
+            return self.send_json(200, {'status': 'ok',
+                                        **self.server.service.info()})
+        return self.send_json(404, {'error': f'No route {self.path}'})
+
+    def do_POST(self):
+        """Register shapes or compute stats."""
+        service = self.server.service
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if self.path == '/register':
+                return self.send_json(200, service.register(
+                    request['name'], request['shape_archive']))
+            if self.path == '/stats':
+                df = service.submit(request).result()
+                body, content_type = encode_frame(
+                    df, request.get('format', 'json'))
+                return self.send_body(200, body, content_type)
+            return self.send_json(404, {'error': f'No route {self.path}'})
+        except PermissionError as error:
+            return self.send_json(403, {'error': repr(error)})
+        except (KeyError, ValueError, RuntimeError,
+                FileNotFoundError) as error:
+            return self.send_json(400, {'error': repr(error)})
+        except Exception as error:
+            logger.exception('Request failed')
+            return self.send_json(500, {'error': repr(error)})
+
+    def send_json(self, status, payload):
+        """Send a JSON response."""
+        self.send_body(status, json.dumps(payload, default=str).encode(),
+                       'application/json')
+
+    def send_body(self, status, body, content_type):
+        """Send a response body."""
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        """Name the client, which has no address on a Unix socket."""
+        return str(self.client_address[0]) if self.client_address \
+            else 'unix'
+
+    def log_message(self, format, *args):
+        """Log requests through the choppy logger."""
+        logger.info(f'{self.address_string()} {format % args}')
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    """Serve HTTP on a Unix socket, a thread per connection."""
+
+    daemon_threads = True
+
+
+def serve(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    """Serve a ZonalStatsService until interrupted."""
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, ServiceHandler)
+        where = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), ServiceHandler)
+        where = f'http://{host}:{port}'
+    server.service = service
+    logger.info(f'Serving zonal stats on {where}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.pool.shutdown()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return server
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Mergeable per-zone statistics for block, tile and worker partitioned runs.
+
+Every partial result is a ``ZoneState`` that can be merged with the state of
+the same zone from another block or worker. Moments (count, sum, mean, std,
+min, max) merge exactly with the Chan et al. update; a state keeping its
+blocks replays them on merge, so merging such states in block order gives
+the same floats as adding the blocks to one state. Order statistics
+(median, percentiles, majority, minority, unique) come from a value-count
+histogram bounded by ``max_bins``; past the bound the histogram collapses
+into a ``QuantileSketch`` and those statistics are flagged approximate.
+Float values rarely repeat, so their histogram is bounded by the sketch
+size instead and a zone never holds more than a sketch.
+"""
+import numpy as np
+try:
+    from choppyzs.zones import (DEFAULT_STATS, ORDER_STATS, REPORT_ORDER,
+                                get_percentile, parse_stats)
+except ImportError:
+    from .zones import (DEFAULT_STATS, ORDER_STATS, REPORT_ORDER,
+                        get_percentile, parse_stats)
+
+DEFAULT_MAX_BINS = 2 ** 16
+DEFAULT_SKETCH_SIZE = 1024
+
+
+def needs_histogram(statistics):
+    """Check if any of the statistics need the value distribution."""
+    return any(stat in ORDER_STATS or stat.startswith('percentile_')
+               for stat in parse_stats(statistics))
+
+
+def merge_counts(values, counts):
+    """Merge repeated values, returning sorted unique values and counts."""
+    values, inverse = np.unique(values, return_inverse=True)
+    return values, np.bincount(inverse.ravel(), weights=counts,
+                               minlength=values.size)
+
+
+def rank_value(values, cumulative, rank):
+    """Get the value at a 0-based rank of a sorted value-count pair."""
+    return float(values[np.searchsorted(cumulative, rank, side='right')])
+
+
+class QuantileSketch():
+    """Approximate, mergeable distribution of weighted centroids.
+
+    Centroids are kept sorted; when there are more than twice ``size`` of
+    them, neighbours are averaged into ``size`` groups of equal weight.
+    """
+
+    def __init__(self, size=DEFAULT_SKETCH_SIZE):
+        """Initialize an empty sketch."""
+        self.size = size
+        self.values = np.empty(0)
+        self.weights = np.empty(0)
+
+    def add(self, values, weights):
+        """Add values with their weights to the sketch."""
+        values = np.concatenate([self.values, np.asarray(values, float)])
+        weights = np.concatenate([self.weights, np.asarray(weights, float)])
+        order = np.argsort(values, kind='stable')
+        self.values, self.weights = values[order], weights[order]
+        if self.values.size > 2 * self.size:
+            self.compress()
+
+    def merge(self, other):
+        """Merge another sketch into this one."""
+        self.add(other.values, other.weights)
+        return self
+
+    def compress(self):
+        """Average neighbouring centroids into ``size`` equal-weight groups."""
+        cumulative = np.cumsum(self.weights)
+        groups = np.minimum(
+            ((cumulative - self.weights / 2) / cumulative[-1]
+             * self.size).astype(np.int64), self.size - 1)
+        weights = np.bincount(groups, weights=self.weights,
+                              minlength=self.size)
+        totals = np.bincount(groups, weights=self.values * self.weights,
+                             minlength=self.size)
+        keep = weights > 0
+        self.values = totals[keep] / weights[keep]
+        self.weights = weights[keep]
+
+    def quantile(self, q, minimum, maximum):
+        """Estimate a percentile, interpolating between centroid midpoints."""
+        cumulative = np.cumsum(self.weights)
+        total = cumulative[-1]
+        midpoints = (cumulative - self.weights / 2) / total
+        points = np.concatenate([[0.0], midpoints, [1.0]])
+        values = np.concatenate([[minimum], self.values, [maximum]])
+        return float(np.interp(q / 100.0, points, values))
+
+
+class ZoneState():
+    """Mergeable statistics state of one zone."""
+
+    def __init__(self, histogram=True, max_bins=DEFAULT_MAX_BINS,
+                 sketch_size=DEFAULT_SKETCH_SIZE, keep_blocks=False):
+        """Initialize an empty zone state.
+
+        ``histogram`` turns off the value distribution when only moments are
+        needed. A ``sketch_size`` of None raises instead of approximating
+        once the histogram passes ``max_bins`` distinct values, otherwise
+        float values collapse past ``sketch_size`` distinct values. With
+        ``keep_blocks`` the moments of every block added are kept for
+        ``merge`` to replay.
+        """
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.nodata = 0
+        self.nan = 0
+        self.histogram = histogram
+        self.max_bins = max_bins
+        self.sketch_size = sketch_size
+        self.floating = False
+        self.values = np.empty(0)
+        self.counts = np.empty(0)
+        self.sketch = None
+        self.blocks = [] if keep_blocks else None
+
+    @property
+    def approximate(self):
+        """Check if the order statistics are approximate."""
+        return self.sketch is not None
+
+    def add(self, values, nodata=None):
+        """Add the pixel values of the zone from one block."""
+        invalid = np.zeros(values.shape, dtype=bool)
+        if nodata is not None:
+            invalid |= values == nodata
+            self.nodata += int(invalid.sum())
+        if np.issubdtype(values.dtype, np.floating):
+            self.floating = True
+            isnan = np.isnan(values)
+            self.nan += int(isnan.sum())
+            invalid |= isnan
+        values = values[~invalid]
+        if not values.size:
+            return self
+        if np.issubdtype(values.dtype, np.integer):
+            values = values.astype(np.int64)
+        block = ZoneState(histogram=False)
+        block.count = int(values.size)
+        block.total = float(values.sum())
+        block.mean = block.total / block.count
+        block.m2 = float(((values - block.mean) ** 2).sum())
+        block.minimum = values.min()
+        block.maximum = values.max()
+        self._merge_moments(block)
+        if self.blocks is not None:
+            self.blocks.append(block)
+        if self.histogram:
+            self._add_counts(*np.unique(values, return_counts=True))
+        return self
+
+    def merge(self, other):
+        """Merge the state of the same zone from another block or worker.
+
+        The blocks the other state kept are merged one by one.
+        """
+        self.nodata += other.nodata
+        self.nan += other.nan
+        self.floating |= other.floating
+        if not other.count:
+            return self
+        for block in other.blocks or [other]:
+            self._merge_moments(block)
+        if self.histogram:
+            if other.sketch is not None:
+                self._to_sketch()
+                self.sketch.merge(other.sketch)
+            else:
+                self._add_counts(other.values, other.counts)
+        return self
+
+    def _merge_moments(self, other):
+        """Merge count, sum, mean, M2, min and max (Chan et al.)."""
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.total += other.total
+        self.minimum = (other.minimum if self.minimum is None
+                        else min(self.minimum, other.minimum))
+        self.maximum = (other.maximum if self.maximum is None
+                        else max(self.maximum, other.maximum))
+
+    def _add_counts(self, values, counts):
+        """Merge value counts into the histogram or sketch."""
+        if self.sketch is not None:
+            self.sketch.add(values, counts)
+            return
+        self.values, self.counts = merge_counts(
+            np.concatenate([self.values, values]),
+            np.concatenate([self.counts, counts]))
+        max_bins = self.max_bins
+        if self.floating and self.sketch_size:
+            max_bins = (self.sketch_size if max_bins is None
+                        else min(max_bins, self.sketch_size))
+        if max_bins is not None and self.values.size > max_bins:
+            if self.sketch_size is None:
+                raise RuntimeError(f'A zone has more than {self.max_bins} '
+                                   f'distinct values, raise max_bins or use '
+                                   f'a quantile sketch')
+            self._to_sketch()
+
+    def _to_sketch(self):
+        """Collapse the histogram into a quantile sketch."""
+        if self.sketch is None:
+            self.sketch = QuantileSketch(self.sketch_size
+                                         or DEFAULT_SKETCH_SIZE)
+            self.sketch.add(self.values, self.counts)
+            self.values = np.empty(0)
+            self.counts = np.empty(0)
+
+    def stats(self, statistics=DEFAULT_STATS):
+        """Compute the statistics in the same form as rasterstats."""
+        statistics = parse_stats(statistics)
+        ordered = ([s for s in REPORT_ORDER if s in statistics]
+                   + [s for s in statistics if s not in REPORT_ORDER])
+        record = {}
+        for stat in ordered:
+            if stat == 'nodata':
+                record[stat] = float(self.nodata)
+            elif stat == 'nan':
+                record[stat] = float(self.nan)
+            elif stat == 'count':
+                record[stat] = self.count
+            elif self.count == 0:
+                record[stat] = None
+            else:
+                record[stat] = self._stat(stat)
+        return record
+
+    def _stat(self, stat):
+        """Compute one statistic of a zone with values."""
+        if stat == 'min':
+            return float(self.minimum)
+        if stat == 'max':
+            return float(self.maximum)
+        if stat == 'range':
+            return float(self.maximum) - float(self.minimum)
+        if stat == 'sum':
+            return float(self.total)
+        if stat == 'mean':
+            return float(self.total / self.count)
+        if stat == 'std':
+            return float(np.sqrt(self.m2 / self.count))
+        if not self.histogram:
+            raise RuntimeError(f'{stat} needs the zone histogram')
+        if self.sketch is not None:
+            return self._sketch_stat(stat)
+        if stat == 'majority':
+            return float(self.values[np.argmax(self.counts)])
+        if stat == 'minority':
+            return float(self.values[np.argmin(self.counts)])
+        if stat == 'unique':
+            return int(self.values.size)
+        q = 50.0 if stat == 'median' else get_percentile(stat)
+        position = (self.count - 1) * q / 100.0
+        cumulative = np.cumsum(self.counts)
+        lower = rank_value(self.values, cumulative, np.floor(position))
+        upper = rank_value(self.values, cumulative, np.ceil(position))
+        return lower + (upper - lower) * (position - np.floor(position))
+
+    def _sketch_stat(self, stat):
+        """Estimate an order statistic from the quantile sketch."""
+        if stat == 'majority':
+            return float(self.sketch.values[np.argmax(self.sketch.weights)])
+        if stat == 'minority':
+            return float(self.sketch.values[np.argmin(self.sketch.weights)])
+        if stat == 'unique':
+            return None
+        q = 50.0 if stat == 'median' else get_percentile(stat)
+        return self.sketch.quantile(q, float(self.minimum),
+                                    float(self.maximum))
+
+
+def approximate_stats(statistics):
+    """List the statistics that are approximate when a zone is sketched."""
+    return [stat for stat in parse_stats(statistics)
+            if stat in ORDER_STATS or stat.startswith('percentile_')]
+
+
+def states_to_records(states, statistics=DEFAULT_STATS):
+    """Convert zone states into rasterstats-like records.
+
+    When any zone was sketched every record gets an ``approximate`` entry
+    naming its approximate statistics (empty for exact zones).
+    """
+    records = [state.stats(statistics) for state in states]
+    if any(state.approximate for state in states):
+        flagged = ','.join(approximate_stats(statistics))
+        for record, state in zip(records, states):
+            record['approximate'] = flagged if state.approximate else ''
+    return records
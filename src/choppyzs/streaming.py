@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Stream a raster block by block and accumulate zonal statistics."""
+import threading
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+try:
+    from choppyzs.pipeline import Pipeline, DEFAULT_BLOCK_BUDGET
+    from choppyzs.planner import plan_windows, tile_windows
+    from choppyzs.stats import (ZoneState, DEFAULT_MAX_BINS,
+                                DEFAULT_SKETCH_SIZE, needs_histogram,
+                                states_to_records)
+    from choppyzs.zones import (DEFAULT_STATS, geometry_extents,
+                                iter_geometries, parse_stats,
+                                rasterize_extent)
+except ImportError:
+    from .pipeline import Pipeline, DEFAULT_BLOCK_BUDGET
+    from .planner import plan_windows, tile_windows
+    from .stats import (ZoneState, DEFAULT_MAX_BINS, DEFAULT_SKETCH_SIZE,
+                        needs_histogram, states_to_records)
+    from .zones import (DEFAULT_STATS, geometry_extents, iter_geometries,
+                        parse_stats, rasterize_extent)
+
+
+def block_windows(src, block_budget=DEFAULT_BLOCK_BUDGET, band=1):
+    """Yield windows in the raster's native block order within a budget.
+
+    Whole rows of blocks are grouped while they fit in ``block_budget``
+    bytes, otherwise each row of blocks is split into runs of blocks.
+    """
+    yield from tile_windows(Window(0, 0, src.width, src.height),
+                            src.block_shapes[band - 1],
+                            np.dtype(src.dtypes[band - 1]).itemsize,
+                            block_budget)
+
+
+def stream_windows(raster_file, geoms, windows, statistics=DEFAULT_STATS,
+                   all_touched=False, band=1, nodata=None,
+                   max_bins=DEFAULT_MAX_BINS,
+                   sketch_size=DEFAULT_SKETCH_SIZE, profiler=None,
+                   pipeline=None, keep_blocks=False):
+    """Accumulate the zone states of the geometries over some windows.
+
+    Each window is read once; every zone overlapping it is rasterized on
+    the overlap and its pixels are added to the zone's state. Windows no
+    zone overlaps are not read. Through the ``pipeline`` the next windows
+    are read (each reader thread with its own handle) while the zones of
+    the current ones are rasterized, and the pixels are added to the
+    states in window order. The windows read are counted on the
+    ``profiler`` when one is given. With ``keep_blocks`` the states keep
+    the moments of every window for an exact merge (see ZoneState).
+    """
+    pipeline = Pipeline() if pipeline is None else pipeline
+    histogram = needs_histogram(statistics)
+    states = [ZoneState(histogram=histogram, max_bins=max_bins,
+                        sketch_size=sketch_size, keep_blocks=keep_blocks)
+              for _ in geoms]
+    with rio.open(raster_file) as src:
+        nodata = src.nodata if nodata is None else nodata
+        transform = src.transform
+        extents = geometry_extents(geoms, transform, src.shape)
+    zones = np.array([i for i, ext in enumerate(extents)
+                      if ext is not None], dtype=np.int64)
+    bounds = np.array([extents[i] for i in zones],
+                      dtype=np.int64).reshape(-1, 4)
+    reads = []
+    for window in windows:
+        hits = ((bounds[:, 0] < window.row_off + window.height)
+                & (bounds[:, 1] > window.row_off)
+                & (bounds[:, 2] < window.col_off + window.width)
+                & (bounds[:, 3] > window.col_off))
+        if hits.any():
+            reads.append((window, hits))
+    handles = threading.local()
+    opened = []
+
+    def read(item):
+        window, hits = item
+        if not hasattr(handles, 'src'):
+            handles.src = rio.open(raster_file)
+            opened.append(handles.src)
+        data = handles.src.read(band, window=window)
+        if profiler is not None:
+            profiler.count_array(data, name='read')
+        return window, hits, data
+
+    def compute(loaded):
+        window, hits, data = loaded
+        row_stop = window.row_off + window.height
+        col_stop = window.col_off + window.width
+        values = []
+        for zone, (r0, r1, c0, c1) in zip(zones[hits], bounds[hits]):
+            extent = (max(r0, window.row_off), min(r1, row_stop),
+                      max(c0, window.col_off), min(c1, col_stop))
+            mask = rasterize_extent(geoms[zone], extent, transform,
+                                    all_touched)
+            block = data[extent[0] - window.row_off:
+                         extent[1] - window.row_off,
+                         extent[2] - window.col_off:
+                         extent[3] - window.col_off]
+            values.append((zone, block[mask]))
+        return values
+
+    def write(values):
+        for zone, zone_values in values:
+            states[zone].add(zone_values, nodata)
+
+    try:
+        pipeline.run(reads, read, compute, write)
+    finally:
+        for handle in opened:
+            handle.close()
+    return states
+
+
+def stream_zonal_stats(shapes, raster_file, statistics=DEFAULT_STATS,
+                       all_touched=False, block_budget=DEFAULT_BLOCK_BUDGET,
+                       band=1, nodata=None, max_bins=DEFAULT_MAX_BINS,
+                       sketch_size=DEFAULT_SKETCH_SIZE, profiler=None,
+                       pipeline=None):
+    """Compute zonal statistics walking the raster once in block order.
+
+    Only the windows planned over the zones are read (see
+    choppyzs.planner), so the reads follow the area the zones cover
+    rather than the raster size or the number of zones. Peak memory
+    follows ``block_budget`` instead of the largest zone. The
+    order statistics are exact unless a zone has more than ``max_bins``
+    distinct values, in which case they are flagged approximate.
+    """
+    statistics = parse_stats(statistics)
+    geoms = list(iter_geometries(shapes))
+    with rio.open(raster_file) as src:
+        windows = plan_windows(src, geoms, block_budget, band)
+    states = stream_windows(raster_file, geoms, windows, statistics,
+                            all_touched, band, nodata, max_bins, sketch_size,
+                            profiler, pipeline)
+    return states_to_records(states, statistics)
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Write zonal statistics incrementally as Parquet, Feather or NetCDF.
+
+The zone attributes are written once, keyed by ``zone_id``, and the stats
+are appended one step (a time, or a raster of a batch) at a time in row
+groups, or along an unlimited step dimension for NetCDF, so no run has to
+hold every step. Parquet and Feather stats are a dataset directory with a
+part file per run, so appending only writes the new steps; the whole
+tables of a single raster are written the same way, as a directory with
+one part.
+
+The run configuration is stored as JSON metadata (``choppy``) so a later
+run can append the missing steps to the same file.
+"""
+import os
+import re
+import json
+import numpy as np
+import pandas as pd
+
+STREAM_FORMATS = ['parquet', 'feather', 'netcdf']
+EXTENSIONS = {'netcdf': 'nc'}
+DEFAULT_ROW_GROUP_SIZE = 2 ** 17
+EPOCH_UNITS = 'seconds since 1970-01-01 00:00:00'
+METADATA_KEY = 'choppy'
+PART_NAME = 'part-{:05d}.{}'
+
+
+def output_extension(output_format):
+    """Get the file extension of an output format."""
+    return EXTENSIONS.get(output_format, output_format)
+
+
+def zones_path(output_path):
+    """Get the path of the zone attribute table next to the stats."""
+    stem, extension = os.path.splitext(output_path)
+    return f'{stem}_zones{extension}'
+
+
+def zone_attributes(shape_df, geometry=False):
+    """Get the zone attribute table keyed by zone_id."""
+    attributes = pd.DataFrame(shape_df).reset_index(drop=True)
+    if 'geometry' in attributes:
+        if geometry:
+            attributes['geometry'] = [
+                None if geom is None else geom.wkb
+                for geom in attributes['geometry']]
+        else:
+            attributes = attributes.drop(columns='geometry')
+    attributes.insert(0, 'zone_id', np.arange(len(attributes)))
+    return attributes
+
+
+def time_column(nc_time, size):
+    """Repeat a time step into a column Arrow can store."""
+    if isinstance(nc_time, np.datetime64) or nc_time is None:
+        return np.repeat(np.datetime64(nc_time, 'ns'), size)
+    return np.repeat(str(nc_time), size)
+
+
+def step_key(step):
+    """Get a comparable key of a step (a time or a raster id)."""
+    if isinstance(step, (np.datetime64, pd.Timestamp)):
+        return str(np.datetime64(step, 'ns'))
+    return str(step)
+
+
+def part_numbers(output_path, output_format):
+    """List the numbers of the part files of a dataset directory."""
+    if not os.path.isdir(output_path):
+        return []
+    pattern = re.compile(r'part-(\d+)\.' + re.escape(output_format) + '$')
+    return sorted(int(match.group(1)) for match in
+                  map(pattern.match, os.listdir(output_path)) if match)
+
+
+def new_part(output_path, output_format, append=False):
+    """Get the path of the next part file of a dataset directory.
+
+    A single file output of older runs is moved in as the first part when
+    appending, without ``append`` it and the old parts are removed.
+    """
+    if os.path.isfile(output_path):
+        if append:
+            single = f'{output_path}.part'
+            os.replace(output_path, single)
+            os.makedirs(output_path)
+            os.replace(single, os.path.join(
+                output_path, PART_NAME.format(0, output_format)))
+        else:
+            os.remove(output_path)
+    numbers = part_numbers(output_path, output_format)
+    if not append:
+        for number in numbers:
+            os.remove(os.path.join(output_path,
+                                   PART_NAME.format(number, output_format)))
+        numbers = []
+    os.makedirs(output_path, exist_ok=True)
+    return os.path.join(output_path, PART_NAME.format(
+        numbers[-1] + 1 if numbers else 0, output_format))
+
+
+def hidden_path(part):
+    """Get the hidden path a part is written at until it is complete."""
+    return os.path.join(os.path.dirname(part),
+                        f'.{os.path.basename(part)}')
+
+
+def read_dataset(output_format, output_path):
+    """Open the stats of a part file directory (or a single file)."""
+    import pyarrow.dataset as ds
+    return ds.dataset(output_path, format=output_format)
+
+
+def read_steps(output_format, output_path, step_name='time'):
+    """Read the configuration and step keys of an existing output.
+
+    Returns (None, []) when there is no output yet.
+    """
+    if output_format == 'netcdf':
+        if not os.path.isfile(output_path):
+            return None, []
+        return read_netcdf_steps(output_path, step_name)
+    if output_format not in ['parquet', 'feather']:
+        raise RuntimeError(f'Format {output_format} can not be appended!')
+    if not os.path.isfile(output_path) and \
+            not part_numbers(output_path, output_format):
+        return None, []
+    dataset = read_dataset(output_format, output_path)
+    table = dataset.to_table(columns=[step_name])
+    metadata = (dataset.schema.metadata or {}).get(METADATA_KEY.encode())
+    steps = table.column(step_name).to_pandas().unique()
+    return (None if metadata is None else json.loads(metadata),
+            [step_key(step) for step in steps])
+
+
+def read_netcdf_steps(output_path, step_name='time'):
+    """Read the configuration and step keys of a NetCDF output."""
+    import netCDF4
+    with netCDF4.Dataset(output_path) as dataset:
+        metadata = getattr(dataset, METADATA_KEY, None)
+        metadata = None if metadata is None else json.loads(metadata)
+        if step_name not in dataset.variables:
+            return metadata, []
+        variable = dataset.variables[step_name]
+        values = variable[:]
+        if variable.dtype == str:
+            return metadata, [str(step) for step in values]
+        if variable.units == EPOCH_UNITS:
+            steps = np.datetime64('1970-01-01', 'ns') + \
+                (np.asarray(values) * 1e9).astype('timedelta64[ns]')
+        else:
+            import cftime
+            steps = cftime.num2date(values, variable.units,
+                                    variable.calendar)
+    return metadata, [step_key(step) for step in steps]
+
+
+class ArrowStatsWriter():
+    """Write stats to a Parquet or Feather dataset directory in row groups.
+
+    Each run writes one part file of the ``output_path`` directory, moved
+    in place on close. With ``append`` the steps go to a new part next to
+    the existing ones (a single file output is moved in as the first
+    part) and the zone attribute table is kept; otherwise the existing
+    parts are replaced.
+    """
+
+    def __init__(self, output_path, attributes, output_format='parquet',
+                 row_group_size=DEFAULT_ROW_GROUP_SIZE, step_name='time',
+                 metadata=None, append=False):
+        """Initialize the writer and write the zone attribute table."""
+        import pyarrow as pa
+        self.pa = pa
+        self.output_path = output_path
+        self.step_name = step_name
+        self.output_format = output_format
+        self.row_group_size = row_group_size
+        self.metadata = metadata
+        self.append = append and (
+            os.path.isfile(output_path)
+            or bool(part_numbers(output_path, output_format)))
+        self.n_zones = len(attributes)
+        self.buffer = []
+        self.buffered = 0
+        self.writer = None
+        if self.append and os.path.isfile(zones_path(output_path)):
+            return
+        self.write_table(pa.Table.from_pandas(attributes,
+                                              preserve_index=False),
+                         zones_path(output_path))
+
+    def write_table(self, table, path):
+        """Write a whole table in the writer's format."""
+        if self.output_format == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, path)
+        else:
+            import pyarrow.feather as feather
+            feather.write_feather(table, path)
+
+    def open(self, schema):
+        """Open the stats file for the schema of the first row group."""
+        if self.metadata is not None:
+            schema = schema.with_metadata(
+                {METADATA_KEY: json.dumps(self.metadata)})
+        if self.append:
+            schema = read_dataset(self.output_format,
+                                  self.output_path).schema
+        self.part = new_part(self.output_path, self.output_format,
+                             self.append)
+        # parts are hidden from readers until they are complete
+        path = self.partial = hidden_path(self.part)
+        if self.output_format == 'parquet':
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(path, schema)
+        else:
+            import pyarrow.ipc as ipc
+            writer = ipc.new_file(path, schema)
+        self.schema = schema
+        return writer
+
+    def write_batches(self, writer, batches):
+        """Write record batches as one row group."""
+        if self.output_format == 'parquet':
+            writer.write_table(self.pa.Table.from_batches(batches))
+        else:
+            for batch in batches:
+                writer.write_batch(batch)
+
+    def write(self, stats, nc_time=None):
+        """Buffer the stats of one step, one row per zone."""
+        stats = pd.DataFrame(stats).reset_index(drop=True)
+        stats.insert(0, 'zone_id', np.arange(len(stats)))
+        if nc_time is not None:
+            stats.insert(1, self.step_name,
+                         time_column(nc_time, len(stats)))
+        self.buffer.append(stats)
+        self.buffered += len(stats)
+        if self.buffered >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered time steps as one row group."""
+        if not self.buffer:
+            return
+        frame = pd.concat(self.buffer, ignore_index=True)
+        table = self.pa.Table.from_pandas(frame, preserve_index=False)
+        if self.writer is None:
+            self.writer = self.open(table.schema)
+        table = table.cast(self.schema)
+        self.write_batches(self.writer, table.to_batches())
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        """Flush the remaining time steps and close the file."""
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            os.replace(self.partial, self.part)
+
+
+class NetCDFStatsWriter():
+    """Append stats as (zone, time) variables of a NetCDF.
+
+    With ``append`` an existing NetCDF is opened and the steps continue
+    along its unlimited step dimension.
+    """
+
+    def __init__(self, output_path, attributes, step_name='time',
+                 metadata=None, append=False):
+        """Initialize the NetCDF with the zone dimension and attributes."""
+        import netCDF4
+        self.output_path = output_path
+        self.step_name = step_name
+        if append and os.path.isfile(output_path):
+            self.dataset = netCDF4.Dataset(output_path, 'a')
+            self.n_times = len(self.dataset.dimensions[step_name])
+            self.variables = {
+                name: variable
+                for name, variable in self.dataset.variables.items()
+                if variable.dimensions == ('zone', step_name)}
+            self.time = self.dataset.variables.get(step_name)
+            return
+        self.dataset = netCDF4.Dataset(output_path, 'w')
+        if metadata is not None:
+            self.dataset.setncattr(METADATA_KEY, json.dumps(metadata))
+        self.dataset.createDimension('zone', len(attributes))
+        self.dataset.createDimension(step_name, None)
+        self.n_times = 0
+        self.variables = {}
+        self.time = None
+        for column in attributes:
+            values = attributes[column]
+            if column == 'geometry':
+                values = values.map(lambda wkb: '' if wkb is None
+                                    else wkb.hex())
+            if pd.api.types.is_numeric_dtype(values):
+                variable = self.dataset.createVariable(column, values.dtype,
+                                                       ('zone',))
+                variable[:] = values.to_numpy()
+            else:
+                variable = self.dataset.createVariable(column, str,
+                                                       ('zone',))
+                variable[:] = values.astype(str).to_numpy(dtype=object)
+
+    def write(self, stats, nc_time=None):
+        """Write the stats of one time step along the time dimension."""
+        stats = pd.DataFrame(stats)
+        if self.time is None:
+            self.time = self.create_time(nc_time)
+        for column in stats:
+            values = pd.to_numeric(stats[column], errors='coerce')
+            if column not in self.variables:
+                if values.isna().all() and stats[column].notna().any():
+                    continue
+                self.variables[column] = self.dataset.createVariable(
+                    column, 'f8', ('zone', self.step_name),
+                    fill_value=np.nan)
+            self.variables[column][:, self.n_times] = \
+                values.to_numpy(dtype=float)
+        if self.time is not False:
+            self.time[self.n_times] = self.encode_time(nc_time)
+        self.n_times += 1
+
+    def create_time(self, nc_time):
+        """Create the step coordinate for the type of the first step."""
+        if nc_time is None:
+            return False
+        if isinstance(nc_time, str):
+            return self.dataset.createVariable(self.step_name, str,
+                                               (self.step_name,))
+        time = self.dataset.createVariable(self.step_name, 'f8',
+                                           (self.step_name,))
+        if isinstance(nc_time, np.datetime64):
+            time.units = EPOCH_UNITS
+            time.calendar = 'standard'
+        else:
+            time.units = f'days since {nc_time.__class__(1850, 1, 1)}'
+            time.calendar = nc_time.calendar
+        return time
+
+    def encode_time(self, nc_time):
+        """Encode a time step with the units of the time coordinate."""
+        if isinstance(nc_time, str):
+            return nc_time
+        if isinstance(nc_time, np.datetime64):
+            return (nc_time - np.datetime64('1970-01-01')) / \
+                np.timedelta64(1, 's')
+        import cftime
+        return cftime.date2num(nc_time, self.time.units, self.time.calendar)
+
+    def close(self):
+        """Close the NetCDF."""
+        self.dataset.close()
+
+
+def create_writer(output_format, output_path, attributes,
+                  row_group_size=DEFAULT_ROW_GROUP_SIZE, step_name='time',
+                  metadata=None, append=False):
+    """Create the incremental writer of an output format.
+
+    ``metadata`` is stored with the stats, with ``append`` the steps are
+    added to an existing output.
+    """
+    if output_format == 'netcdf':
+        return NetCDFStatsWriter(output_path, attributes, step_name,
+                                 metadata, append)
+    if output_format in ['parquet', 'feather']:
+        return ArrowStatsWriter(output_path, attributes, output_format,
+                                row_group_size, step_name, metadata, append)
+    raise RuntimeError(f'Format {output_format} can not be streamed!')
+
+
+def write_frame(df, output_format, output_path):
+    """Write a whole DataFrame of zonal stats in a columnar format.
+
+    Parquet and Feather are written as the only part of a dataset
+    directory, like the incremental writers do.
+    """
+    df = pd.DataFrame(df)
+    if 'geometry' in df:
+        df['geometry'] = [None if geom is None else geom.wkb
+                          for geom in df['geometry']]
+    if output_format in ['parquet', 'feather']:
+        part = new_part(output_path, output_format)
+        if output_format == 'parquet':
+            df.to_parquet(hidden_path(part), index=False)
+        else:
+            df.reset_index(drop=True).to_feather(hidden_path(part))
+        os.replace(hidden_path(part), part)
+    elif output_format == 'netcdf':
+        if 'geometry' in df:
+            df['geometry'] = df['geometry'].map(
+                lambda wkb: '' if wkb is None else wkb.hex())
+        df.rename_axis('zone').to_xarray().to_netcdf(output_path)
+    else:
+        raise RuntimeError(f'Format {output_format} is not columnar!')
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Rasterize zones once and compute zonal statistics with NumPy group-by."""
+import math
+import numpy as np
+from rasterio import features
+from rasterio.windows import Window, transform as window_transform
+
+DEFAULT_STATS = 'min,max,mean,median,majority,sum,std,count,range'
+VALID_STATS = ['count', 'min', 'max', 'mean', 'sum', 'std', 'median',
+               'majority', 'minority', 'unique', 'range', 'nodata', 'nan']
+# the order rasterstats reports the statistics in
+REPORT_ORDER = ['min', 'max', 'mean', 'count', 'sum', 'std', 'median',
+                'majority', 'minority', 'unique', 'range']
+CUBE_STATS = ['min', 'max', 'mean', 'sum', 'std', 'count', 'range']
+ORDER_STATS = ['median', 'majority', 'minority', 'unique']
+# rasterstats falls back to this nodata value for in-memory arrays
+ARRAY_NODATA = -999
+
+
+def parse_stats(statistics):
+    """Return the statistics as a list, validating every entry."""
+    if statistics is None:
+        statistics = DEFAULT_STATS
+    if isinstance(statistics, str):
+        statistics = statistics.split(',')
+    statistics = [stat.strip() for stat in statistics if stat.strip()]
+    for stat in statistics:
+        if stat not in VALID_STATS and not stat.startswith('percentile_'):
+            raise RuntimeError(f'Statistic {stat} is not acceptable!')
+    return statistics
+
+
+def split_stats(statistics, available):
+    """Split the statistics into those available and those skipped."""
+    statistics = parse_stats(statistics)
+    return ([stat for stat in statistics if stat in available],
+            [stat for stat in statistics if stat not in available])
+
+
+def get_percentile(stat):
+    """Get the percentile as a float from a percentile_<q> statistic."""
+    q = float(stat.replace('percentile_', '', 1))
+    if q < 0 or q > 100:
+        raise RuntimeError(f'Percentile {q} must be between 0 and 100')
+    return q
+
+
+def geometry_window(bounds, transform, shape):
+    """Get the (row, col) slices of a grid covering a bounding box."""
+    west, south, east, north = bounds
+    inverse = ~transform
+    cols, rows = zip(*[inverse * (x, y) for x in (west, east)
+                       for y in (south, north)])
+    row_start = max(int(math.floor(min(rows))), 0)
+    row_stop = min(int(math.ceil(max(rows))), shape[0])
+    col_start = max(int(math.floor(min(cols))), 0)
+    col_stop = min(int(math.ceil(max(cols))), shape[1])
+    return (row_start, row_stop), (col_start, col_stop)
+
+
+def geometry_extents(geoms, transform, shape):
+    """Get the (row_start, row_stop, col_start, col_stop) of geometries.
+
+    Geometries that are empty or fall outside of the grid get None.
+    """
+    extents = []
+    for geom in geoms:
+        if geom is None or geom.is_empty:
+            extents.append(None)
+            continue
+        (r0, r1), (c0, c1) = geometry_window(geom.bounds, transform, shape)
+        extents.append((r0, r1, c0, c1) if r1 > r0 and c1 > c0 else None)
+    return extents
+
+
+def rasterize_extent(geom, extent, transform, all_touched=False):
+    """Rasterize a geometry on the (r0, r1, c0, c1) extent of a grid."""
+    r0, r1, c0, c1 = extent
+    return features.rasterize(
+        [(geom, 1)], out_shape=(r1 - r0, c1 - c0),
+        transform=window_transform(Window(c0, r0, c1 - c0, r1 - r0),
+                                   transform),
+        fill=0, all_touched=all_touched, dtype='uint8').astype(bool)
+
+
+def iter_geometries(shapes):
+    """Yield the geometries of a GeoDataFrame, GeoSeries or sequence."""
+    shapes = getattr(shapes, 'geometry', shapes)
+    for geom in shapes:
+        yield geom
+
+
+class ZoneIndex():
+    """Burn zones into a label raster and per-zone pixel index lists.
+
+    The index is built once for a grid (affine and shape) and reused for any
+    array on that grid, e.g. every time step of a NetCDF. Pixel indices are
+    stored relative to ``window``, the smallest window covering every zone,
+    so only that window of a raster needs to be read. Overlapping zones keep
+    all of their pixels in the index lists; the label raster holds the last
+    zone burned for a pixel.
+    """
+
+    def __init__(self, shapes, transform, shape, all_touched=False):
+        """Initialize the ZoneIndex by rasterizing every zone."""
+        self.transform = transform
+        self.shape = tuple(shape)
+        self.all_touched = all_touched
+        geoms = list(iter_geometries(shapes))
+        self.n_zones = len(geoms)
+        extents = geometry_extents(geoms, transform, self.shape)
+        self.window = self._covering_window(extents)
+        row_off, col_off = self.window.row_off, self.window.col_off
+        width = self.window.width
+        pixel_lists = []
+        for geom, ext in zip(geoms, extents):
+            if ext is None:
+                pixel_lists.append(np.empty(0, dtype=np.int64))
+                continue
+            r0, r1, c0, c1 = ext
+            rows, cols = np.nonzero(rasterize_extent(geom, ext, transform,
+                                                     all_touched))
+            pixel_lists.append((rows + r0 - row_off).astype(np.int64) * width
+                               + (cols + c0 - col_off))
+        self._set_pixels(pixel_lists)
+
+    @staticmethod
+    def _covering_window(extents):
+        """Get the smallest window covering every zone extent."""
+        present = [ext for ext in extents if ext is not None]
+        if not present:
+            return Window(0, 0, 0, 0)
+        row_off = min(ext[0] for ext in present)
+        col_off = min(ext[2] for ext in present)
+        height = max(ext[1] for ext in present) - row_off
+        width = max(ext[3] for ext in present) - col_off
+        return Window(col_off, row_off, width, height)
+
+    def _set_pixels(self, pixel_lists):
+        """Store the per-zone window pixel lists and the label raster."""
+        counts = np.array([len(pix) for pix in pixel_lists], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.pixels = (np.concatenate(pixel_lists) if pixel_lists
+                       else np.empty(0, dtype=np.int64))
+        self.zones = np.repeat(np.arange(self.n_zones, dtype=np.int64),
+                               counts)
+        self.labels = np.zeros((self.window.height, self.window.width),
+                               dtype=np.int32)
+        self.labels.ravel()[self.pixels] = self.zones + 1
+
+    def __len__(self):
+        """Return the number of zones."""
+        return self.n_zones
+
+    def pixel_indices(self, zone):
+        """Return the flat window pixel indices of a zone."""
+        return self.pixels[self.offsets[zone]:self.offsets[zone + 1]]
+
+    @property
+    def slices(self):
+        """Return the (row, col) slices of the zone window on the grid."""
+        win = self.window
+        return (slice(win.row_off, win.row_off + win.height),
+                slice(win.col_off, win.col_off + win.width))
+
+    def subset(self, arr):
+        """Slice the zone window out of a full-grid or windowed array."""
+        win = self.window
+        if arr.shape[-2:] == self.shape:
+            arr = arr[(Ellipsis,) + self.slices]
+        elif arr.shape[-2:] != (win.height, win.width):
+            raise RuntimeError(f'Array shape {arr.shape} does not match the '
+                               f'grid {self.shape} or window {win}')
+        return np.ascontiguousarray(arr)
+
+    def stats(self, arr, statistics=DEFAULT_STATS, nodata=None):
+        """Compute statistics for every zone of a 2D array.
+
+        Returns a list with one dict per zone, matching the output of
+        ``rasterstats.zonal_stats``.
+        """
+        statistics = parse_stats(statistics)
+        values = self.subset(arr).ravel()[self.pixels]
+        invalid = np.zeros(values.shape, dtype=bool)
+        if nodata is not None:
+            invalid |= values == nodata
+        if np.issubdtype(values.dtype, np.floating):
+            isnan = np.isnan(values)
+            invalid |= isnan
+        else:
+            isnan = None
+        valid = ~invalid
+        if np.issubdtype(values.dtype, np.integer):
+            values = values.astype(np.int64)
+        return self._reduce(values[valid], self.zones[valid], statistics,
+                            extra=self._nodata_counts(values, isnan,
+                                                      statistics, nodata))
+
+    def cube_stats(self, cube, statistics=CUBE_STATS, nodata=None):
+        """Compute statistics for every zone and time of a (time, y, x) cube.
+
+        Every zone's pixels are gathered across the whole block at once and
+        reduced along the pixel axis. Returns a float array shaped
+        (zone, time, stat) with the stats in the order given; zones without
+        valid pixels get a count of 0 and NaN for the other stats.
+        """
+        statistics = parse_stats(statistics)
+        for stat in statistics:
+            if stat not in CUBE_STATS:
+                raise RuntimeError(f'Statistic {stat} is not available for '
+                                   f'whole cubes, use one of {CUBE_STATS}')
+        cube = self.subset(cube)
+        n_times = cube.shape[0]
+        values = cube.reshape(n_times, -1)[:, self.pixels]
+        values = values.astype(np.float64, copy=False)
+        valid = ~np.isnan(values)
+        if nodata is not None:
+            valid &= values != nodata
+        counts = np.diff(self.offsets)
+        present = counts > 0
+        starts = self.offsets[:-1][present]
+        results = {}
+        count = np.add.reduceat(valid, starts, axis=1) if starts.size else \
+            np.zeros((n_times, 0))
+        total = np.add.reduceat(np.where(valid, values, 0), starts, axis=1) \
+            if starts.size else np.zeros((n_times, 0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+        results['count'] = count
+        results['sum'] = np.where(count > 0, total, np.nan)
+        results['mean'] = mean
+        if starts.size and set(['min', 'max', 'range']).intersection(
+                statistics):
+            results['min'] = np.minimum.reduceat(
+                np.where(valid, values, np.inf), starts, axis=1)
+            results['max'] = np.maximum.reduceat(
+                np.where(valid, values, -np.inf), starts, axis=1)
+            results['range'] = results['max'] - results['min']
+        if starts.size and 'std' in statistics:
+            zone_of_pixel = np.repeat(np.arange(starts.size), counts[present])
+            deviation = np.where(valid, values - mean[:, zone_of_pixel], 0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                results['std'] = np.sqrt(np.add.reduceat(
+                    deviation * deviation, starts, axis=1) / count)
+        out = np.full((self.n_zones, n_times, len(statistics)), np.nan)
+        out[..., [i for i, s in enumerate(statistics) if s == 'count']] = 0
+        empty = count == 0
+        for i, stat in enumerate(statistics):
+            if stat not in results or not starts.size:
+                continue
+            result = results[stat].astype(np.float64)
+            if stat != 'count':
+                result[empty] = np.nan
+            out[present, :, i] = result.T
+        return out
+
+    def _nodata_counts(self, values, isnan, statistics, nodata):
+        """Count the nodata and nan pixels of every zone."""
+        extra = {}
+        if 'nodata' in statistics:
+            hits = (values == nodata if nodata is not None
+                    else np.zeros(values.shape, dtype=bool))
+            extra['nodata'] = np.bincount(self.zones[hits],
+                                          minlength=self.n_zones)
+        if 'nan' in statistics:
+            hits = (isnan if isnan is not None
+                    else np.zeros(values.shape, dtype=bool))
+            extra['nan'] = np.bincount(self.zones[hits],
+                                       minlength=self.n_zones)
+        return extra
+
+    def _reduce(self, values, zones, statistics, extra=None):
+        """Reduce valid values grouped by their (sorted) zone numbers."""
+        n_zones = self.n_zones
+        count = np.bincount(zones, minlength=n_zones)
+        present = count > 0
+        starts = np.concatenate([[0], np.cumsum(count)[:-1]])
+        total = np.bincount(zones, weights=values, minlength=n_zones)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / count
+        results = {'count': count, 'sum': total, 'mean': mean}
+        if values.size:
+            nonempty = starts[present]
+            minimum = np.zeros(n_zones, dtype=values.dtype)
+            maximum = np.zeros(n_zones, dtype=values.dtype)
+            minimum[present] = np.minimum.reduceat(values, nonempty)
+            maximum[present] = np.maximum.reduceat(values, nonempty)
+            results['min'] = minimum
+            results['max'] = maximum
+            results['range'] = (maximum.astype(np.float64)
+                                - minimum.astype(np.float64))
+        if 'std' in statistics and values.size:
+            deviation = values - mean[zones]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                results['std'] = np.sqrt(np.bincount(
+                    zones, weights=deviation * deviation,
+                    minlength=n_zones) / count)
+        percentiles = [s for s in statistics if s.startswith('percentile_')]
+        if values.size and (percentiles or
+                            set(ORDER_STATS).intersection(statistics)):
+            ordered = values[np.lexsort((values, zones))]
+            results.update(self._order_stats(ordered, zones, count, starts,
+                                             statistics, percentiles))
+        results.update(extra or {})
+        return self._to_records(results, statistics, present)
+
+    def _order_stats(self, ordered, zones, count, starts, statistics,
+                     percentiles):
+        """Compute median, percentiles and value-count stats on sorted data."""
+        results = {}
+        present = count > 0
+        last = np.maximum(count - 1, 0)
+        if 'median' in statistics:
+            percentiles = percentiles + ['median']
+        for stat in percentiles:
+            q = 50.0 if stat == 'median' else get_percentile(stat)
+            position = last * q / 100.0
+            lower = np.floor(position).astype(np.int64)
+            upper = np.ceil(position).astype(np.int64)
+            value = np.zeros(len(count))
+            lo = ordered[(starts + lower)[present]].astype(np.float64)
+            hi = ordered[(starts + upper)[present]].astype(np.float64)
+            value[present] = lo + (hi - lo) * (position - lower)[present]
+            results[stat] = value
+        if set(['majority', 'minority', 'unique']).intersection(statistics):
+            change = np.ones(ordered.size, dtype=bool)
+            change[1:] = ((ordered[1:] != ordered[:-1])
+                          | (zones[1:] != zones[:-1]))
+            run_starts = np.flatnonzero(change)
+            run_lengths = np.diff(np.append(run_starts, ordered.size))
+            run_zones = zones[run_starts]
+            run_values = ordered[run_starts]
+            results['unique'] = np.bincount(run_zones, minlength=len(count))
+            for stat, sign in (('majority', -1), ('minority', 1)):
+                if stat not in statistics:
+                    continue
+                order = np.lexsort((run_values, sign * run_lengths,
+                                    run_zones))
+                first = np.ones(order.size, dtype=bool)
+                first[1:] = run_zones[order][1:] != run_zones[order][:-1]
+                value = np.zeros(len(count), dtype=ordered.dtype)
+                value[run_zones[order][first]] = run_values[order][first]
+                results[stat] = value
+        return results
+
+    @staticmethod
+    def _to_records(results, statistics, present):
+        """Convert per-zone stat arrays into a list of dicts."""
+        statistics = ([s for s in REPORT_ORDER if s in statistics]
+                      + [s for s in statistics if s not in REPORT_ORDER])
+        records = []
+        for zone, has_values in enumerate(present):
+            record = {}
+            for stat in statistics:
+                if stat in ('nodata', 'nan'):
+                    record[stat] = float(results[stat][zone])
+                elif stat == 'count':
+                    record[stat] = int(results['count'][zone])
+                elif not has_values:
+                    record[stat] = None
+                elif stat == 'unique':
+                    record[stat] = int(results[stat][zone])
+                else:
+                    record[stat] = float(results[stat][zone])
+            records.append(record)
+        return records